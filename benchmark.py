@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import resource
+import tracemalloc
+import multiprocessing
+import numpy as np
+import pandas as pd
+import bureau_data_simulation as sim
+
+# Benchmarks for the bureau data simulation: each pipeline stage on its own, then the whole pipeline, at several scales.
+# Stages run in pipeline order on one shard's worth of customers, each fed the output of the stages before it.
+# A stage is timed without tracing (the median of --repeat runs), then run once more under tracemalloc for its peak memory,
+# which counts the Python and numpy allocations the stage makes. The pipeline runs main() --repeat times, each in a fresh
+# process, and reports the median time and peak resident memory of those processes. Medians of several runs keep one slow
+# or fast run from passing for a regression, or from hiding one. Throughput is rows produced per second: applicants for
+# simulate_loan_apps, the target and the pipeline, the rows of each child table and snapshots for theirs, customers for the aggregates.
+# Results are compared with a stored baseline: a throughput drop or a peak memory rise above --threshold is a regression.
+# Everything runs offline on the standard library, numpy and pandas; baselines only compare on the same machine.
+
+default_scales = [10000, 100000, 1000000]
+default_baseline = "benchmark_baseline.json"
+default_repeat = 5
+snapshot_months = 24 #months of snapshots the simulate_snapshots stage draws
+
+def build_target(loans, store, rand):
+  leaves = sim.leaf_frame(store)
+  leaves = sim.scale_scores(leaves, sim.score_ranges(leaves))
+  fills, thresh = sim.target_cutoffs(lambda: [leaves])
+  return sim.assign_target(loans, sim.final_score(leaves, fills), thresh, sim.target_overrides(loans, rand))
+
+#Stage name -> (function of the frames built so far, name of its output); draws are keyed, so every run draws the same.
+#The stages are those of simulate_chunk: the table specs' simulate_<stage> and agg_<stage>, and snapshots after the tradelines
+def child_stages(i, spec):
+  calls = {"simulate_"+spec["stage"]: (lambda d: sim.simulate_table(spec, d["customers"], d["rands"][spec["rand"]],
+    parent=d["loans"], ids=d["child_ids"][i], counts=d["counts"][i]), spec["name"])}
+  if spec is sim.tradeline_spec:
+    calls["simulate_snapshots"] = (lambda d: sim.simulate_snapshots(d[spec["name"]], d["rands"][spec["rand"]], snapshot_months), "snapshots")
+  calls["agg_"+spec["stage"]] = (lambda d: sim.agg_table(spec, d[spec["name"]], d["rands"]["agg_"+spec["stage"]]), "agg_"+spec["stage"])
+  return calls
+
+stage_calls = {"simulate_"+sim.loans_spec["stage"]: (lambda d: sim.simulate_table(sim.loans_spec, d["customers"], d["rands"][sim.loans_spec["rand"]]), "loans")}
+for i, spec in enumerate(sim.child_specs):
+  stage_calls.update(child_stages(i, spec))
+stage_calls["target"] = (lambda d: build_target(d["loans"], d["store"], d["rands"]["target"]), "target")
+stages = list(stage_calls)
+
+def stage_inputs(nRows):
+  ids, run_key, totals = sim.run_keys(nRows, 6)
+  counts = sim.shard_counts(0, nRows, run_key)
+  customers, ordinals, counts, child_ids = sim.shard_ids(0, nRows, ids, counts, [0]*len(counts))
+  return {"customers": customers, "child_ids": child_ids, "counts": counts, "rands": sim.shard_rands(run_key, ordinals, counts)}
+
+#The latent store simulate_chunk builds, the input of the target stage
+def latent_store(d):
+  return sim.latent_store(d["customers"], d["counts"], d["loans"], [d["agg_"+spec["stage"]] for spec in sim.child_specs])
+
+def time_call(fn, repeat):
+  seconds = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    result = fn()
+    seconds.append(time.perf_counter()-start)
+  return np.median(seconds), result
+
+def peak_call(fn):
+  tracemalloc.start()
+  try:
+    fn()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+def bench_stages(nRows, repeat, selected):
+  frames = stage_inputs(nRows)
+  results = []
+  for name in stages:
+    if name=="target":
+      frames["store"] = latent_store(frames)
+    fn, out = stage_calls[name]
+    call = lambda: fn(frames)
+    seconds, frames[out] = time_call(call, repeat)
+    if name not in selected:
+      continue
+    results.append({"stage": name, "scale": nRows, "rows": len(frames[out]), "seconds": seconds,
+      "rows_per_s": len(frames[out])/seconds, "peak_mb": peak_call(call)/2**20})
+  return results
+
+def run_pipeline(nRows, chunk_size, workers, out_dir):
+  start = time.perf_counter()
+  sim.main(nRows, chunk_size, out_dir, workers)
+  seconds = time.perf_counter()-start
+  #ru_maxrss is in kilobytes on Linux; worker processes are included when they have exited
+  peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  return seconds, peak_kb/1024
+
+def bench_pipeline(nRows, chunk_size, workers, repeat):
+  runs = []
+  for i in range(repeat):
+    out_dir = tempfile.mkdtemp(prefix="bureau_bench_")
+    try:
+      #A fresh process per run, so the peak is this run's alone
+      with multiprocessing.get_context("spawn").Pool(1) as pool:
+        runs.append(pool.apply(run_pipeline, (nRows, chunk_size, workers, out_dir)))
+    finally:
+      shutil.rmtree(out_dir)
+  seconds, peak_mb = np.median(runs, axis=0)
+  return {"stage": "pipeline", "scale": nRows, "rows": nRows, "seconds": seconds, "rows_per_s": nRows/seconds, "peak_mb": peak_mb}
+
+def environment():
+  return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+    "machine": platform.machine(), "system": platform.system(), "cpus": os.cpu_count()}
+
+def result_key(result):
+  return "%s@%d" % (result["stage"], result["scale"])
+
+def compare(results, baseline, threshold):
+  regressions = []
+  for result in results:
+    base = baseline.get(result_key(result))
+    if base is None:
+      result["vs_baseline"] = None
+      continue
+    speed = result["rows_per_s"]/base["rows_per_s"]-1
+    memory = result["peak_mb"]/base["peak_mb"]-1
+    result["vs_baseline"] = {"rows_per_s": speed, "peak_mb": memory}
+    if speed < -threshold:
+      regressions.append("%s: throughput %.0f rows/s vs %.0f (%+.0f%%)" % (result_key(result), result["rows_per_s"], base["rows_per_s"], 100*speed))
+    if memory > threshold:
+      regressions.append("%s: peak memory %.1f MB vs %.1f (%+.0f%%)" % (result_key(result), result["peak_mb"], base["peak_mb"], 100*memory))
+  return regressions
+
+def print_results(results):
+  print("%-24s %9s %10s %9s %13s %10s %16s" % ("stage","scale","rows","seconds","rows/s","peak MB","vs baseline"))
+  for r in results:
+    change = "" if r.get("vs_baseline") is None else "%+.0f%% / %+.0f%%" % (100*r["vs_baseline"]["rows_per_s"], 100*r["vs_baseline"]["peak_mb"])
+    print("%-24s %9d %10d %9.3f %13.0f %10.1f %16s" % (r["stage"], r["scale"], r["rows"], r["seconds"], r["rows_per_s"], r["peak_mb"], change))
+
+def main(scales=default_scales, selected=stages+["pipeline"], repeat=default_repeat, threshold=0.2, baseline_path=default_baseline,
+  save=False, report=None, chunk_size=None, workers=1):
+  results = []
+  #A small untimed run first, so that no stage pays for first-call setup
+  bench_stages(1000, 1, [])
+  for nRows in scales:
+    print("Benchmarking %d customers" % nRows, file=sys.stderr)
+    results += bench_stages(nRows, repeat, selected)
+    if "pipeline" in selected:
+      results.append(bench_pipeline(nRows, chunk_size, workers, repeat))
+
+  baseline = {}
+  if os.path.exists(baseline_path):
+    with open(baseline_path) as f:
+      stored = json.load(f)
+    baseline = stored["results"]
+    if stored["environment"]!=environment():
+      print("Baseline was recorded on a different environment: "+json.dumps(stored["environment"]), file=sys.stderr)
+  regressions = compare(results, baseline, threshold)
+  print_results(results)
+
+  if report:
+    with open(report, "w") as f:
+      json.dump({"environment": environment(), "threshold": threshold, "results": results, "regressions": regressions}, f, indent=2)
+  if save:
+    #Saving merges into the stored baseline, so scales and stages not run this time keep their numbers
+    baseline.update({result_key(r): {k: r[k] for k in ("rows","seconds","rows_per_s","peak_mb")} for r in results})
+    with open(baseline_path, "w") as f:
+      json.dump({"environment": environment(), "results": baseline}, f, indent=2, sort_keys=True)
+    print("Saved baseline to "+baseline_path)
+    return 0
+  for line in regressions:
+    print("REGRESSION "+line)
+  return 1 if regressions else 0
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Benchmark the bureau data simulation stages and pipeline")
+  parser.add_argument("--scales", default=",".join(str(s) for s in default_scales), help="comma separated numbers of customers")
+  parser.add_argument("--stages", default=",".join(stages+["pipeline"]), help="comma separated stages to report, from: "+", ".join(stages+["pipeline"]))
+  parser.add_argument("--repeat", type=int, default=default_repeat, help="time each stage and the pipeline this many times and compare the medians")
+  parser.add_argument("--threshold", type=float, default=0.2, help="relative throughput drop or peak memory rise reported as a regression")
+  parser.add_argument("--baseline", default=default_baseline, help="baseline file to compare with and save to")
+  parser.add_argument("--save", action="store_true", help="store these results as the baseline instead of checking for regressions")
+  parser.add_argument("--report", default=None, help="also write the results as JSON to this file")
+  parser.add_argument("--chunk-size", type=int, default=None, help="shard size for the pipeline runs")
+  parser.add_argument("--workers", type=int, default=1, help="worker processes for the pipeline runs")
+  args = parser.parse_args()
+  unknown = set(args.stages.split(","))-set(stages+["pipeline"])
+  if unknown:
+    parser.error("unknown stages: "+", ".join(sorted(unknown)))
+  sys.exit(main([int(s) for s in args.scales.split(",")], args.stages.split(","), args.repeat, args.threshold,
+    args.baseline, args.save, args.report, args.chunk_size, args.workers))
@@ -1,22 +1,39 @@
 import pandas as pd
 import numpy as np
-import random
-import datetime 
-import math
+import os
+import json
+import shutil
+import time
+import tempfile
+import logging
+import argparse
+import inspect
+from concurrent.futures import ProcessPoolExecutor
 from scipy.stats import skewnorm
+from scipy.special import gammaincinv
+import sim_engine
+import sim_output
+from sim_engine import conform, draw_counts, child_numbers, table_columns, markov_paths, keyed_rand, uniform, integers, normal, gamma, choice, new_store, store_put, store_get, band_scores, weighted_score, group_agg, chunked_quantile, id_width, id_key, allocate_ids, id_ordinals
+from sim_output import formats, output_config, shard_path, prepare_table, write_part, finish_table, start_writer, submit, stop_writer
+from sim_report import log, new_report, stage, merge_profiles, process_usage, write_report
+from sim_cache import cache_config, fingerprint, cached_call, cached_file
+from sim_validate import summarize, merge_summaries, validation_report, write_validation
 
 mySeed = 20171230
-np.random.seed(mySeed)
 
 # This code's objective is to simulate bureau data for building a project to demonstrate the Automated Feature Engineering capabilities of DataRobot
 # We will create fake Credit Bureau Data - Tradeline.csv, PublicRecords.csv, Inquiries.csv, Collections.csv, and LoanApplications.csv
 
-def sim_date(oldest_dt, duration, num_days):
-  oldest_dt = datetime.datetime.strptime(oldest_dt,'%Y-%m-%d')
-  dt_list = []
-  for i in range(num_days):
-    dt_list.append(oldest_dt + datetime.timedelta(days=int(np.random.choice(list(range(0,duration)),1))))
-  return pd.Series(dt_list)
+def sim_date(oldest_dt, duration, rand, name):
+  return np.datetime64(oldest_dt,'D') + integers(rand, name, 0, duration)
+
+#Application window of the first cohort of applicants, 3 months from 2014-07-01. Runs that append a later cohort
+#give it its own window, and every other date of its customers moves with the window's start (see cohort_shift),
+#so account histories, inquiries and bureau report dates keep the same distance to the application.
+first_cohort = {"start": "2014-07-01", "window": 90}
+
+def cohort_shift(cohort):
+  return np.datetime64(cohort["start"],'D') - np.datetime64(first_cohort["start"],'D')
 
 ############################# Loan Applications Data ######################################
 
@@ -25,534 +42,1247 @@ def sim_date(oldest_dt, duration, num_days):
 # All these loans were approved and went through the entire loan cycle. Now, we know who defaulted(target=1) and paid back in full(target=0)
 # Below, we simulate the information available at the time of making the lending decision
 
-def simulate_loan_apps(customers):
-  print("Simulating loan applications")
-  nRows = len(customers)
-  loans = pd.DataFrame(customers,columns=['CustID']).sort_values(by='CustID')
-
-  #Application date
-  oldest_app_date = '2014-07-01'
-  app_window = 90 #3 months of applications
-  loans["app_date"] = sim_date(oldest_app_date,app_window,nRows)
-  loans["is_bad"] = np.random.choice([0,1],nRows,p=[0.9,0.1])
-
-  #Annual Income
-  loans["annual_income"] = np.random.binomial(1, 0.995, nRows)*np.round(np.random.gamma(1.7, 3, nRows)*10000, decimals=-2).astype('int64')
-  loans.loc[loans["annual_income"]<1000,"annual_income"] = 1000
-  
-  #Marital Status
-  mar_list=["single","married","divorced","widowed"]
-  mar_prob_low = [0.6,0.15,0.23,0.02]
-  mar_prob_med = [0.4,0.35,0.15,0.1]
-  mar_prob_high = [0.15,0.6,0.05,0.2]
-  loans.loc[loans["annual_income"]<30000,"marital_status"] = np.random.choice(mar_list,len(loans[loans["annual_income"]<30000]),p=mar_prob_low)
-  loans.loc[(loans["annual_income"]>=30000) & (loans["annual_income"]<50000),"marital_status"] = np.random.choice(mar_list,len(loans[(loans["annual_income"]>=30000) & (loans["annual_income"]<50000)]),p=mar_prob_med)
-  loans.loc[loans["annual_income"]>=50000,"marital_status"] = np.random.choice(mar_list,len(loans[loans["annual_income"]>=50000]),p=mar_prob_high)
-  
-  #Residential Status
-  res_list=["rent","house_owner","mortgage"]
-  res_prob_single=[0.85,0.05,0.1]
-  res_prob_married=[0.3,0.2,0.5]
-  res_prob_divorced=[0.6,0.1,0.3]
-  res_prob_widowed=[0.1,0.6,0.3]
-  loans.loc[loans["marital_status"]=="single","residential_status"] = np.random.choice(res_list,len(loans[loans["marital_status"]=="single"]),p=res_prob_single)
-  loans.loc[loans["marital_status"]=="married","residential_status"] = np.random.choice(res_list,len(loans[loans["marital_status"]=="married"]),p=res_prob_married)
-  loans.loc[loans["marital_status"]=="divorced","residential_status"] = np.random.choice(res_list,len(loans[loans["marital_status"]=="divorced"]),p=res_prob_divorced)
-  loans.loc[loans["marital_status"]=="widowed","residential_status"] = np.random.choice(res_list,len(loans[loans["marital_status"]=="widowed"]),p=res_prob_widowed)
-  
-  #Loan purpose
-  purpose_list=["auto","education","personal loan","business","debt_consolidation"]
-  purpose_prob = [0.17,0.1,0.35,0.25,0.13]
-  loans["loan_purpose"] = np.random.choice(purpose_list,nRows,p=purpose_prob)
-  
-  #Application Scores
-  l=[]
-  for index,app in loans.iterrows():
-    dict_app = {}
-    dict_app["CustID"] = loans["CustID"]
-
-    #Annual Income
-    if app["annual_income"]<20000:
-      dict_app["inc_score"] = random.uniform(14,15)
-    elif 20000<=app["annual_income"]<30000:
-      dict_app["inc_score"] = random.uniform(11,12)
-    elif 30000<=app["annual_income"]<40000:
-      dict_app["inc_score"] = random.uniform(8,10)
-    elif 40000<=app["annual_income"]<50000:
-      dict_app["inc_score"] = random.uniform(6,7)
-    elif 50000<=app["annual_income"]<60000:
-      dict_app["inc_score"] = random.uniform(5,6)
-    elif 60000<=app["annual_income"]<70000:
-      dict_app["inc_score"] = random.uniform(4,5)
-    elif 70000<=app["annual_income"]<80000:
-      dict_app["inc_score"] = random.uniform(3,4)
-    elif 80000<=app["annual_income"]<90000:
-      dict_app["inc_score"] = random.uniform(1,2)
-    else:
-      dict_app["inc_score"] = random.uniform(0,0.5)
-    
-    ##Marital Status
-    if app["marital_status"] == "single":
-      dict_app["mar_score"] = random.uniform(2,6)
-    elif app["marital_status"] == "married":
-      dict_app["mar_score"] = random.uniform(1,3)
-    elif app["marital_status"] == "divorced":
-      dict_app["mar_score"] = random.uniform(5,9)
-    elif app["marital_status"] == "widowed":
-      dict_app["mar_score"] = random.uniform(0,4)
-
-    #Residential Status
-    if app["residential_status"] == "rent":
-      dict_app["res_score"] = random.uniform(4,9)
-    elif app["residential_status"] == "mortgage":
-      dict_app["res_score"] = random.uniform(2,7)
-    elif app["residential_status"] == "house_owner":
-      dict_app["res_score"] = random.uniform(0,5)
-
-    #Loan purpose
-    if app["loan_purpose"] == "education":
-      dict_app["purpose_score"] = random.uniform(0,1)
-    elif app["loan_purpose"] == "debt_consolidation":
-      dict_app["purpose_score"] = random.uniform(5,7)
-    elif app["loan_purpose"] == "auto":
-      dict_app["purpose_score"] = random.uniform(2,4)
-    elif app["loan_purpose"] == "personal":
-      dict_app["purpose_score"] = random.uniform(8,10)
-    else:
-      dict_app["purpose_score"] = random.uniform(12,15)
-
-    #Application Variable weights
-    a1= 0.45#annual income
-    a2= 0.0#marital status
-    a3= 0.1#residential status
-    a4= 0.35#loan purpose
-
-    dict_app["app_risk_score"] = a1*dict_app["inc_score"]+a2*dict_app["mar_score"]+a3*dict_app["res_score"]+a4*dict_app["purpose_score"]
-    l.append(dict_app)
-
-  scores = pd.DataFrame(l)
-  max_score = max(scores["app_risk_score"]) 
-  min_score = min(scores["app_risk_score"])
-  loans["app_risk_score"] = scores["app_risk_score"].apply(lambda x: (x-min_score)/(max_score-min_score))
-  loans["inc_score"] = scores["inc_score"]
-  loans["purpose_score"] = scores["purpose_score"]
-  loans["res_score"] = scores["res_score"]
-
-  return loans
-  
-
-def agg_tradeline(tl):
-  print("Aggregating tradeline table")
-  rows = tl[["CustID","account_id"]].groupby("CustID").count().reset_index()
-  rows.columns = ["CustID","num_tl_accounts"]
-
-  #Account type
-  rows["account_type_mostfreq"] = tl[['CustID','account_type']].groupby("CustID").agg(lambda x: x.value_counts().index[0]).reset_index()["account_type"]
-  rows["account_type_numunique"] = tl[['CustID','account_type']].groupby("CustID").agg(lambda x: len(x.unique())).reset_index()["account_type"]
-
-  #Creditor
-  rows["creditor_mostfreq"] = tl[['CustID','creditor']].groupby("CustID").agg(lambda x: x.value_counts().index[0]).reset_index()["creditor"]
-  rows["creditor_numunique"] = tl[['CustID','creditor']].groupby("CustID").agg(lambda x: len(x.unique())).reset_index()["creditor"]
-
-  #Account owner
-  rows["account_owner_mostfreq"] = tl[['CustID','account_owner']].groupby("CustID").agg(lambda x: x.value_counts().index[0]).reset_index()["account_owner"]
-  rows["account_owner_numunique"] = tl[['CustID','account_owner']].groupby("CustID").agg(lambda x: len(x.unique())).reset_index()["account_owner"]
-
-  #Current delinquency
-  rows["curr_delq_mostfreq"] = tl[['CustID','current_delq']].groupby("CustID").agg(lambda x: x.value_counts().index[0] if len(x.value_counts())>0 else "NA").reset_index()["current_delq"]
-  
-  #Worst delq
-  rows["worst_delq_mostfreq"] = tl[['CustID','worst_dlq']].groupby("CustID").agg(lambda x: x.value_counts().index[0] if len(x.value_counts())>0 else "NA").reset_index()["worst_dlq"]
-
-  #Utilization
-  rows["util_avg"]=tl[['CustID','utilization']].groupby("CustID").agg({'utilization':lambda x:x.mean()}).reset_index()["utilization"]
-
-  #Credit limit
-  rows["credit_limit_avg"] = tl[['CustID','credit_limit']].groupby("CustID").agg({'credit_limit':lambda x:x.mean()}).reset_index()["credit_limit"] 
-  
-  l=[]
-  #Create scores for each aggregated variable
-  for index,row in rows.iterrows():
-    dict_tl = {}
-    dict_tl["CustID"] = row["CustID"]
-
-    #Number of tl accounts
-    if row["num_tl_accounts"]==0:
-      dict_tl["num_tl_score"] = random.uniform(6,10)
-    elif 0<row["num_tl_accounts"]<3:
-      dict_tl["num_tl_score"] = random.uniform(0,4)
-    elif 3<=row["num_tl_accounts"]<5:
-      dict_tl["num_tl_score"] = random.uniform(2,5)
-    else:
-      dict_tl["num_tl_score"] = random.uniform(3,6)
-
-    #Most frequent account type
-    if row["account_type_mostfreq"]=="revolving":
-      dict_tl["account_type_mostfreq_score"] = random.uniform(2,7)
-    elif row["account_type_mostfreq"]=="mortgage":
-      dict_tl["account_type_mostfreq_score"] = random.uniform(3,5)
-    else:
-      dict_tl["account_type_mostfreq_score"] = random.uniform(1,4)
-    
-    #Num unique creditor
-    if row["creditor_numunique"]==1:
-      dict_tl["creditor_numunique_score"] = random.uniform(0,3)
-    elif row["creditor_numunique"]==2:
-      dict_tl["creditor_numunique_score"] = random.uniform(1,4)
-    elif row["creditor_numunique"]==3:
-      dict_tl["creditor_numunique_score"] = random.uniform(3,7)
-    else:
-      dict_tl["creditor_numunique_score"] = random.uniform(4,9)
-
-    #Most freq creditor
-    if row["creditor_mostfreq"] in ["ABC Bank","Bank of XYZ","Cooperative Capital"]:
-      dict_tl["creditor_mostfreq_score"] = random.uniform(1,6)
-    else:
-      dict_tl["creditor_mostfreq_score"] = random.uniform(5,10)
-
-    #Credit limit
-    if row["credit_limit_avg"]==None:
-      dict_tl["credit_limit_avg_score"] = random.uniform(0,4)
-    elif row["credit_limit_avg"]<3000:
-      dict_tl["credit_limit_avg_score"] = random.uniform(4,9)
-    elif 3000<=row["credit_limit_avg"]<4000:
-      dict_tl["credit_limit_avg_score"] = random.uniform(3,6)
-    elif 4000<=row["credit_limit_avg"]<5000:
-      dict_tl["credit_limit_avg_score"] = random.uniform(1,5)
-    else:
-      dict_tl["credit_limit_avg_score"] = random.uniform(0,3)
-
-    # #Utilization
-    # if row["util_avg"]==None:
-    #   dict_tl["average_util_score"] = random.uniform(0,4)
-    # elif row["util_avg"]<0.3 :
-    #   dict_tl["average_util_score"] = random.uniform(1,4)
-    # elif 0.3<=row["util_avg"]<0.5 :
-    #   dict_tl["average_util_score"] = random.uniform(3,6)
-    # elif 0.5<=row["util_avg"]<0.75 :
-    #   dict_tl["average_util_score"] = random.uniform(5,7)
-    # else:
-    #   dict_tl["average_util_score"] = random.uniform(7,9)
-    dict_tl["average_util_score"] = row["util_avg"]*10
-
-    #Curr delinquency
-    if row["curr_delq_mostfreq"]=="<30DPD":
-      dict_tl["curr_delq_mostfreq_score"] = random.uniform(0,3)
-    elif row["curr_delq_mostfreq"]=="30-60DPD":
-      dict_tl["curr_delq_mostfreq_score"] = random.uniform(1,5)
-    elif row["curr_delq_mostfreq"]=="60-90DPD":
-      dict_tl["curr_delq_mostfreq_score"] = random.uniform(3,6)
-    elif row["curr_delq_mostfreq"]==">90DPD":
-      dict_tl["curr_delq_mostfreq_score"] = random.uniform(5,9)
-    else:
-      dict_tl["curr_delq_mostfreq_score"] = random.uniform(1,5)
-
-    #Worst delinquency
-    if row["worst_delq_mostfreq"]=="<30DPD":
-      dict_tl["worst_delq_mostfreq_score"] = random.uniform(0,3)
-    elif row["worst_delq_mostfreq"]=="30-60DPD":
-      dict_tl["worst_delq_mostfreq_score"] = random.uniform(1,5)
-    elif row["worst_delq_mostfreq"]=="60-90DPD":
-      dict_tl["worst_delq_mostfreq_score"] = random.uniform(3,6)
-    elif row["worst_delq_mostfreq"]==">90DPD":
-      dict_tl["worst_delq_mostfreq_score"] = random.uniform(5,9)
-    else:
-      dict_tl["worst_delq_mostfreq_score"] = random.uniform(1,5)
-
-    l.append(dict_tl)
-
-  scores = pd.DataFrame(l)
-  #TL variable weights
-  t1 = 0.2 #num_tl
-  t2 = 0.25 #curr_delq_mostfreq
-  t3 = 0.0 #worst_delq_mostfreq
-  t4 = 0.1 #creditor_numunique
-  t5 = 0.05 #acct_type_mostfreq
-  t6 = 0.3 #avg utilization
-  t7 = 0.05 #avg credit limit
-  t8 = 0.05 #most freq creditor
-
-  scores["tl_risk_score"] = t1*scores["num_tl_score"] + t2*scores["curr_delq_mostfreq_score"] + t3*scores["worst_delq_mostfreq_score"] 
-  + t4*scores["creditor_numunique_score"] + t5*scores["account_type_mostfreq_score"] + t6*scores["average_util_score"] + t7*scores["credit_limit_avg_score"]
-  + t8*scores["creditor_mostfreq_score"]
-  max_score = max(scores["tl_risk_score"]) 
-  min_score = min(scores["tl_risk_score"])
-  scores["tl_risk_score"] = scores["tl_risk_score"].apply(lambda x: (x-min_score)/(max_score-min_score))
-  return rows.merge(scores,on="CustID")
-
-def simulate_tradeline(customers,loans):
-  print("Simulating tradeline accounts")
-  nTradeLines = len(customers) * 3 #assuming that bureau contains 3 tradelines on average per customer
-  tradeline = pd.DataFrame(np.random.choice(customers, nTradeLines, replace=True), columns=['CustID']).sort_values(by="CustID")
-
-  #AccountID: Existing tradelines for applicant
-  tradeline['account_id'] = ["A"+str(s) for s in np.random.choice(999999, size=nTradeLines,replace=False)] 
-
-  #Account Type
-  acct_type = ["revolving","mortgage","instalment"]
-  acct_type_prob = [0.75,0.1,0.15]
-  tradeline["account_type"] = np.random.choice(acct_type,nTradeLines,p=acct_type_prob)
-
-  #Creditor
-  list_banks = ["TrendingClub","ABC Bank","Bank of XYZ","Cooperative Capital","Rhyme","Lord_P2P","Uprise"]
-  mkt_share = [0.1,0.34,0.21,0.1,0.09,0.07,0.09]
-  tradeline["creditor"] = np.random.choice(list_banks,nTradeLines,p=mkt_share)
-
-  #AccountOwner
-  owner_list = ["individual","joint"]
-  owner_prob = [0.9,0.1]
-  tradeline["account_owner"] = np.random.choice(owner_list,nTradeLines,p=owner_prob)
-
-  #Int_Rate
-  tradeline["int_rate"] = None
-  tradeline.loc[tradeline["account_type"]=="instalment","int_rate"] = np.random.normal(0.08,0.0016,len(tradeline[tradeline["account_type"]=="instalment"]))
-  tradeline.loc[tradeline["account_type"]=="mortgage","int_rate"] = np.random.normal(0.06,.0009,len(tradeline[tradeline["account_type"]=="mortgage"]))
-  tradeline.loc[tradeline["account_type"]=="revolving","int_rate"] = np.random.normal(0.09,0.0036,len(tradeline[tradeline["account_type"]=="revolving"]))
-
-  #Credit limit
-  tradeline["credit_limit"]=None
-  tradeline.loc[tradeline["account_type"]=="revolving","credit_limit"] = np.random.randint(1000,8000,size=len(tradeline[tradeline["account_type"]=="revolving"]))
-  tradeline["credit_limit"] = tradeline["credit_limit"].apply(lambda x: int(math.ceil(x)/100.0)*100 if x!=None else x)
+#Marital Status
+mar_list=["single","married","divorced","widowed"]
+mar_prob_low = [0.6,0.15,0.23,0.02]
+mar_prob_med = [0.4,0.35,0.15,0.1]
+mar_prob_high = [0.15,0.6,0.05,0.2]
+
+#Residential Status
+res_list=["rent","house_owner","mortgage"]
+res_prob_single=[0.85,0.05,0.1]
+res_prob_married=[0.3,0.2,0.5]
+res_prob_divorced=[0.6,0.1,0.3]
+res_prob_widowed=[0.1,0.6,0.3]
+
+#Loan purpose
+purpose_list=["auto","education","personal loan","business","debt_consolidation"]
+purpose_prob = [0.17,0.1,0.35,0.25,0.13]
+
+loans_schema = {
+  "CustID": None, #IDs keep pandas' default string dtype
+  "app_date": "datetime64[s]",
+  "is_bad": "int8",
+  "annual_income": "int32",
+  "marital_status": pd.CategoricalDtype(mar_list),
+  "residential_status": pd.CategoricalDtype(res_list),
+  "loan_purpose": pd.CategoricalDtype(purpose_list),
+}
+
+#Application score bands: score -> (column, bands[, default range])
+app_score_bands = {
+  "inc_score": ("annual_income", [
+    (20000,(14,15)),
+    (30000,(11,12)),
+    (40000,(8,10)),
+    (50000,(6,7)),
+    (60000,(5,6)),
+    (70000,(4,5)),
+    (80000,(3,4)),
+    (90000,(1,2)),
+    (np.inf,(0,0.5))]),
+  "mar_score": ("marital_status", {"single":(2,6), "married":(1,3), "divorced":(5,9), "widowed":(0,4)}),
+  "res_score": ("residential_status", {"rent":(4,9), "mortgage":(2,7), "house_owner":(0,5)}),
+  #"personal loan" is not listed, so it scores with the other purposes in the default band
+  "purpose_score": ("loan_purpose", {"education":(0,1), "debt_consolidation":(5,7), "auto":(2,4), "personal":(8,10)}, (12,15)),
+}
+
+#Application Variable weights
+app_weights = {
+  "inc_score":0.45, #a1 annual income
+  "mar_score":0.0, #a2 marital status
+  "res_score":0.1, #a3 residential status
+  "purpose_score":0.35, #a4 loan purpose
+}
+
+#Applications fall in the cohort's window
+def application_dates(frame, rand, context):
+  return sim_date(context["cohort"]["start"], context["cohort"]["window"], rand, "app_date")
+
+#Annual Income, 0 for 0.5% of applicants before the floor of 1000
+def annual_income(frame, rand, context):
+  income = (uniform(rand,"has_income")<0.995)*np.round(gamma(rand,"annual_income",1.7,3)*10000, decimals=-2).astype('int32')
+  return np.maximum(income, 1000).astype('int32')
+
+#The customer level table, see Table specs; is_bad is a placeholder until the target is known
+loans_spec = {
+  "name": "Loan Applications",
+  "stage": "loan_apps",
+  "rand": "loans",
+  "schema": loans_schema,
+  "columns": [
+    ("app_date", application_dates),
+    ("is_bad", "choice", [0.9,0.1]),
+    ("annual_income", annual_income),
+    #Marital status by income band (below 30000, below 50000, the rest), residential status by marital status
+    ("marital_status", "dependent", "annual_income", [(30000, mar_prob_low), (50000, mar_prob_med), (np.inf, mar_prob_high)]),
+    ("residential_status", "dependent", "marital_status", {"single": res_prob_single, "married": res_prob_married, "divorced": res_prob_divorced, "widowed": res_prob_widowed}),
+    ("loan_purpose", "choice", purpose_prob),
+  ],
+  "score_bands": app_score_bands,
+  "weights": app_weights,
+  "risk_score": "app_risk_score",
+  "leaf": "app",
+  "leaf_weight": 0.6,
+}
+
+
+#Tradelines per customer: Poisson with 3 on average, so about 5% of applicants have no tradeline.
+#{"dist": "zero_inflated_poisson", "mean": 3, "zero_prob": p} sets the share without tradelines directly, see sim_engine.draw_counts
+tradeline_counts = {"dist": "poisson", "mean": 3}
+
+#Account Type
+acct_type = ["revolving","mortgage","instalment"]
+acct_type_prob = [0.75,0.1,0.15]
+
+#Creditor
+list_banks = ["TrendingClub","ABC Bank","Bank of XYZ","Cooperative Capital","Rhyme","Lord_P2P","Uprise"]
+mkt_share = [0.1,0.34,0.21,0.1,0.09,0.07,0.09]
+
+#AccountOwner
+owner_list = ["individual","joint"]
+owner_prob = [0.9,0.1]
+
+#Delinquency status
+curr_status = ["<30DPD","30-60DPD","60-90DPD",">90DPD"]
+curr_status_prob = [0.8,0.08,0.07,0.05]
+#Worst status in the last 12 months given the current one, never better than the current one
+worst_dlq_prob = {
+  "<30DPD": [0.9,0.05,0.03,0.02], #accounts that are current as of now
+  "30-60DPD": [0,0.9,0.06,0.04], #accounts currently 1 cycle delq
+  "60-90DPD": [0,0,0.8,0.2], #accounts currently 2 cycles delq
+  ">90DPD": [0,0,0,1.0], #accounts currently 3 cycles delq
+}
+
+tradeline_schema = {
+  "CustID": None,
+  "account_id": None,
+  "account_type": pd.CategoricalDtype(acct_type),
+  "creditor": pd.CategoricalDtype(list_banks),
+  "account_owner": pd.CategoricalDtype(owner_list),
+  "int_rate": "float32",
+  "credit_limit": "Int32",
+  "balance": "float32",
+  "utilization": "float32",
+  "open_date": "datetime64[s]",
+  "closed_date": "datetime64[s]",
+  "report_date": "datetime64[s]",
+  "current_delq": pd.CategoricalDtype(curr_status),
+  "worst_dlq": pd.CategoricalDtype(curr_status),
+}
+
+#Tradeline aggregates: (column name, source column, aggregate[, value when a customer has none])
+tl_agg_spec = [
+  ("num_tl_accounts","account_id","count"),
+  ("account_type_mostfreq","account_type","mode"),
+  ("account_type_numunique","account_type","nunique"),
+  ("creditor_mostfreq","creditor","mode"),
+  ("creditor_numunique","creditor","nunique"),
+  ("account_owner_mostfreq","account_owner","mode"),
+  ("account_owner_numunique","account_owner","nunique"),
+  ("curr_delq_mostfreq","current_delq","mode","NA"),
+  ("worst_delq_mostfreq","worst_dlq","mode","NA"),
+  ("util_avg","utilization","mean"),
+  ("credit_limit_avg","credit_limit","mean"),
+]
+
+#Tradeline score bands
+delq_bands = {"<30DPD":(0,3), "30-60DPD":(1,5), "60-90DPD":(3,6), ">90DPD":(5,9)}
+tl_score_bands = {
+  "num_tl_score": ("num_tl_accounts", [(1,(6,10)), (3,(0,4)), (5,(2,5)), (np.inf,(3,6))]),
+  "account_type_mostfreq_score": ("account_type_mostfreq", {"revolving":(2,7), "mortgage":(3,5)}, (1,4)),
+  "creditor_numunique_score": ("creditor_numunique", [(1,(4,9)), (2,(0,3)), (3,(1,4)), (4,(3,7)), (np.inf,(4,9))]),
+  "creditor_mostfreq_score": ("creditor_mostfreq", {"ABC Bank":(1,6), "Bank of XYZ":(1,6), "Cooperative Capital":(1,6)}, (5,10)),
+  #Customers without an open revolving account have no average limit and fall in the last band
+  "credit_limit_avg_score": ("credit_limit_avg", [(3000,(4,9)), (4000,(3,6)), (5000,(1,5)), (np.inf,(0,3))]),
+  "average_util_score": ("util_avg", 10),
+  "curr_delq_mostfreq_score": ("curr_delq_mostfreq", delq_bands, (1,5)),
+  "worst_delq_mostfreq_score": ("worst_delq_mostfreq", delq_bands, (1,5)),
+}
+
+#TL variable weights
+#Only t1-t3 have ever reached tl_risk_score: the t4-t8 terms were on their own lines without a continuation,
+#so they are kept at zero to preserve the score distribution. The intended weights are noted alongside.
+tl_weights = {
+  "num_tl_score":0.2, #t1
+  "curr_delq_mostfreq_score":0.25, #t2
+  "worst_delq_mostfreq_score":0.0, #t3
+  "creditor_numunique_score":0.0, #t4 (0.1)
+  "account_type_mostfreq_score":0.0, #t5 (0.05)
+  "average_util_score":0.0, #t6 (0.3)
+  "credit_limit_avg_score":0.0, #t7 (0.05)
+  "creditor_mostfreq_score":0.0, #t8 (0.05)
+}
+
+#Credit limit, utilization and delinquency status of every account before closed accounts lose them;
+#revolving accounts only have a limit and utilization. Snapshots start their history from the same values.
+def account_limits(rand):
+  return integers(rand,"credit_limit",1000,8000)//100*100
+
+def account_utilization(rand):
+  return np.clip(normal(rand,"utilization",0.5,0.3),0,0.95)
+
+def account_delq(rand):
+  return choice(rand,"current_delq",curr_status_prob)
+
+#Limits, balances and open and close dates by account type, for accounts whose type, current and worst status are drawn;
+#dates are the first cohort's moved by the cohort's shift. Closed accounts lose their balance, limit and current status.
+def account_terms(tradeline, rand, context):
+  shift = context["shift"]
+  type_codes = tradeline["account_type"].cat.codes.to_numpy()
+  is_rev = type_codes==acct_type.index("revolving")
+  is_mg = type_codes==acct_type.index("mortgage")
+
+  #Credit limit, rounded down to the hundred; revolving accounts only
+  credit_limit = np.where(is_rev, account_limits(rand), 0).astype('int32')
 
   #Balance
-  tradeline["balance"]=None
-  tradeline["utilization"] = None
-  tradeline.loc[tradeline["account_type"]=="revolving","utilization"] = list(np.clip(np.random.normal(0.5,0.3,len(tradeline[tradeline["account_type"]=="revolving"])),0,0.95))
-  tradeline["balance"] = tradeline["credit_limit"]*tradeline["utilization"]
+  utilization = np.where(is_rev, account_utilization(rand), np.nan).astype('float32')
+  balance = (credit_limit*utilization).astype('float32')
 
   #Open and close dates
-  open_dates=[]
-  close_dates = []
-  mg_loan_life = np.random.normal(30*365,5*365,nTradeLines) #mortgage account could live between 6mo to 30 years
-  other_loan_life = np.random.normal(1,60, nTradeLines) #revolving and instalment are for 0 to 5 years
-
-  for i in range(len(tradeline)):
-  #mortgage accounts opened between 2004-01-01 and 2014-07-01
-    if (tradeline.iloc[i]["account_type"]=="mortgage"):
-      open_dt = (datetime.date(2004,6,1)+datetime.timedelta(days = int(np.random.randint(0,3600,1)[0])))
-      open_dates.append(open_dt)
-      mg_days = int(np.random.normal(20*365,7*365,1)[0])
-      close_dt = open_dt + datetime.timedelta(days = int(mg_days))
-      if close_dt>datetime.date(2014,7,1) or close_dt<open_dt:
-        close_dt=None
-    else: #revolving and instalment loans captured for last 2 years
-      open_dt = (datetime.date(2012,6,1)+datetime.timedelta(days = int(np.random.randint(0,365*2,1)[0])))
-      open_dates.append(open_dt)
-      other_days = np.random.normal(3*365,365,1)
-      close_dt = open_dates[i] + datetime.timedelta(days = int(other_days))
-      if close_dt>=datetime.date(2014,7,1) or close_dt<open_dt:
-        close_dt=None
-    close_dates.append(close_dt)
-
-  tradeline["open_date"] = open_dates
-  tradeline["closed_date"] = close_dates
-  tradeline["report_date"] = datetime.date(2004,5,31)
-
-  #Current delinquency status
-  curr_status = ["<30DPD","30-60DPD","60-90DPD",">90DPD"]
-  curr_status_prob = [0.8,0.08,0.07,0.05]
-  tradeline["current_delq"] = np.random.choice(curr_status,nTradeLines,p=curr_status_prob) 
-
-  #Worst Dlq in last 12 months
-  tradeline.loc[tradeline["current_delq"].isnull(),"worst_dlq"] = np.random.choice(["<30DPD","30-60DPD","60-90DPD",">90DPD"],len(tradeline[tradeline["current_delq"].isnull()]),p=[0.9,0.05,0.03,0.02]) #for closed accounts
-  tradeline.loc[tradeline["current_delq"]=="<30DPD","worst_dlq"]=np.random.choice(["<30DPD","30-60DPD","60-90DPD",">90DPD"],len(tradeline[tradeline["current_delq"]=="<30DPD"]),p=[0.9,0.05,0.03,0.02]) #accounts that are current as of now
-  tradeline.loc[tradeline["current_delq"]=="30-60DPD","worst_dlq"]=np.random.choice(["30-60DPD","60-90DPD",">90DPD"],len(tradeline[tradeline["current_delq"]=="30-60DPD"]),p=[0.9,0.06,0.04]) #accounts currently 1 cycle delq
-  tradeline.loc[tradeline["current_delq"]=="60-90DPD","worst_dlq"]=np.random.choice(["60-90DPD",">90DPD"],len(tradeline[tradeline["current_delq"]=="60-90DPD"]),p=[0.8,0.2]) #accounts currently 2 cycles delq
-  tradeline.loc[tradeline["current_delq"]==">90DPD","worst_dlq"]=">90DPD" #accounts currently 3 cycles delq
-  tradeline.loc[tradeline["closed_date"]<datetime.date(2013,7,1),"worst_dlq"]=None #for accounts closed before report_date-12 months
-  
+  #mortgage accounts opened between 2004-06-01 and 2014-04-13 and live 20 years on average,
+  #revolving and instalment loans captured for last 2 years and live 3 years on average
+  open_offset = integers(rand, "open_date", 0, np.where(is_mg, 3600, 365*2))
+  open_dates = np.where(is_mg, np.datetime64('2004-06-01','D'), np.datetime64('2012-06-01','D')) + shift + open_offset
+  loan_life = normal(rand, "loan_life", np.where(is_mg, 20*365, 3*365), np.where(is_mg, 7*365, 365)).astype('int64') #truncated towards zero
+  close_dates = open_dates + loan_life
+
+  #Accounts still open at 2014-07-01 (mortgages closing on that day count as closed) and negative lifetimes have no closed date
+  cutoff = np.datetime64('2014-07-01','D') + shift
+  still_open = np.where(is_mg, close_dates>cutoff, close_dates>=cutoff) | (close_dates<open_dates)
+  close_dates[still_open] = np.datetime64('NaT')
+  is_closed = ~still_open
+
   #When account is closed
-  tradeline.loc[~tradeline["closed_date"].isnull(),"balance"] = None
-  tradeline.loc[~tradeline["closed_date"].isnull(),"credit_limit"] = None
-  tradeline.loc[~tradeline["closed_date"].isnull(),"utilization"] = None
-  tradeline.loc[~tradeline["closed_date"].isnull(),"current_delq"]=None #for accounts closed before report_date
-
-  tl_agg = agg_tradeline(tradeline)
-  tl_agg.to_csv("agg_tl.csv",index=False, header=True)
-
-  tradeline = tradeline.merge(tl_agg[["CustID","tl_risk_score"]],on="CustID")
-  return tradeline
-
-def agg_inq(inq):
-  print("Aggregating inquiries table")
-  rows = inq[["CustID","inquiry_id"]].groupby("CustID").count().reset_index().sort_values(by="CustID")
-  rows.columns=["CustID","num_inquiries"]
-
-  #Inquiry type
-  rows["inq_type_mostfreq"] = inq[['CustID','inquiry_type']].groupby("CustID").agg(lambda x: x.value_counts().index[0]).reset_index()["inquiry_type"]
-  rows["inq_type_numunique"] = inq[['CustID','inquiry_type']].groupby("CustID").agg(lambda x: len(x.unique())).reset_index()["inquiry_type"]
-
-  #Application decision
-  rows["application_decision_mostfreq"] = inq[['CustID','application_decision']].groupby("CustID").agg(lambda x: x.value_counts().index[0]).reset_index()["application_decision"]
-  rows["application_decision_numunique"] = inq[['CustID','application_decision']].groupby("CustID").agg(lambda x: len(x.unique())).reset_index()["application_decision"]
-
-  #Inquiry Scores
-  l=[]
-
-  for index, inq in rows.iterrows():
-    dict_inq={}
-    dict_inq["CustID"] = rows["CustID"]
-
-    #Number of inquiries
-    if inq["num_inquiries"]==None or inq["num_inquiries"]==0:
-      dict_inq["num_inq_score"] = random.uniform(0,3)
-    elif inq["num_inquiries"]==1:
-      dict_inq["num_inq_score"] = random.uniform(0,5)
-    elif 1<inq["num_inquiries"]<4:
-      dict_inq["num_inq_score"] = random.uniform(1,6)
-    elif inq["num_inquiries"]>4:
-      dict_inq["num_inq_score"] = random.uniform(3,8)
-    else:
-      dict_inq["num_inq_score"] = random.uniform(0,4)
+  balance[is_closed] = np.nan
+  utilization[is_closed] = np.nan
+
+  return {
+    "credit_limit": pd.arrays.IntegerArray(credit_limit, ~is_rev | is_closed),
+    "balance": balance,
+    "utilization": utilization,
+    "open_date": open_dates,
+    "closed_date": close_dates,
+    "current_delq": tradeline["current_delq"].where(~is_closed), #for accounts closed before report_date
+    "worst_dlq": tradeline["worst_dlq"].where(~(close_dates<np.datetime64('2013-07-01','D')+shift)), #for accounts closed before report_date-12 months
+  }
+
+tradeline_spec = {
+  "name": "Bureau Tradeline Accounts",
+  "stage": "tradeline",
+  "rand": "tradeline",
+  "counts": (tradeline_counts, "tradelines"),
+  "id": ("account_id", "A", "account"),
+  "total": "accounts",
+  "schema": tradeline_schema,
+  "columns": [
+    ("account_type", "choice", acct_type_prob),
+    ("creditor", "choice", mkt_share),
+    ("account_owner", "choice", owner_prob),
+    #Int_Rate: mean and standard deviation by account type, in acct_type order
+    ("int_rate", "normal", [0.09,0.06,0.08], [0.0036,.0009,0.0016], "account_type"),
+    ("report_date", "fixed_date", "2004-05-31"),
+    #Current delinquency status, as account_delq draws it, and the worst one in the last 12 months
+    ("current_delq", "choice", curr_status_prob),
+    ("worst_dlq", "dependent", "current_delq", worst_dlq_prob),
+    ("credit_limit", account_terms),
+  ],
+  "agg": tl_agg_spec,
+  "agg_table": "agg_tl", #written with the component scores
+  "agg_scores": True,
+  "score_bands": tl_score_bands,
+  "weights": tl_weights,
+  "risk_score": "tl_risk_score",
+  "leaf": "tl",
+  "leaf_weight": 0.3,
+  "fill": 0.5, #customers without tradelines take the median score
+}
+
+############################# Tradeline snapshots ######################################
+
+# Monthly account history: with snapshot_months set, each account gets a row for every month end it was open in the
+# snapshot_months months before the cohort's applications (up to June 2014 for the first cohort); closed accounts
+# drop out after the last month end before they close. An account's last row holds its values in the tradeline table,
+# or for an account closed before the report the ones it had when it closed, and its history is drawn back from there
+# a month at a time, for all accounts together, with delq_transitions reversed in time: read forward, the months
+# follow delq_transitions and end in the state the tradeline table reports. Utilization walks back the same way by
+# steps of util_drift, and balances are utilization times the credit limit, for revolving accounts only.
+# States are int8 codes; a shard holds an accounts x months matrix of states and one of utilizations.
+
+snapshot_months = 0 #0 turns snapshots off
+
+#Monthly delinquency transitions, from a month's state (row) to the next month's (column), in curr_status order;
+#in the long run they keep about the shares of curr_status_prob in each state
+delq_transitions = [
+  [0.94,0.06,0,0],
+  [0.40,0.25,0.35,0],
+  [0.20,0.10,0.50,0.20],
+  [0.15,0,0.10,0.75],
+]
+
+#Monthly change of a revolving account's utilization: normal, with a mean by the month's state in curr_status order
+#(delinquent accounts run their balances up) and util_step_sd
+util_drift = [-0.01,0.02,0.03,0.04]
+util_step_sd = 0.05
+
+snapshot_schema = {
+  "CustID": None,
+  "account_id": None,
+  "snapshot_date": "datetime64[s]",
+  "delq_state": pd.CategoricalDtype(curr_status),
+  "balance": "float32",
+  "utilization": "float32",
+}
+
+#rand: the tradeline table's draws, see shard_rands; rows come out by account in tradeline order, oldest month first
+def simulate_snapshots(tradeline, rand, months, cohort=first_cohort):
+  nAcc = len(tradeline)
+  last_month = (np.datetime64('2014-07-01','D') + cohort_shift(cohort)).astype('datetime64[M]') - 1
+  closed = tradeline["closed_date"].to_numpy().astype('datetime64[D]')
+  end_month = np.where(np.isnat(closed), last_month, closed.astype('datetime64[M]') - 1)
+  first_month = np.maximum(tradeline["open_date"].to_numpy().astype('datetime64[M]'), last_month - (months-1))
+  nMonths = np.maximum((end_month - first_month).astype('int64') + 1, 0)
+  steps = max(int(nMonths.max()) if nAcc else 0, 1)
+
+  #Column s holds the state s months before the account's last month: P reversed in time is pi_j P[j,i] from i to j
+  reverse = np.asarray(delq_transitions).T * np.asarray(curr_status_prob)[None, :]
+  states = markov_paths(account_delq(rand), reverse, steps, rand, "snapshot delq")
+  util = np.empty((nAcc, steps))
+  util[:, 0] = account_utilization(rand)
+  drift = np.asarray(util_drift)
+  for s in range(1, steps):
+    #Take back the step into the month after, whose state sets its mean
+    util[:, s] = np.clip(util[:, s-1] - normal(rand, "snapshot utilization %d" % s, drift[states[:, s-1]], util_step_sd), 0, 0.95)
+
+  acc = np.repeat(np.arange(nAcc), nMonths)
+  back = np.repeat(nMonths-1, nMonths) - child_numbers(nMonths)
+  snapshots = pd.DataFrame({"CustID": tradeline["CustID"].to_numpy()[acc], "account_id": tradeline["account_id"].to_numpy()[acc]})
+  snapshots["snapshot_date"] = (end_month[acc] - back + 1).astype('datetime64[D]') - 1
+  snapshots["delq_state"] = pd.Categorical.from_codes(states[acc, back], dtype=snapshot_schema["delq_state"])
+  is_rev = (tradeline["account_type"]=="revolving").to_numpy()[acc]
+  utilization = np.where(is_rev, util[acc, back], np.nan).astype('float32')
+  snapshots["balance"] = (account_limits(rand)[acc]*utilization).astype('float32')
+  snapshots["utilization"] = utilization
+  return conform(snapshots, snapshot_schema)
+
+#Inquiries per customer, as for tradelines
+inquiry_counts = {"dist": "poisson", "mean": 3}
+
+#InquiryType
+inq_type = ["revolving","instalment","mortgage","rental_application"]
+inq_type_prob = [0.65,0.1,0.1,0.15]
+
+#ApplicationStatus
+app_status = ["approved","denied"]
+app_status_prob = [0.8,0.2]
+
+inq_schema = {
+  "CustID": None,
+  "inquiry_id": None,
+  "inquiry_date": "datetime64[s]",
+  "inquiry_type": pd.CategoricalDtype(inq_type),
+  "report_date": "datetime64[s]",
+  "application_decision": pd.CategoricalDtype(app_status),
+}
+
+#Inquiry aggregates
+inq_agg_spec = [
+  ("num_inquiries","inquiry_id","count"),
+  ("inq_type_mostfreq","inquiry_type","mode"),
+  ("inq_type_numunique","inquiry_type","nunique"),
+  ("application_decision_mostfreq","application_decision","mode"),
+  ("application_decision_numunique","application_decision","nunique"),
+]
+
+#Inquiry score bands
+#Customers whose inquiries are all of one type match no inq_type_numunique band and keep a missing score,
+#which main() later fills along with customers that have no inquiries
+inq_score_bands = {
+  "num_inq_score": ("num_inquiries", [(1,(0,3)), (2,(0,5)), (4,(1,6)), (5,(0,4)), (np.inf,(3,8))]),
+  "appdec_mf_score": ("application_decision_mostfreq", {"approved":(0,5)}, (3,8)),
+  "inq_type_numunique_score": ("inq_type_numunique", [(1,(0,4)), (2,None), (4,(2,7)), (np.inf,(5,9))]),
+  "application_decision_numunique_score": ("application_decision_numunique", [(1,(0,4)), (2,(0,5)), (np.inf,(3,7))]),
+  "inq_type_mostfreq_score": ("inq_type_mostfreq", {"revolving":(3,8), "instalment":(1,5), "mortgage":(2,7), "rental_application":(0,4)}, (2,5)),
+}
+
+#final score, weights for each aggregated feature
+inq_weights = {
+  "num_inq_score":0.3, #b1
+  "inq_type_mostfreq_score":0.25, #b2
+  "inq_type_numunique_score":0.1, #b3
+  "appdec_mf_score":0.3, #b4
+  "application_decision_numunique_score":0.05, #b5
+}
+
+inq_spec = {
+  "name": "Bureau Inquiries",
+  "stage": "inq",
+  "rand": "inquiry",
+  "counts": (inquiry_counts, "inquiries"),
+  "id": ("inquiry_id", "Inq_", "inquiry"),
+  "total": "inquiries",
+  "schema": inq_schema,
+  "columns": [
+    #Date of inquiry, in the 4 months before the application
+    ("inquiry_date", "days_before", "app_date", 0, 120),
+    ("inquiry_type", "choice", inq_type_prob),
+    ("report_date", "fixed_date", "2014-05-31"),
+    ("application_decision", "choice", app_status_prob),
+  ],
+  "agg": inq_agg_spec,
+  "agg_table": "inq_agg", #written with its index, without the component scores
+  "agg_scores": False,
+  "agg_index": True,
+  "score_bands": inq_score_bands,
+  "weights": inq_weights,
+  "risk_score": "inq_risk_score",
+  "leaf": "inq",
+  "leaf_weight": 0.1,
+  "fill": 0.1, #customers without inquiries take the 10th percentile
+}
+
+############################# Public Records ######################################
+
+#Bankruptcies, judgments and liens per customer: most applicants have none
+public_record_counts = {"dist": "zero_inflated_poisson", "mean": 1.2, "zero_prob": 0.88}
+
+#RecordType
+pr_type = ["bankruptcy","civil_judgment","tax_lien"]
+pr_type_prob = [0.3,0.45,0.25]
+
+#Status given the record type
+pr_status = ["discharged","dismissed","satisfied","unsatisfied","released"]
+pr_status_prob = {
+  "bankruptcy": [0.8,0.2,0,0,0],
+  "civil_judgment": [0,0,0.55,0.45,0],
+  "tax_lien": [0,0,0,0.4,0.6],
+}
+
+pr_schema = {
+  "CustID": None,
+  "record_id": None,
+  "record_type": pd.CategoricalDtype(pr_type),
+  "status": pd.CategoricalDtype(pr_status),
+  "filing_date": "datetime64[s]",
+  "amount": "int32",
+  "report_date": "datetime64[s]",
+}
+
+pr_agg_spec = [
+  ("num_public_records","record_id","count"),
+  ("pr_type_mostfreq","record_type","mode"),
+  ("pr_type_numunique","record_type","nunique"),
+  ("pr_status_mostfreq","status","mode"),
+  ("pr_amount_avg","amount","mean"),
+]
+
+pr_score_bands = {
+  "num_pr_score": ("num_public_records", [(2,(3,6)), (3,(5,8)), (np.inf,(7,10))]),
+  "pr_type_mostfreq_score": ("pr_type_mostfreq", {"bankruptcy":(6,10), "civil_judgment":(3,7), "tax_lien":(2,6)}),
+  "pr_status_mostfreq_score": ("pr_status_mostfreq", {"unsatisfied":(5,9), "dismissed":(4,8), "discharged":(2,6), "satisfied":(0,4), "released":(0,3)}),
+  "pr_amount_avg_score": ("pr_amount_avg", [(5000,(0,4)), (20000,(2,6)), (np.inf,(4,9))]),
+}
+
+pr_weights = {
+  "num_pr_score":0.3,
+  "pr_type_mostfreq_score":0.3,
+  "pr_status_mostfreq_score":0.25,
+  "pr_amount_avg_score":0.15,
+}
+
+public_record_spec = {
+  "name": "Bureau Public Records",
+  "stage": "public_records",
+  "rand": "public_record",
+  "counts": (public_record_counts, "public_records"),
+  "id": ("record_id", "PR_", "public_record"),
+  "total": "public_records",
+  "schema": pr_schema,
+  "columns": [
+    ("record_type", "choice", pr_type_prob),
+    ("status", "dependent", "record_type", pr_status_prob),
+    #Filed in the 10 years before the application
+    ("filing_date", "days_before", "app_date", 30, 3650),
+    ("amount", "gamma", 1.3, 8000, -2),
+    ("report_date", "fixed_date", "2014-05-31"),
+  ],
+  "agg": pr_agg_spec,
+  "agg_table": None,
+  "score_bands": pr_score_bands,
+  "weights": pr_weights,
+  "risk_score": "pr_risk_score",
+  "leaf": "pr",
+  "leaf_weight": 0.2,
+  "fill": 0.0, #customers without public records take the lowest score
+}
+
+############################# Collections ######################################
+
+#Debts placed with collection agencies per customer
+collection_counts = {"dist": "zero_inflated_poisson", "mean": 1.5, "zero_prob": 0.75}
+
+#CreditorType
+coll_creditor_type = ["medical","utility","telecom","retail","bank"]
+coll_creditor_type_prob = [0.4,0.15,0.2,0.1,0.15]
+
+#CollectionStatus
+coll_status = ["paid","unpaid","settled"]
+coll_status_prob = [0.25,0.6,0.15]
+
+coll_schema = {
+  "CustID": None,
+  "collection_id": None,
+  "creditor_type": pd.CategoricalDtype(coll_creditor_type),
+  "status": pd.CategoricalDtype(coll_status),
+  "placed_date": "datetime64[s]",
+  "amount": "int32",
+  "report_date": "datetime64[s]",
+}
+
+coll_agg_spec = [
+  ("num_collections","collection_id","count"),
+  ("coll_amount_total","amount","sum"),
+  ("coll_status_mostfreq","status","mode"),
+  ("coll_creditor_type_numunique","creditor_type","nunique"),
+]
+
+coll_score_bands = {
+  "num_coll_score": ("num_collections", [(2,(2,5)), (4,(4,8)), (np.inf,(6,10))]),
+  "coll_amount_total_score": ("coll_amount_total", [(500,(0,3)), (2000,(2,6)), (np.inf,(5,9))]),
+  "coll_status_mostfreq_score": ("coll_status_mostfreq", {"paid":(0,3), "settled":(2,5), "unpaid":(5,9)}),
+  "coll_creditor_type_numunique_score": ("coll_creditor_type_numunique", [(2,(1,4)), (np.inf,(3,7))]),
+}
+
+coll_weights = {
+  "num_coll_score":0.35,
+  "coll_amount_total_score":0.25,
+  "coll_status_mostfreq_score":0.3,
+  "coll_creditor_type_numunique_score":0.1,
+}
+
+collection_spec = {
+  "name": "Bureau Collections",
+  "stage": "collections",
+  "rand": "collection",
+  "counts": (collection_counts, "collections"),
+  "id": ("collection_id", "Col_", "collection"),
+  "total": "collections",
+  "schema": coll_schema,
+  "columns": [
+    ("creditor_type", "choice", coll_creditor_type_prob),
+    ("status", "choice", coll_status_prob),
+    #Placed in the 7 years before the application
+    ("placed_date", "days_before", "app_date", 30, 2555),
+    ("amount", "gamma", 1.1, 600, -1),
+    ("report_date", "fixed_date", "2014-05-31"),
+  ],
+  "agg": coll_agg_spec,
+  "agg_table": None,
+  "score_bands": coll_score_bands,
+  "weights": coll_weights,
+  "risk_score": "coll_risk_score",
+  "leaf": "coll",
+  "leaf_weight": 0.1,
+  "fill": 0.0, #customers without collections take the lowest score
+}
+
+############################# Table specs ######################################
+
+# Every table is a spec run through the same two functions: simulate_table draws its rows and agg_table rolls a
+# child table up to one row per customer, so a new table is configuration. A spec holds
+#   name, stage, rand:  the output table, the stage names simulate_<stage> and agg_<stage>, the name its draws are keyed by
+#   schema, columns:    column dtypes in output order, and the generators drawing them, see sim_engine.table_columns
+#   score_bands, weights, risk_score: the banded component scores (see sim_engine.band_scores) and their weighted total
+#   leaf, leaf_weight:  the risk score's name in scenarios and its weight in the final score, see Target variable
+# and child tables, one row per account, inquiry, ... of a customer of the first table, also
+#   counts:             (count distribution, draw name), see sim_engine.draw_counts
+#   id, total:          (ID column, prefix, kind of ID), and the corpus entry counting the rows written so far
+#   agg:                aggregates per customer (see sim_engine.group_agg), whose bands score the customer
+#   agg_table:          the aggregates' output table, None to keep them in the latent store only;
+#                       agg_scores keeps the component scores in it, agg_index writes its index
+#   fill:               quantile of the scaled risk score taken by customers without rows
+# The first spec is the customer level table; its columns may use context["cohort"], the application window.
+# Child rows come out grouped by customer in customers order and may read the customer's row, see days_before.
+
+table_specs = [loans_spec, tradeline_spec, inq_spec, public_record_spec, collection_spec]
+child_specs = table_specs[1:]
+#Unique per row, so the writers keep them as plain strings and validation does not count their values
+id_columns = ["CustID"]+[spec["id"][0] for spec in child_specs]
+
+#counts and ids: rows per customer and the child IDs, in customers order, for child tables only
+#rand draws a row per table row; dates are the first cohort's moved by cohort_shift
+def simulate_table(spec, customers, rand, cohort=first_cohort, parent=None, ids=None, counts=None):
+  context = {"shift": cohort_shift(cohort), "cohort": cohort}
+  if parent is None:
+    frame = pd.DataFrame({"CustID": customers})
+  else:
+    owner = np.repeat(np.arange(len(customers)), counts)
+    frame = pd.DataFrame({"CustID": customers[owner]})
+    column, prefix, kind = spec["id"]
+    frame[column] = [prefix+str(s) for s in ids]
+    context.update(parent=parent, owner=owner)
+  frame = table_columns(frame, spec["columns"], spec["schema"], rand, context)
+  if parent is None:
+    scores = band_scores(frame, spec["score_bands"], rand)
+    frame[spec["risk_score"]] = weighted_score(scores, spec["weights"])
+    frame = pd.concat([frame, scores], axis=1)
+  #Latent scores stay after the schema's columns
+  return conform(frame[list(spec["schema"]) + [col for col in frame.columns if col not in spec["schema"]]], spec["schema"])
+
+#rand draws a row per customer with rows in the table
+def agg_table(spec, rows, rand):
+  agg = group_agg(rows, "CustID", spec["agg"])
+  scores = band_scores(agg, spec["score_bands"], rand)
+  agg = pd.concat([agg, scores], axis=1)
+  agg[spec["risk_score"]] = weighted_score(scores, spec["weights"])
+  return agg
+
+############################# Stage cache ######################################
+
+# With a cache (see sim_cache) each simulation stage is looked up by a key made from its code and that of the module
+# functions it and the generators of its spec call, the configuration below, the keys of its inputs and the key of the
+# table it draws for. Tuning the target only touches code that runs after these stages, so such runs load every stage
+# from the cache instead of simulating it again.
+#Scenario and target settings of the specs only come into play after the stages
+agg_keys = ["agg","agg_table","agg_scores","agg_index","score_bands","weights","risk_score"]
+stage_config = {
+  "simulate_snapshots": [curr_status, curr_status_prob, delq_transitions, util_drift, util_step_sd, snapshot_schema],
+}
+for spec in table_specs:
+  aggregated = "agg" in spec
+  stage_config["simulate_"+spec["stage"]] = {k: v for k, v in spec.items() if k not in ["leaf","leaf_weight","fill"]+agg_keys*aggregated}
+  if aggregated:
+    stage_config["agg_"+spec["stage"]] = {k: spec[k] for k in agg_keys if k in spec}
+engine_source = inspect.getsource(sim_engine)
+
+#Functions of this module that fns call, directly or through each other (nested functions and lambdas included),
+#so that editing a helper such as sim_date misses the cache of every stage that reaches it
+def called_functions(fns):
+  found, todo = [], list(fns)
+  while todo:
+    fn = todo.pop()
+    if fn in found:
+      continue
+    found.append(fn)
+    codes = [fn.__code__]
+    while codes:
+      code = codes.pop()
+      codes += [c for c in code.co_consts if inspect.iscode(c)]
+      todo += [f for f in (fn.__globals__.get(name) for name in code.co_names) if inspect.isfunction(f) and f.__module__==fn.__module__]
+  return sorted(found, key=lambda f: f.__name__)
+
+#Functions held in a stage's configuration, such as the callable column generators of a spec
+def config_functions(config):
+  if inspect.isfunction(config):
+    return [config]
+  if isinstance(config, dict):
+    config = list(config.values())
+  return [f for part in config for f in config_functions(part)] if isinstance(config, (list, tuple)) else []
+
+#Runs fn as a stage through the cache; returns its result and its key, which stages reading the result build on
+#The rows rand draws for follow from the inputs, so its key is all the key needs of it
+def run_cached_stage(report, cache, name, inputs, rand, rows_in, fn, *args):
+  code = [inspect.getsource(f) for f in called_functions([fn]+config_functions(stage_config[name]))]
+  key = fingerprint(name, code, engine_source, stage_config[name], inputs, rand["key"])
+  with stage(report, name, rows_in) as record:
+    result, record["cache"] = cached_call(cache, key, fn, *args)
+    record["rows_out"] = len(result)
+  return result, key
+
+#Every component score and the leaf risk scores, see sim_engine.new_store
+latent_factors = [name for spec in table_specs for name in spec["weights"]]+[spec["risk_score"] for spec in table_specs]
+
+#aggs: the aggregates of each child table, a row per customer with rows in it, in customer order
+def latent_store(customers, counts, loans, aggs):
+  store = new_store(customers, latent_factors)
+  store_put(store, np.arange(len(customers)), loans)
+  for c, agg in zip(counts, aggs):
+    store_put(store, np.flatnonzero(c), agg)
+  return store
+
+#child_ids and counts: the IDs and rows per customer of each child table; rands: the keyed draws of each table, see shard_rands
+#cohort: the customers' application window, see first_cohort; ids_key identifies the customers, their ordinals, IDs and counts
+#finished(name, frame, key) is handed each child table as soon as it is simulated, with its cache key
+#months: months of tradeline snapshots, none when 0
+#Returns the loans, the aggregate tables to write by name and the latent store
+def simulate_chunk(customers, child_ids, counts, rands, cohort, report, finished, cache=None, ids_key=None, months=0):
+  nCust = len(customers)
+  loans, loans_key = run_cached_stage(report, cache, "simulate_"+loans_spec["stage"], [ids_key, cohort], rands[loans_spec["rand"]], nCust,
+    simulate_table, loans_spec, customers, rands[loans_spec["rand"]], cohort)
+  aggs = []
+  written = {}
+  for spec, ids, c in zip(child_specs, child_ids, counts):
+    rand, agg_rand = rands[spec["rand"]], rands["agg_"+spec["stage"]]
+    rows, rows_key = run_cached_stage(report, cache, "simulate_"+spec["stage"], [ids_key, loans_key, cohort], rand, nCust,
+      simulate_table, spec, customers, rand, cohort, loans, ids, c)
+    finished(spec["name"], rows, rows_key)
+    if months and spec is tradeline_spec:
+      snapshots, snapshots_key = run_cached_stage(report, cache, "simulate_snapshots", [rows_key, cohort, months], rand,
+        len(rows), simulate_snapshots, rows, rand, months, cohort)
+      finished("Bureau Tradeline Snapshots", snapshots, snapshots_key)
+      del snapshots #the writer holds it until it is written
+    agg, agg_key = run_cached_stage(report, cache, "agg_"+spec["stage"], [rows_key], agg_rand, len(rows), agg_table, spec, rows, agg_rand)
+    aggs.append(agg)
+    if spec["agg_table"] is not None:
+      written[spec["agg_table"]] = agg if spec["agg_scores"] else agg.drop(list(spec["weights"]), axis=1)
+
+  with stage(report, "latent_store", nCust) as record:
+    store = latent_store(customers, counts, loans, aggs)
+    #Drop latent factors, the store holds them from here on
+    loans = loans[list(loans_schema)]
+    record["rows_out"] = nCust
+  return loans, written, store
+
+############################# Target variable ######################################
+
+#Combine all leaf risk scores, each with its spec's leaf_weight
+bad_rate = 0.1 #top 10% will have is_bad=1
+
+# Leaf scores are min/max scaled over the whole population and the target is cut at a population quantile,
+# so the target is built in passes over the simulated chunks: score ranges are merged while simulating,
+# then the fill values for missing leaf scores and the cutoff are found with chunked_quantile.
+leaf_scores = [spec["risk_score"] for spec in table_specs]
+
+#Leaf scores of a shard's customers, in customer order
+def leaf_frame(store):
+  return pd.DataFrame(store_get(store, leaf_scores), columns=leaf_scores)
+
+def score_ranges(leaves):
+  return {col: (leaves[col].min(), leaves[col].max()) for col in leaf_scores}
+
+def merge_ranges(a, b):
+  return {col: (np.fmin(a[col][0],b[col][0]), np.fmax(a[col][1],b[col][1])) for col in a}
+
+def scale_scores(frame, ranges):
+  scaled = {col: (frame[col]-lo)/(hi-lo) for col, (lo, hi) in ranges.items() if col in frame}
+  return frame.assign(**scaled)
+
+def final_score(leaves, fills):
+  #Customers without rows in a child table have no risk score of it
+  leaves = leaves.fillna(fills)
+  return sum(spec["leaf_weight"]*leaves[spec["risk_score"]] for spec in table_specs)
+
+#fills for missing leaf scores and the is_bad cutoff, from the scaled leaf scores of every shard
+def target_cutoffs(scaled_leaves):
+  fills = {spec["risk_score"]: chunked_quantile(lambda: (leaves[spec["risk_score"]] for leaves in scaled_leaves()), spec["fill"], 0, 1)
+    for spec in child_specs}
+  thresh = chunked_quantile(lambda: (final_score(leaves, fills) for leaves in scaled_leaves()), 1-bad_rate, 0, sum(spec["leaf_weight"] for spec in table_specs))
+  return fills, thresh
+
+#is_bad set by income, purpose and marital status regardless of the score; -1 where the score decides
+#rand draws a row per customer; a customer matching several overrides takes the last one's draw
+def target_overrides(loans, rand):
+  income = loans["annual_income"].to_numpy()
+  purpose = loans["loan_purpose"]
+  marital = loans["marital_status"]
+  is_bad = np.full(len(loans), -1, dtype='int8')
+  overrides = [
+    ((income>104000) & (income<114000), [0.94,0.06]),
+    ((income>115000) & (income<125000), [0.96,0.04]),
+    ((income>125000) & (income<135000), [0.98,0.02]),
+    (income>135000, [0.99,0.01]),
+    ((purpose=="business").to_numpy(), [0.85,0.15]),
+    ((purpose=="education").to_numpy(), [0.95,0.05]),
+    ((marital=="widowed").to_numpy(), [0.93,0.07]),
+    ((marital=="divorced").to_numpy(), [0.88,0.12]),
+  ]
+  for i, (mask, p) in enumerate(overrides):
+    is_bad[mask] = choice(rand,"override %d" % i,p)[mask]
+  return is_bad
+
+#final: final scores in loans order
+def assign_target(loans, final, thresh, overrides):
+  is_bad = (np.asarray(final)>thresh).astype('int8')
+  loans["is_bad"] = np.where(overrides>=0, overrides, is_bad)
+  return loans
 
-    #app_dec_mostfreq
-    if inq["application_decision_mostfreq"]=="approved":
-      dict_inq["appdec_mf_score"] = random.uniform(0,5)
-    else:
-      dict_inq["appdec_mf_score"] = random.uniform(3,8)
-
-    #Inq type num unique
-    if inq["inq_type_numunique"]==None or inq["inq_type_numunique"]==0:
-      dict_inq["inq_type_numunique_score"] = random.uniform(0,4)
-    elif 1<inq["inq_type_numunique"]<4:
-      dict_inq["inq_type_numunique_score"] = random.uniform(2,7)
-    elif inq["inq_type_numunique"]>=4:
-      dict_inq["inq_type_numunique_score"] = random.uniform(5,9)
-
-    #App decision num unique
-    if inq["application_decision_numunique"]==None or inq["application_decision_numunique"]==0:
-      dict_inq["application_decision_numunique_score"] = random.uniform(0,4)
-    elif inq["application_decision_numunique"]==1:
-      dict_inq["application_decision_numunique_score"] = random.uniform(0,5)
-    else:
-      dict_inq["application_decision_numunique_score"] = random.uniform(3,7)
-
-    #inq_type_mostfreq
-    if inq["inq_type_mostfreq"]=="revolving":
-      dict_inq["inq_type_mostfreq_score"] = random.uniform(3,8)
-    elif inq["inq_type_mostfreq"]=="instalment":
-      dict_inq["inq_type_mostfreq_score"] = random.uniform(1,5)
-    elif inq["inq_type_mostfreq"]=="mortgage":
-      dict_inq["inq_type_mostfreq_score"] = random.uniform(2,7)
-    elif inq["inq_type_mostfreq"]=="rental_application":
-      dict_inq["inq_type_mostfreq_score"] = random.uniform(0,4)
+############################# Scenario sweeps ######################################
+
+# A sweep labels the same simulated customers under several weightings: the component weights of each table spec,
+# e.g. the application (a1-a4), tradeline (t1-t8) and inquiry (b1-b5) ones, the leaf weights and the bad rate. Every
+# scenario's leaf scores are one product of the customers' component score matrix with a weight matrix holding a column
+# per leaf and scenario,
+# then they are scaled, filled and cut like the main target; the income, purpose and marital overrides are drawn
+# once and apply to every scenario. Missing components only blank the leaf scores that give them weight.
+
+component_weights = {spec["leaf"]: spec["weights"] for spec in table_specs}
+component_scores = [name for weights in component_weights.values() for name in weights]
+leaves = list(component_weights)
+
+#scenarios: list of dicts with a name and any of <leaf>_weights (partial dicts are fine) and <leaf>_wt for the leaves
+#above, e.g. app_weights and tl_wt, and bad_rate; what a scenario leaves out keeps the value in the table specs
+def load_scenarios(path):
+  with open(path) as f:
+    scenarios = json.load(f)
+  names = [s.get("name") for s in scenarios]
+  if None in names or len(set(names))<len(names):
+    raise ValueError("Every scenario needs a unique name")
+  for s in scenarios:
+    unknown = set(s)-{"name","bad_rate"}-{leaf+"_weights" for leaf in leaves}-{leaf+"_wt" for leaf in leaves}
+    for leaf, weights in component_weights.items():
+      unknown |= {leaf+"_weights."+w for w in s.get(leaf+"_weights", {}) if w not in weights}
+    if unknown:
+      raise ValueError("Unknown settings in scenario %s: %s" % (s["name"], ", ".join(sorted(unknown))))
+  return scenarios
+
+#sweep: everything the shards need to label the scenarios; ranges, fills and thresh are filled in as the run finds them
+def new_sweep(scenarios):
+  W = np.zeros((len(component_scores), len(leaves)*len(scenarios)))
+  for i, s in enumerate(scenarios):
+    for j, leaf in enumerate(leaves):
+      weights = dict(component_weights[leaf], **s.get(leaf+"_weights", {}))
+      W[:, i*len(leaves)+j] = [weights.get(name, 0.0) for name in component_scores]
+  return {
+    "names": [s["name"] for s in scenarios],
+    "W": W,
+    "leaf_weights": np.array([[s.get(spec["leaf"]+"_wt", spec["leaf_weight"]) for spec in table_specs] for s in scenarios]),
+    "bad_rate": np.array([s.get("bad_rate", bad_rate) for s in scenarios]),
+    "ranges": None, "fills": None, "thresh": None,
+  }
+
+#Raw leaf scores, customers x (scenario, leaf); customers without rows in a child table have missing components
+def scenario_leaves(store, sweep):
+  C = store_get(store, component_scores)
+  missing = np.isnan(C)
+  scores = np.where(missing, 0.0, C) @ sweep["W"]
+  scores[(missing.astype('float64') @ (sweep["W"]!=0)) > 0] = np.nan
+  return scores
+
+def scale_leaves(scores, sweep):
+  lo, hi = sweep["ranges"]
+  return (scores-lo)/(hi-lo)
+
+#Final scores, customers x scenarios; missing child table scores take the fills
+def scenario_final(scaled, sweep):
+  filled = np.where(np.isnan(scaled), sweep["fills"], scaled)
+  return (filled.reshape(len(scaled), -1, len(leaves)) * sweep["leaf_weights"]).sum(axis=2)
+
+#Leaf columns of every scenario: child table leaves are filled with their spec's fill quantile as in target_cutoffs
+def sweep_cutoffs(scaled_leaves, sweep):
+  nScenarios = len(sweep["names"])
+  fills = np.zeros((nScenarios, len(leaves)))
+  for j, spec in enumerate(child_specs, 1):
+    fills[:, j] = chunked_quantile(lambda: (x[:, j::len(leaves)] for x in scaled_leaves()), spec["fill"], 0, 1)
+  sweep = dict(sweep, fills=fills.ravel())
+  thresh = chunked_quantile(lambda: (scenario_final(x, sweep) for x in scaled_leaves()), 1-sweep["bad_rate"], 0, sweep["leaf_weights"].sum(axis=1))
+  return dict(sweep, thresh=thresh)
+
+def scenario_labels(loans, scores, sweep, overrides):
+  final = scenario_final(scale_leaves(scores, sweep), sweep)
+  is_bad = np.where(overrides[:, None]>=0, overrides[:, None], final>sweep["thresh"]).astype('int8')
+  labels = pd.DataFrame(is_bad, columns=["is_bad_"+name for name in sweep["names"]])
+  labels.insert(0, "CustID", loans["CustID"].to_numpy())
+  return labels
+
+############################# Validation ######################################
+
+# With validate set, a run summarizes every table as its shards write it and checks the merged summaries against
+# validation_checks (see sim_validate); validation.json holds the results and each column's missing share.
+# validate_output.py checks output already on disk the same way, streaming it in chunks.
+# Shares are of the non-missing values, so current_delq, which closed accounts lack, is checked over open accounts.
+
+income_quantiles = [0.05,0.1,0.25,0.5,0.75,0.9,0.95]
+
+#annual_income is 1000 for the 0.5% of applicants without one, and otherwise gamma(1.7)*30000 rounded to 100
+def income_cdf():
+  return {float(gammaincinv(1.7, (q-0.005)/0.995)*3*10000): q for q in income_quantiles}
+
+#(table, column, kind, expected, tolerance), see sim_validate.check_summary
+validation_checks = [
+  ("Loan Applications", "is_bad", "mean", bad_rate, 0.01), #the overrides move it a little off the cutoff's rate
+  ("Loan Applications", "annual_income", "cdf", income_cdf(), 0.01),
+  ("Loan Applications", "loan_purpose", "shares", dict(zip(purpose_list, purpose_prob)), 0.01),
+  ("Bureau Tradeline Accounts", "account_type", "shares", dict(zip(acct_type, acct_type_prob)), 0.01),
+  ("Bureau Tradeline Accounts", "creditor", "shares", dict(zip(list_banks, mkt_share)), 0.01),
+  ("Bureau Tradeline Accounts", "account_owner", "shares", dict(zip(owner_list, owner_prob)), 0.01),
+  ("Bureau Tradeline Accounts", "current_delq", "shares", dict(zip(curr_status, curr_status_prob)), 0.01),
+  ("Bureau Inquiries", "inquiry_type", "shares", dict(zip(inq_type, inq_type_prob)), 0.01),
+  ("Bureau Inquiries", "application_decision", "shares", dict(zip(app_status, app_status_prob)), 0.01),
+  ("Bureau Public Records", "record_type", "shares", dict(zip(pr_type, pr_type_prob)), 0.01),
+  ("Bureau Collections", "creditor_type", "shares", dict(zip(coll_creditor_type, coll_creditor_type_prob)), 0.01),
+  ("Bureau Collections", "status", "shares", dict(zip(coll_status, coll_status_prob)), 0.01),
+]
+
+############################# Shards ######################################
+
+# Applicants are simulated in fixed-size shards of consecutive customer ordinals. Every draw is keyed by customer
+# ordinal (see sim_engine.keyed_rand), so a customer's rows depend on the seed alone, not on the shard size or on
+# how many worker processes run the shards; only the order of customers within the output files follows the shards.
+# A shard writes its child tables and pickles its loans, its customer aggregates, its latent store and its customer ordinals,
+# which are kept until the target is known; only the score ranges travel back to the parent process.
+# The passes over the population for the cutoffs read each shard's leaf scores, saved on their own.
+# Once the cutoffs are known each shard writes its part of the remaining tables, see sim_output for the file layout.
+# A scenario sweep adds the scenario_labels table: CustID and one is_bad_<scenario> column per scenario,
+# and snapshot months the Bureau Tradeline Snapshots table.
+
+tables = [spec["name"] for spec in table_specs]+[spec["agg_table"] for spec in child_specs if spec["agg_table"] is not None]
+
+#ID width and key per kind of ID, shared by all shards so that they never hand out the same ID
+#totals: the number of rows of each child table
+def id_keys(nRows, totals, min_id_width, id_seq):
+  customer_seq, *child_seqs = id_seq.spawn(1+len(child_specs))
+  keys = {"customer": (id_width(nRows, min_id_width), id_key(customer_seq))}
+  for spec, total, seq in zip(child_specs, totals, child_seqs):
+    keys[spec["id"][2]] = (id_width(total, min_id_width), id_key(seq))
+  return keys
+
+#Rows of each child table per customer, for customer ordinals start..end-1
+def shard_counts(start, end, run_key):
+  rand = keyed_rand(run_key, "counts", np.arange(start, end))
+  return tuple(draw_counts(spec["counts"][0], rand, spec["counts"][1]) for spec in child_specs)
+
+#Rows of each child table in each shard of chunk_size customers from ordinal first to nRows-1, shards x tables.
+#The parent needs only these totals, so it draws the counts a shard at a time and keeps none of them.
+def shard_totals(first, nRows, chunk_size, run_key):
+  totals = np.zeros((len(range(first, nRows, chunk_size)), len(child_specs)), dtype='int64')
+  for i, start in enumerate(range(first, nRows, chunk_size)):
+    totals[i] = [c.sum() for c in shard_counts(start, min(start+chunk_size, nRows), run_key)]
+  return totals
+
+#ID keys for nRows customers, the key every draw is made from, and the child table rows of each shard of chunk_size
+#customers from ordinal first on, see shard_totals; prior: the numbers of rows of each child table of the customers before first
+def run_keys(nRows, min_id_width, first=0, prior=None, chunk_size=None):
+  id_seq, draw_seq = np.random.SeedSequence(mySeed).spawn(2)
+  run_key = draw_seq.generate_state(1, dtype=np.uint64)[0]
+  totals = shard_totals(first, nRows, chunk_size or max(nRows-first, 1), run_key)
+  return id_keys(nRows, (prior or [0]*len(child_specs)) + totals.sum(axis=0), min_id_width, id_seq), run_key, totals
+
+#Customer ordinals start..end-1 with their counts, in ordinal order. Child rows are numbered in customer
+#ordinal order from offsets, the numbers of rows of each child table of the customers before start.
+#Returns the CustIDs sorted, the customers' ordinals and counts in that order, and the child IDs in that order
+def shard_ids(start, end, ids, counts, offsets):
+  numbers = allocate_ids(np.arange(start, end), *ids["customer"])
+  order = np.argsort(numbers) #all IDs have the same number of digits, so they sort like the CustIDs
+  customers = np.array(["C"+str(s) for s in numbers[order]])
+  child_ids = []
+  for c, offset, spec in zip(counts, offsets, child_specs):
+    first = offset + np.cumsum(c) - c
+    child_ids.append(allocate_ids(np.repeat(first[order], c[order]) + child_numbers(c[order]), *ids[spec["id"][2]]))
+  return customers, start+order, tuple(c[order] for c in counts), child_ids
+
+#Keyed draws of each table, see sim_engine.keyed_rand: customer level rows are keyed by the customer's ordinal,
+#child rows by their customer's ordinal and their number among its children; ordinals and counts in CustID order
+def shard_rands(run_key, ordinals, counts):
+  rands = {loans_spec["rand"]: keyed_rand(run_key, loans_spec["rand"], ordinals), "target": keyed_rand(run_key, "target", ordinals)}
+  for spec, c in zip(child_specs, counts):
+    rands[spec["rand"]] = keyed_rand(run_key, spec["rand"], np.repeat(ordinals, c), child_numbers(c))
+    rands["agg_"+spec["stage"]] = keyed_rand(run_key, "agg_"+spec["stage"], ordinals[c>0])
+  return rands
+
+output_source = inspect.getsource(sim_output)
+
+#key identifies the frame's content; with a cache CSV parts are copied from it when their key is unchanged
+#With a writer the part is written in the background: the "write" stage runs in the writer, so it times and profiles
+#the writing itself, while "queue" times handing the part over, which waits when the writer is behind. A background
+#write leaves the peak memory alone (see sim_report.stage), and is done in the shard when its stage is profiled.
+#summaries: table name -> summary of the shard's rows so far, updated with frame's when validating
+def write_table(report, frame, name, index, output, csv_index=False, cache=None, key=None, writer=None, summaries=None):
+  if summaries is not None:
+    with stage(report, "summarize "+name, len(frame)):
+      summaries[name] = merge_summaries(summaries.get(name), summarize(frame, id_columns))
+  if report["profile"]=="write "+name:
+    writer = None
+  def job():
+    with stage(report, "write "+name, len(frame), reset=writer is None) as record:
+      write = lambda: write_part(frame, name, index, output, csv_index)
+      if cache is not None and key is not None and output["format"]=="csv":
+        part_key = fingerprint("write", name, index, csv_index, output_source, key)
+        record["bytes_written"], record["cache"] = cached_file(cache, part_key, shard_path(output["work_dir"], index, name+".csv"), write)
+      else:
+        record["bytes_written"] = write()
+  if writer is None:
+    job()
+  else:
+    with stage(report, "queue "+name, len(frame)):
+      submit(writer, job)
+
+def simulate_shard(task):
+  index, start, end, ids, run_key, offsets, cohort, months, output, profile, cache, sweep, validate = task
+  summaries = {} if validate else None
+  report = new_report(profile, output["work_dir"], index)
+  with stage(report, "shard_ids", end-start) as record:
+    counts = shard_counts(start, end, run_key)
+    customers, ordinals, counts, child_ids = shard_ids(start, end, ids, counts, offsets)
+    rands = shard_rands(run_key, ordinals, counts)
+    record["rows_out"] = len(customers)+sum(len(c) for c in child_ids)
+  ids_key = fingerprint("shard_ids", inspect.getsource(shard_ids), start, end, ids, offsets, counts)
+  #Child tables are written in the background while the shard goes on
+  writer = start_writer()
+  try:
+    finished = lambda name, frame, key: write_table(report, frame, name, index, output, cache=cache, key=key, writer=writer, summaries=summaries)
+    loans, aggs, store = simulate_chunk(customers, child_ids, counts, rands, cohort, report, finished, cache, ids_key, months)
+    with stage(report, "save_scores", len(loans)) as record:
+      path = shard_path(output["work_dir"], index, "scores.pkl")
+      pd.to_pickle((loans, aggs, store, ordinals), path)
+      leaves_path = shard_path(output["work_dir"], index, "leaf_scores.npy")
+      np.save(leaves_path, store_get(store, leaf_scores))
+      record["bytes_written"] = os.path.getsize(path)+os.path.getsize(leaves_path)
+    leaf_ranges = None
+    if sweep is not None:
+      with stage(report, "scenario_leaves", len(loans)) as record:
+        scores = scenario_leaves(store, sweep)
+        leaf_ranges = (np.fmin.reduce(scores, axis=0), np.fmax.reduce(scores, axis=0))
+        path = shard_path(output["work_dir"], index, "leaves.npy")
+        np.save(path, scores)
+        record["bytes_written"] = os.path.getsize(path)
+  finally:
+    stop_writer(writer)
+  agg_rows = {spec["agg_table"]: len(aggs[spec["agg_table"]]) for spec in child_specs if spec.get("agg_index")}
+  return score_ranges(leaf_frame(store)), agg_rows, report["stages"], leaf_ranges, summaries
+
+def finalize_shard(task):
+  index, ranges, fills, thresh, run_key, agg_offsets, output, profile, sweep, validate = task
+  summaries = {} if validate else None
+  report = new_report(profile, output["work_dir"], index)
+  with stage(report, "load_scores") as record:
+    loans, aggs, store, ordinals = pd.read_pickle(shard_path(output["work_dir"], index, "scores.pkl"))
+    record["rows_out"] = len(loans)
+  with stage(report, "assign_target", len(loans)) as record:
+    overrides = target_overrides(loans, keyed_rand(run_key, "target", ordinals))
+    if sweep is not None:
+      labels = scenario_labels(loans, np.load(shard_path(output["work_dir"], index, "leaves.npy")), sweep, overrides)
+    loans = assign_target(loans, final_score(scale_scores(leaf_frame(store), ranges), fills), thresh, overrides)
+    aggs = {name: scale_scores(agg, ranges) for name, agg in aggs.items()}
+    #Indexes written with the aggregates run on across shards
+    for name, offset in agg_offsets.items():
+      aggs[name].index = range(offset, offset+len(aggs[name]))
+    record["rows_out"] = len(loans)
+  write_table(report, loans, loans_spec["name"], index, output, summaries=summaries)
+  for name, agg in aggs.items():
+    write_table(report, agg, name, index, output, csv_index=name in agg_offsets, summaries=summaries)
+  if sweep is not None:
+    write_table(report, labels, "scenario_labels", index, output, summaries=summaries)
+  return report["stages"], summaries
+
+#Shards are handed out in order and their results come back in order, whatever the number of workers
+def run_shards(fn, tasks, workers):
+  if workers>1 and len(tasks)>1:
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      return list(pool.map(fn, tasks))
+  return [fn(task) for task in tasks]
+
+def load_leaves(work_dir, nShards):
+  for index in range(nShards):
+    yield pd.DataFrame(np.load(shard_path(work_dir, index, "leaf_scores.npy")), columns=leaf_scores)
+
+############################# Customer lookup ######################################
+
+# One customer's rows, the same as the full runs with the same rows, ID width and cohorts write for it, without simulating anyone else.
+# The CustID is mapped back to its ordinal through the inverse ID permutation, the customer's first row number in each
+# child table comes from the counts of the customers before it, and the stages run on a shard of that one customer.
+# is_bad needs the population's score ranges, fills and cutoff, which run_report.json keeps as "target";
+# without them the loan application comes without is_bad.
+
+#Customers per block of the lookup index
+lookup_block = 4096
+
+#What every lookup shares: ID keys, the run key, the first row number in each child table of each block of lookup_block
+#customers, the cohorts, as a run report's corpus lists them, and the months of tradeline snapshots; by default all
+#customers are in the first cohort. A lookup redraws the counts of its customer's block only, so the index stays small for any rows.
+def customer_index(nRows=10000, min_id_width=6, cohorts=None, months=0):
+  ids, run_key, totals = run_keys(nRows, min_id_width, chunk_size=lookup_block)
+  return {"rows": nRows, "ids": ids, "run_key": run_key, "first": np.cumsum(totals, axis=0) - totals,
+    "cohorts": cohorts or [dict(first_cohort, first=0, rows=nRows)], "snapshot_months": months}
+
+#Ordinal of a CustID, KeyError for IDs no customer of the run has
+def customer_ordinal(custid, index):
+  width, key = index["ids"]["customer"]
+  if len(custid)!=width+1 or custid[0]!="C" or not custid[1:].isdigit() or custid[1]=="0":
+    raise KeyError(custid)
+  ordinal = int(id_ordinals([int(custid[1:])], width, key)[0])
+  if ordinal>=index["rows"]:
+    raise KeyError(custid)
+  return ordinal
+
+#Table name -> the customer's rows; target: the "target" entry of a run's report
+def customer_records(custid, index, target=None):
+  o = customer_ordinal(custid, index)
+  block = o//lookup_block
+  start = block*lookup_block
+  block_counts = shard_counts(start, min(start+lookup_block, index["rows"]), index["run_key"])
+  offsets = [first + c[:o-start].sum() for first, c in zip(index["first"][block], block_counts)]
+  counts = tuple(c[o-start:o-start+1] for c in block_counts)
+  customers, ordinals, counts, child_ids = shard_ids(o, o+1, index["ids"], counts, offsets)
+  rands = shard_rands(index["run_key"], ordinals, counts)
+  cohort = [c for c in index["cohorts"] if c["first"]<=o][-1]
+  cohort = {"start": cohort["start"], "window": cohort["window"]}
+  records = {}
+  finished = lambda name, frame, key: records.update({name: frame})
+  loans, aggs, store = simulate_chunk(customers, child_ids, counts, rands, cohort, new_report(), finished, months=index["snapshot_months"])
+  if target is None:
+    loans = loans.drop(columns="is_bad")
+  else:
+    final = final_score(scale_scores(leaf_frame(store), target["ranges"]), target["fills"])
+    loans = assign_target(loans, final, target["thresh"], target_overrides(loans, rands["target"]))
+  return {loans_spec["name"]: loans, **records}
+
+############################# Cohorts ######################################
+
+# A run can append a cohort of applicants to the output of earlier runs instead of rebuilding it. The new customers
+# take the ordinals after the existing ones, so their draws and IDs are new, and the rows of their child tables are
+# numbered on from the existing totals. IDs keep the widths the output has: a cohort that would need wider IDs is
+# refused, so a corpus meant to grow should start with a larger --id-width. The cohort is labelled with the target
+# cutoffs, and its aggregates scaled with the score ranges, found when the output was first built, which leaves the
+# existing rows as they are and makes the cost depend on the new cohort only. The corpus, i.e. the output's totals,
+# ID widths, parts written and cohorts, is kept in each run's report for the next append.
+
+#Totals are kept per child table, see the specs' total, and per aggregate table written with its index
+corpus_totals = [spec["total"] for spec in child_specs]+[spec["agg_table"]+"_rows" for spec in child_specs if spec.get("agg_index")]
+
+def new_corpus():
+  return {"rows": 0, **{name: 0 for name in corpus_totals}, "parts": 0, "id_widths": None, "cohorts": []}
+
+#The run section of the report in out_dir, when a cohort can be appended to that output
+def load_run(out_dir):
+  path = os.path.join(out_dir, "run_report.json")
+  with open(path) as f:
+    run = json.load(f)["run"]
+  if "corpus" not in run:
+    raise ValueError(path+" has no corpus, so its output cannot be appended to")
+  if run["seed"]!=mySeed:
+    raise ValueError("%s is from a run with seed %d, this script has %d" % (path, run["seed"], mySeed))
+  missing = [name for name in corpus_totals if name not in run["corpus"]]
+  if missing:
+    raise ValueError("%s is from a run without %s, so its output lacks tables this script writes" % (path, ", ".join(missing)))
+  if run.get("scenarios"):
+    raise ValueError("Cannot append to output with scenario labels")
+  return run
+
+#By default a cohort's window follows the last one's, with the same length
+def next_cohort(corpus, start=None, window=None):
+  cohort = dict(first_cohort)
+  if corpus["cohorts"]:
+    last = corpus["cohorts"][-1]
+    cohort = {"start": str(np.datetime64(last["start"],'D') + last["window"]), "window": last["window"]}
+  return {"start": str(np.datetime64(start or cohort["start"],'D')), "window": int(window or cohort["window"])}
+
+# A run writes run_report.json next to its outputs, see sim_report; with profile set to a stage name
+# that stage runs under cProfile in every shard and the merged stats are written to profile_<stage>.prof
+# With append the run adds a cohort to the output in out_dir (see Cohorts), whose format, partitions, ID width and
+# snapshot months it keeps; app_start and app_window set the cohort's application window
+# With validate the run checks its tables against validation_checks and writes validation.json, see Validation;
+# an append checks the new cohort only
+def main(nRows=10000, chunk_size=None, out_dir=".", workers=1, min_id_width=6, fmt="csv", partitions=0, profile=None,
+  cache_dir=None, cache_mb=2048, scenarios=None, append=False, app_start=None, app_window=None, months=snapshot_months, validate=False):
+  log.info("Simulating credit bureau data...")
+  wall = time.perf_counter()
+  previous = load_run(out_dir) if append else None
+  corpus = previous["corpus"] if append else new_corpus()
+  if append:
+    if scenarios:
+      raise ValueError("Scenario sweeps cannot be appended")
+    fmt, partitions, min_id_width = previous["format"], previous["partitions"], previous["id_width"]
+    months = previous.get("snapshot_months", 0)
+  cohort = next_cohort(corpus, app_start, app_window)
+  first = corpus["rows"]
+  chunk_size = chunk_size or nRows
+  starts = list(range(first, first+nRows, chunk_size))
+  nShards = len(starts)
+
+  #Child rows are numbered in customer ordinal order, so each shard starts where the ones before it end
+  prior = [corpus[spec["total"]] for spec in child_specs]
+  ids, run_key, totals = run_keys(first+nRows, min_id_width, first, prior, chunk_size)
+  widths = {kind: width for kind, (width, key) in ids.items()}
+  if corpus["id_widths"] is not None and widths!=corpus["id_widths"]:
+    raise ValueError("The cohort needs ID widths %s, the output has %s; start the output with a larger --id-width" % (widths, corpus["id_widths"]))
+  offsets = np.cumsum(totals, axis=0) - totals + prior
+  cache = cache_config(cache_dir, cache_mb)
+  sweep = new_sweep(scenarios) if scenarios else None
+  run_tables = tables + (["scenario_labels"] if sweep else []) + (["Bureau Tradeline Snapshots"] if months else [])
+
+  work_dir = tempfile.mkdtemp(prefix="bureau_shards_", dir=out_dir)
+  try:
+    output = output_config(fmt, partitions, work_dir, out_dir, corpus["parts"], id_columns)
+    for name in run_tables:
+      prepare_table(name, output)
+
+    #Simulate each shard and collect the score ranges
+    tasks = [(i, start, min(start+chunk_size, first+nRows), ids, run_key, offsets[i], cohort, months, output, profile, cache, sweep, validate)
+      for i, start in enumerate(starts)]
+    shard_results = run_shards(simulate_shard, tasks, workers)
+    records = [r for shard_result in shard_results for r in shard_result[2]]
+    ranges = shard_results[0][0]
+    for r, n, shard_records, leaf_ranges, summaries in shard_results[1:]:
+      ranges = merge_ranges(ranges, r)
+
+    #Fix target variable; an appended cohort keeps the output's
+    report = new_report(profile, work_dir)
+    if append:
+      ranges, fills, thresh = previous["target"]["ranges"], previous["target"]["fills"], previous["target"]["thresh"]
     else:
-      dict_inq["inq_type_mostfreq_score"] = random.uniform(2,5)
-
-    l.append(dict_inq)
-
-  scores=pd.DataFrame(l)
-  #final score, weights for each aggregated feature
-  b1 = 0.3 #num_inq
-  b2 = 0.25 #inq_type_mf
-  b3 = 0.1 #inqtype_numunique
-  b4 = 0.3 #appdec_mf
-  b5 = 0.05 #appdec_numunique
-  
-  scores["inq_risk_score"] = b1*scores["num_inq_score"]+b2*scores["inq_type_mostfreq_score"]+b3*scores["inq_type_numunique_score"]+b4*scores["appdec_mf_score"]+b5*scores["application_decision_numunique_score"]
-  max_score = max(scores["inq_risk_score"]) 
-  min_score = min(scores["inq_risk_score"])
-  scores["inq_risk_score"] = scores["inq_risk_score"].apply(lambda x: (x-min_score)/(max_score-min_score))
-  rows["inq_risk_score"] = scores["inq_risk_score"]
-  return rows
-
-def simulate_inq(customers,loans):
-  print("Simulating inquiries table")
-  nInq = len(customers) * 3 #assuming that bureau contains 3 inquiries on average per customer
-  inq = pd.DataFrame(np.random.choice(customers, nInq, replace=True), columns=['CustID']).sort_values(by="CustID")
-  inq["inquiry_id"] = ["Inq_"+str(s) for s in np.random.choice(range(100000, 999999), size=nInq, replace=False)]
-
-  inq = inq.merge(loans[["CustID","app_date"]].groupby("CustID").min(),on="CustID",how="left")
-  # inq.to_csv("inq_test.csv")
-
-  #Date of inquiry
-  inq["inquiry_date"] = inq["app_date"].apply(lambda x: x-datetime.timedelta(int(np.random.randint(0,120,1)[0])))
-  inq = inq.drop(["app_date"],axis=1)
-
-  #InquiryType
-  inq_type = ["revolving","instalment","mortgage","rental_application"]
-  inq_type_prob = [0.65,0.1,0.1,0.15]
-  inq["inquiry_type"] = np.random.choice(inq_type,nInq,p=inq_type_prob)
-
-  inq["report_date"] = datetime.date(2014,5,31)
-  #ApplicationStatus
-  app_status = ["approved","denied"]
-  app_status_prob = [0.8,0.2]
-  inq["application_decision"] = np.random.choice(app_status,nInq,p=app_status_prob)
-
-  inq_agg = agg_inq(inq)
-  inq_agg.to_csv("inq_agg.csv")
-
-  inq = inq.merge(inq_agg[["CustID","inq_risk_score"]],on="CustID")
-  return inq
-
-def main():
-  print("Simulating credit bureau data...")
-  nRows = 10000
-  customers = ["C"+str(s) for s in np.random.choice(range(100000, 999999), size=nRows, replace=False)]
-  
-  loans = simulate_loan_apps(customers)
-  tradeline = simulate_tradeline(customers,loans)
-  inq = simulate_inq(customers,loans)
-
-  #Fix target variable
-  print("Creating target variable")
-
-  #Merge all leaf risk scores with root table
-  loans = loans.merge(inq[["CustID","inq_risk_score"]].groupby("CustID").mean(), how="left", on="CustID")
-  loans = loans.merge(tradeline[["CustID","tl_risk_score"]].groupby("CustID").mean(), how="left", on="CustID")
-  # loans = loans.merge(pr[["CustID","pr_risk_score"]].groupby("CustID").mean(), how="left", on="CustID")
-  
-  #Combine all leaf risk scores
-  #Leaf weights
-  # residential_wt = 0.05
-  # annual_income_wt = 0.2
-  # loan_purpose_wt = 0.2
-  app_wt=0.6
-  tl_wt = 0.3
-  inq_wt = 0.1
-  # pr_wt = 0.2
-
-  #Inq_score missing
-  loans.loc[loans["inq_risk_score"].isnull(),"inq_risk_score"] = loans["inq_risk_score"].quantile(0.1)
-  #TL_Score missing
-  loans.loc[loans["tl_risk_score"].isnull(),"tl_risk_score"] = loans["tl_risk_score"].quantile(0.5)
-  #Both missing
-
-  loans["final_score"] = app_wt*loans["app_risk_score"]+tl_wt*loans["tl_risk_score"]+inq_wt*loans["inq_risk_score"]
-  # loans["final_score"] = annual_income_wt*loans["inc_score"]+ loan_purpose_wt*loans["purpose_score"] + tl_wt*loans["tl_risk_score"]+inq_wt*loans["inq_risk_score"]
-
-  thresh = loans["final_score"].quantile(0.9) #top 10% will have is_bad=1
-  loans["is_bad"] = loans["final_score"].apply(lambda x: 0 if x==None else (1 if x>thresh else 0))
-  loans.loc[(loans["annual_income"]>104000) & (loans["annual_income"]<114000),"is_bad"] = np.random.choice([0,1],len(loans[(loans["annual_income"]>104000) & (loans["annual_income"]<114000)]),p=[0.94,0.06])
-  loans.loc[(loans["annual_income"]>115000) & (loans["annual_income"]<125000),"is_bad"] = np.random.choice([0,1],len(loans[(loans["annual_income"]>115000) & (loans["annual_income"]<125000)]),p=[0.96,0.04])
-  loans.loc[(loans["annual_income"]>125000) & (loans["annual_income"]<135000),"is_bad"] = np.random.choice([0,1],len(loans[(loans["annual_income"]>125000) & (loans["annual_income"]<135000)]),p=[0.98,0.02])
-  loans.loc[loans["annual_income"]>135000,"is_bad"] = np.random.choice([0,1],len(loans[loans["annual_income"]>135000]),p=[0.99,0.01])
-  
-  loans.loc[loans["loan_purpose"]=="business","is_bad"] = np.random.choice([0,1],len(loans[loans["loan_purpose"]=="business"]),p=[0.85,0.15])
-  loans.loc[loans["loan_purpose"]=="education","is_bad"] = np.random.choice([0,1],len(loans[loans["loan_purpose"]=="education"]),p=[0.95,0.05])
-  
-  loans.loc[loans["marital_status"]=="widowed","is_bad"] = np.random.choice([0,1],len(loans[loans["marital_status"]=="widowed"]),p=[0.93,0.07])
-  loans.loc[loans["marital_status"]=="divorced","is_bad"] = np.random.choice([0,1],len(loans[loans["marital_status"]=="divorced"]),p=[0.88,0.12])
-  
-  #Drop latent factors
-  loans = loans.drop(["app_risk_score","inq_risk_score","tl_risk_score","final_score","inc_score","purpose_score","res_score"],axis=1)
-  tradeline = tradeline.drop(["tl_risk_score"],axis=1)
-  inq = inq.drop(["inq_risk_score"],axis=1)
-  # pr = pr.drop(["pr_risk_score"],axis=1)
-
-  #Cosmetic changes
-  # tradeline["int_rate"] = tradeline["int_rate"].apply(lambda x: str(round(100*x,2))+"%")
-  # tradeline["credit_limit"] = tradeline["credit_limit"].apply(lambda x: "$"+str(int(x/100)*100) if x!=None else None)
-  # tradeline["balance"] = tradeline["balance"].apply(lambda x: "$"+str(int(x/100)*100)
-
-  #Writing out csv files
-  print("Writing out files")
-  loans.to_csv('Loan Applications.csv',index=False, header=True)
-  inq.to_csv("Bureau Inquiries.csv",index=False, header=True)
-  tradeline.to_csv("Bureau Tradeline Accounts.csv",index=False, header=True)
-  # pr.to_csv("Public Records.csv")
+      with stage(report, "target_cutoffs", nRows):
+        scaled_leaves = lambda: (scale_scores(leaves, ranges) for leaves in load_leaves(work_dir, nShards))
+        fills, thresh = target_cutoffs(scaled_leaves)
+    if sweep is not None:
+      with stage(report, "sweep_cutoffs", nRows*len(sweep["names"])):
+        sweep["ranges"] = (np.fmin.reduce([r[3][0] for r in shard_results]), np.fmax.reduce([r[3][1] for r in shard_results]))
+        scaled_leaves = lambda: (scale_leaves(np.load(shard_path(work_dir, i, "leaves.npy")), sweep) for i in range(nShards))
+        sweep = sweep_cutoffs(scaled_leaves, sweep)
+
+    #Writing out files
+    agg_rows = {name: [r[1][name] for r in shard_results] for name in shard_results[0][1]}
+    agg_offsets = {name: corpus[name+"_rows"] + np.cumsum([0]+rows[:-1]) for name, rows in agg_rows.items()}
+    tasks = [(i, ranges, fills, thresh, run_key, {name: o[i] for name, o in agg_offsets.items()}, output, profile, sweep, validate)
+      for i in range(nShards)]
+    final_results = run_shards(finalize_shard, tasks, workers)
+    records += [r for shard_records, summaries in final_results for r in shard_records]
+    for name in run_tables:
+      with stage(report, "finish "+name) as record:
+        record["bytes_written"] = finish_table(name, nShards, output)
+    validation = None
+    if validate:
+      with stage(report, "validate"):
+        summaries = {}
+        for shard_summaries in [r[4] for r in shard_results]+[r[1] for r in final_results]:
+          for name, summary in shard_summaries.items():
+            summaries[name] = merge_summaries(summaries.get(name), summary)
+        validation = validation_report(summaries, validation_checks)
+        write_validation(os.path.join(out_dir, "validation.json"), validation)
+    records += report["stages"]
+    profile_path = profile and merge_profiles(work_dir, profile, os.path.join(out_dir, "profile_%s.prof" % profile))
+  finally:
+    shutil.rmtree(work_dir)
+
+  if profile and profile_path is None:
+    log.warning("No stage named %s ran, so there is no profile", profile)
+  corpus = dict(corpus, rows=first+nRows, parts=corpus["parts"]+nShards, id_widths=widths,
+    cohorts=corpus["cohorts"]+[dict(cohort, first=first, rows=nRows)])
+  for spec, total in zip(child_specs, totals.sum(axis=0)):
+    corpus[spec["total"]] += int(total)
+  for name, rows in agg_rows.items():
+    corpus[name+"_rows"] += int(sum(rows))
+  #The target's parameters let customer_records label single customers as this run did
+  run = {"rows": nRows, "chunk_size": chunk_size, "shards": nShards, "workers": workers, "format": fmt, "partitions": partitions,
+    "seed": mySeed, "id_width": min_id_width, "cache": cache_dir, "profile": profile_path, "wall_s": time.perf_counter()-wall,
+    "target": {"ranges": ranges, "fills": fills, "thresh": thresh}, "append": append, "corpus": corpus, "snapshot_months": months}
+  if sweep is not None:
+    run["scenarios"] = [{"name": name, "bad_rate": rate, "cutoff": cut} for name, rate, cut in zip(sweep["names"], sweep["bad_rate"], sweep["thresh"])]
+  if validation is not None:
+    run["validation"] = {"checks": len(validation["checks"]), "failed": validation["failed"]}
+  run.update(process_usage())
+  write_report(os.path.join(out_dir, "run_report.json"), run, records)
 
 if __name__=='__main__':
-  main()
-  
+  parser = argparse.ArgumentParser(description="Simulate credit bureau data for the AFE demo")
+  parser.add_argument("--rows", type=int, default=10000, help="number of loan applicants")
+  parser.add_argument("--chunk-size", type=int, default=None, help="applicants per shard; bounds memory and sets the unit of parallel work")
+  parser.add_argument("--out-dir", default=".", help="directory the output files are written to")
+  parser.add_argument("--workers", type=int, default=1, help="number of processes simulating shards")
+  parser.add_argument("--id-width", type=int, default=6, help="minimum number of digits in customer, account and inquiry IDs; widened as needed for the row count")
+  parser.add_argument("--format", default="csv", choices=sorted(formats), help="output file format; parquet and feather need pyarrow")
+  parser.add_argument("--partitions", type=int, default=0, help="split parquet/feather output into this many CustID hash buckets")
+  parser.add_argument("--profile", default=None, help="run this stage under cProfile, e.g. agg_tradeline, and write profile_<stage>.prof")
+  parser.add_argument("--cache-dir", default=None, help="reuse simulated stages from this directory when their inputs and configuration are unchanged")
+  parser.add_argument("--cache-mb", type=float, default=2048, help="size limit of the stage cache; least recently used entries are evicted")
+  parser.add_argument("--scenarios", default=None, help="JSON list of weight scenarios to label in one run, written to scenario_labels")
+  parser.add_argument("--append", action="store_true", help="add --rows applicants as a new cohort to the output in --out-dir instead of rebuilding it")
+  parser.add_argument("--app-start", default=None, help="first application date of the cohort, YYYY-MM-DD; by default the first cohort's, or the day after the last cohort's window when appending")
+  parser.add_argument("--app-window", type=int, default=None, help="days of applications in the cohort; by default 90, or the last cohort's when appending")
+  parser.add_argument("--snapshot-months", type=int, default=snapshot_months, help="write this many months of tradeline snapshots before the applications, e.g. 24 or 36")
+  parser.add_argument("--validate", action="store_true", help="check the output against the configured distributions and write validation.json")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  main(args.rows, args.chunk_size, args.out_dir, args.workers, args.id_width, args.format, args.partitions, args.profile,
+    args.cache_dir, args.cache_mb, load_scenarios(args.scenarios) if args.scenarios else None, args.append, args.app_start, args.app_window,
+    args.snapshot_months, args.validate)
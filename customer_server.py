@@ -0,0 +1,86 @@
+import json
+import logging
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote
+import pandas as pd
+import bureau_data_simulation as sim
+from sim_output import csv_text
+from sim_report import log
+
+# Local JSON stub for UI tests: GET /customers/<CustID> answers with that customer's loan application and rows of every
+# child table, simulated on the spot by bureau_data_simulation.customer_records, so they are the rows a full run with the
+# same number of rows and ID width writes for the customer. Pointed at a run's run_report.json it takes the rows,
+# ID width, cohorts, snapshot months and is_bad cutoffs of that output, appended cohorts included; without one there is no is_bad.
+# Fields hold the text the CSV has, numbers as JSON numbers and missing values as null.
+
+#JSON values of a column
+def json_values(values):
+  missing = values.isna().to_numpy()
+  if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype.kind not in "biufM":
+    return [None if m else v for v, m in zip(values.astype(object), missing)]
+  text = csv_text(values)
+  if values.dtype.kind=="M":
+    return [None if m else t for t, m in zip(text, missing)]
+  return [None if m else json.loads(t) for t, m in zip(text, missing)]
+
+def customer_json(custid, index, target=None):
+  records = {}
+  for name, frame in sim.customer_records(custid, index, target).items():
+    columns = [json_values(frame[col]) for col in frame.columns]
+    records[name] = [dict(zip(frame.columns, row)) for row in zip(*columns)]
+  return records
+
+def make_handler(index, target):
+  class CustomerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      parts = unquote(urlsplit(self.path).path).strip("/").split("/")
+      if len(parts)!=2 or parts[0]!="customers":
+        return self.send_json(404, {"error": "Not found; ask for /customers/<CustID>"})
+      try:
+        self.send_json(200, customer_json(parts[1], index, target))
+      except KeyError:
+        self.send_json(404, {"error": "No customer "+parts[1]})
+
+    def send_json(self, status, body):
+      data = json.dumps(body).encode()
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+      log.info(fmt, *args)
+  return CustomerHandler
+
+def main(report=None, nRows=10000, min_id_width=6, host="127.0.0.1", port=8000):
+  target = cohorts = None
+  months = 0
+  if report is not None:
+    with open(report) as f:
+      run = json.load(f)["run"]
+    if run["seed"]!=sim.mySeed:
+      raise ValueError("%s is from a run with seed %d, this script has %d" % (report, run["seed"], sim.mySeed))
+    nRows, min_id_width, target, cohorts = run["corpus"]["rows"], run["id_width"], run["target"], run["corpus"]["cohorts"]
+    months = run.get("snapshot_months", 0)
+  index = sim.customer_index(nRows, min_id_width, cohorts, months)
+  server = HTTPServer((host, port), make_handler(index, target))
+  log.info("Serving %d customers on http://%s:%d/customers/<CustID>", nRows, host, server.server_port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Serve single customers' simulated records as JSON")
+  parser.add_argument("--report", default=None, help="run_report.json of the run to match; sets --rows and --id-width and adds is_bad")
+  parser.add_argument("--rows", type=int, default=10000, help="number of loan applicants of the run to match")
+  parser.add_argument("--id-width", type=int, default=6, help="minimum ID width of the run to match")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8000)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  main(args.report, args.rows, args.id_width, args.host, args.port)
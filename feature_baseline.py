@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import bureau_data_simulation as sim
+from sim_output import pa, write_csv
+from sim_report import log
+
+if pa is not None:
+  import pyarrow.dataset as ds
+
+# Point in time features of each loan application, a baseline for automated feature engineering to beat:
+# inquiry counts in the days before app_date, overall and by inquiry_type, accounts opened in the last 12 months,
+# accounts open on app_date and their utilization, and with snapshots the account months spent 30+ days delinquent.
+# Only what happened before app_date counts, so nothing from the application day or later leaks in.
+# Nothing is joined to the applications or filtered per window: each child table is sorted once into int64 keys holding
+# the applicant in the high bits and the day in the low ones, values to total become prefix sums along the sorted rows,
+# and the window [app_date-days, app_date) of every applicant is two searchsorted calls on the keys.
+# A feature costs O(applicants log rows) however many windows there are, so millions of applicants take seconds.
+
+features_file = "pit_features.csv"
+
+inq_windows = [30,60,90] #days before the application
+tl_open_windows = [365] #accounts opened in these days before the application
+delq_windows = [365] #account months at 30DPD or worse in the snapshots of these days before the application
+
+day_offset = 2**31 #keeps day numbers positive in the low 32 bits of a key
+
+def day_numbers(dates):
+  return np.asarray(dates, dtype='datetime64[D]').astype('int64') + day_offset
+
+#Sorted keys of a child table's rows by applicant and day, and prefix sums of each of sums (name -> values) in that order;
+#codes: row number of each row's applicant, -1 when it has none. Rows without a date are left out.
+def event_index(codes, dates, sums=None):
+  days = np.asarray(dates, dtype='datetime64[D]')
+  keep = (codes>=0) & ~np.isnat(days)
+  keys = (codes[keep].astype('int64') << 32) + day_numbers(days[keep])
+  order = np.argsort(keys, kind='stable')
+  index = {"keys": keys[order]}
+  for name, values in (sums or {}).items():
+    index[name] = np.concatenate([[0], np.cumsum(np.asarray(values, dtype='float64')[keep][order])])
+  return index
+
+#Per applicant, the rows dated in [app_day-days, app_day), or all before app_day without days; with name, the total of that sum
+def window_total(index, codes, app_days, days=None, name=None):
+  base = codes.astype('int64') << 32
+  end = np.searchsorted(index["keys"], base + app_days)
+  start = np.searchsorted(index["keys"], base + (app_days-days if days else 0))
+  if name is None:
+    return end-start
+  return index[name][end]-index[name][start]
+
+#Row number in loans of each child row's applicant
+def applicant_codes(loans, child):
+  return pd.Index(loans["CustID"]).get_indexer(child["CustID"])
+
+def inquiry_features(loans, inq, app_days):
+  codes = applicant_codes(loans, inq)
+  applicants = np.arange(len(loans))
+  features = {}
+  every = event_index(codes, inq["inquiry_date"])
+  for days in inq_windows:
+    features["inq_%dd" % days] = window_total(every, applicants, app_days, days)
+  #Each type is a key space of its own: applicant and type together take the high bits
+  types = pd.Categorical(inq["inquiry_type"], categories=sim.inq_type).codes
+  by_type = event_index(np.where((codes>=0) & (types>=0), codes*len(sim.inq_type)+types, -1), inq["inquiry_date"])
+  for t, name in enumerate(sim.inq_type):
+    for days in inq_windows:
+      features["inq_%s_%dd" % (name, days)] = window_total(by_type, applicants*len(sim.inq_type)+t, app_days, days)
+  return features
+
+#Accounts are open on app_date when opened before it and not closed before it; utilization is the revolving
+#accounts' balances over their limits, and the average utilization of those reporting one
+def tradeline_features(loans, tl, app_days):
+  codes = applicant_codes(loans, tl)
+  applicants = np.arange(len(loans))
+  closed = np.asarray(tl["closed_date"], dtype='datetime64[D]')
+  is_open = np.isnat(closed) | (day_numbers(closed) >= app_days[np.maximum(codes, 0)])
+  has_util = is_open & tl["utilization"].notna().to_numpy()
+  index = event_index(codes, tl["open_date"], {
+    "open": is_open, "has_util": has_util,
+    "util": np.where(has_util, tl["utilization"].to_numpy(dtype='float64', na_value=np.nan), 0),
+    "balance": np.where(has_util, tl["balance"].to_numpy(dtype='float64', na_value=np.nan), 0),
+    "limit": np.where(has_util, tl["credit_limit"].to_numpy(dtype='float64', na_value=np.nan), 0)})
+  features = {}
+  for days in tl_open_windows:
+    features["tl_opened_%dd" % days] = window_total(index, applicants, app_days, days)
+  features["tl_open"] = window_total(index, applicants, app_days, name="open").astype('int64')
+  limit = window_total(index, applicants, app_days, name="limit")
+  with np.errstate(invalid='ignore', divide='ignore'):
+    features["tl_open_revolving_util"] = window_total(index, applicants, app_days, name="balance")/limit
+    features["tl_open_util_avg"] = window_total(index, applicants, app_days, name="util")/window_total(index, applicants, app_days, name="has_util")
+  return features
+
+def snapshot_features(loans, snapshots, app_days):
+  codes = applicant_codes(loans, snapshots)
+  applicants = np.arange(len(loans))
+  delinquent = pd.Categorical(snapshots["delq_state"], categories=sim.curr_status).codes > 0
+  index = event_index(codes, snapshots["snapshot_date"], {"delq": delinquent})
+  return {"delq_account_months_%dd" % days: window_total(index, applicants, app_days, days, "delq").astype('int64') for days in delq_windows}
+
+#One row per application, in loans order; snapshots may be None
+def point_in_time_features(loans, tradeline, inq, snapshots=None):
+  app_days = day_numbers(loans["app_date"])
+  features = {"CustID": loans["CustID"].to_numpy()}
+  features.update(inquiry_features(loans, inq, app_days))
+  features.update(tradeline_features(loans, tradeline, app_days))
+  if snapshots is not None:
+    features.update(snapshot_features(loans, snapshots, app_days))
+  return pd.DataFrame(features)
+
+############################# Reading the output ######################################
+
+#A table of a run's output with the given columns, whatever format the run wrote it in
+def read_table(out_dir, name, fmt, columns):
+  path = os.path.join(out_dir, name)
+  dates = [col for col in columns if col.endswith("_date")]
+  if fmt=="csv":
+    return pd.read_csv(path+".csv", usecols=columns, parse_dates=dates)
+  if pa is None:
+    raise ImportError("pyarrow is required to read %s output" % fmt)
+  table = ds.dataset(path, format="ipc" if fmt=="feather" else fmt, partitioning="hive").to_table(columns=columns)
+  return table.to_pandas(date_as_object=False)
+
+def main(out_dir=".", path=None):
+  with open(os.path.join(out_dir, "run_report.json")) as f:
+    run = json.load(f)["run"]
+  start = time.perf_counter()
+  fmt = run["format"]
+  loans = read_table(out_dir, "Loan Applications", fmt, ["CustID","app_date"])
+  tradeline = read_table(out_dir, "Bureau Tradeline Accounts", fmt,
+    ["CustID","open_date","closed_date","credit_limit","balance","utilization"])
+  inq = read_table(out_dir, "Bureau Inquiries", fmt, ["CustID","inquiry_date","inquiry_type"])
+  snapshots = None
+  if run.get("snapshot_months"):
+    snapshots = read_table(out_dir, "Bureau Tradeline Snapshots", fmt, ["CustID","snapshot_date","delq_state"])
+  read_s = time.perf_counter()-start
+  features = point_in_time_features(loans, tradeline, inq, snapshots)
+  path = path or os.path.join(out_dir, features_file)
+  write_csv(features, path)
+  log.info("%d applicants, %d features: read in %.2fs, computed and written in %.2fs to %s",
+    len(features), features.shape[1]-1, read_s, time.perf_counter()-start-read_s, path)
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Point in time baseline features of the simulated loan applications")
+  parser.add_argument("--out-dir", default=".", help="directory holding the run's output and run_report.json")
+  parser.add_argument("--features-file", default=None, help="where to write the features; by default %s in --out-dir" % features_file)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  main(args.out_dir, args.features_file)
@@ -0,0 +1,110 @@
+import os
+import shutil
+import pickle
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+import scipy
+
+# On-disk cache of stage outputs
+# A stage's key is a hash of everything its output depends on: the stage's code and configuration, the keys of
+# the stages it reads from and the key of the random draws it makes. An entry holds the output.
+# Files a stage writes can be cached the same way, keyed by what their content depends on.
+# Entries are single pickle files or file copies, written to a temporary name and renamed so that concurrent shards never read
+# a partial entry. When the cache grows past its size limit the least recently used entries are evicted.
+
+#cache: dict with the cache directory and its size limit in bytes, or None when caching is off
+def cache_config(cache_dir, max_mb):
+  if cache_dir is None:
+    return None
+  os.makedirs(cache_dir, exist_ok=True)
+  return {"dir": cache_dir, "max_bytes": int(max_mb*2**20)}
+
+def _feed(h, part):
+  if isinstance(part, np.ndarray):
+    h.update(str(part.dtype).encode()+b":"+part.tobytes())
+  elif isinstance(part, (list, tuple)):
+    h.update(b"[")
+    for p in part:
+      _feed(h, p)
+    h.update(b"]")
+  elif isinstance(part, dict):
+    h.update(b"{")
+    for k, v in part.items():
+      _feed(h, k)
+      _feed(h, v)
+    h.update(b"}")
+  elif callable(part):
+    h.update(inspect.getsource(part).encode()) #functions by their code, not their address
+  else:
+    h.update(repr(part).encode())
+  h.update(b"\0")
+
+#Library versions are part of every key: a new numpy or scipy may turn the same uniforms into different numbers
+def fingerprint(*parts):
+  h = hashlib.sha256()
+  _feed(h, (np.__version__, pd.__version__, scipy.__version__)+parts)
+  return h.hexdigest()
+
+def entry_path(cache, key):
+  return os.path.join(cache["dir"], key+".pkl")
+
+#Returns fn(*args) and whether it came from the cache
+def cached_call(cache, key, fn, *args):
+  if cache is None:
+    return fn(*args), None
+  path = entry_path(cache, key)
+  try:
+    with open(path, "rb") as f:
+      result = pickle.load(f)
+    os.utime(path) #mark as recently used
+    return result, "hit"
+  except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+    pass
+  result = fn(*args)
+  tmp = "%s.%d.tmp" % (path, os.getpid())
+  with open(tmp, "wb") as f:
+    pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp, path)
+  evict(cache, keep=path)
+  return result, "miss"
+
+#Produces the file at path with write(), or copies it from the cache; returns write()'s result (the size) and hit or miss
+def cached_file(cache, key, path, write):
+  if cache is None:
+    return write(), None
+  entry = os.path.join(cache["dir"], key+".part")
+  try:
+    shutil.copyfile(entry, path)
+    os.utime(entry)
+    return os.path.getsize(path), "hit"
+  except OSError:
+    pass
+  result = write()
+  tmp = "%s.%d.tmp" % (entry, os.getpid())
+  shutil.copyfile(path, tmp)
+  os.replace(tmp, entry)
+  evict(cache, keep=entry)
+  return result, "miss"
+
+def evict(cache, keep=None):
+  entries = []
+  for entry in os.scandir(cache["dir"]):
+    try:
+      if entry.name.endswith((".pkl",".part")):
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+      pass #evicted by another shard meanwhile
+  total = sum(size for mtime, size, path in entries)
+  for mtime, size, path in sorted(entries):
+    if total<=cache["max_bytes"]:
+      break
+    if path==keep:
+      continue
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+    total -= size
@@ -0,0 +1,474 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy.special import ndtri, gammaincinv, pdtr
+
+# Vectorized building blocks shared by the bureau data simulation stages in bureau_data_simulation.py
+
+############################# Score bands ######################################
+
+# A band table maps the values of one column to the (lo, hi) range its latent score is drawn from.
+# Numeric bands are a list of (upper, (lo, hi)) pairs in increasing order of upper: a value falls in the first
+# band whose upper bound it is strictly below, and NaN falls through to the last band, like the final else of an if/elif chain.
+# Categorical bands are a dict of category -> (lo, hi); values not listed get the default range.
+# A range of None leaves the score missing.
+
+#Index of each value's band among the entries of the band table, and the entries; -1 is the default, the last entry
+def band_index(values, bands, default=None):
+  if isinstance(bands, dict):
+    entries = list(bands.values()) + [default]
+    values = pd.Series(values)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+      #Look up each category once and index the result by the codes; missing values (code -1) take the default
+      idx = np.append(pd.Index(list(bands.keys())).get_indexer(values.cat.categories), -1)[values.cat.codes.to_numpy()]
+    else:
+      idx = pd.Index(list(bands.keys())).get_indexer(values.to_numpy(dtype=object)) #-1 picks the default
+  else:
+    entries = [r for upper, r in bands]
+    uppers = np.array([upper for upper, r in bands], dtype='float64')
+    idx = np.searchsorted(uppers, np.asarray(values, dtype='float64'), side='right')
+    idx = np.minimum(idx, len(entries)-1)
+  return idx, entries
+
+def band_ranges(values, bands, default=None):
+  idx, ranges = band_index(values, bands, default)
+  lo = np.array([np.nan if r is None else r[0] for r in ranges], dtype='float64')
+  hi = np.array([np.nan if r is None else r[1] for r in ranges], dtype='float64')
+  return lo[idx], hi[idx]
+
+#u: a uniform per value
+def draw_band_scores(values, bands, u, default=None):
+  lo, hi = band_ranges(values, bands, default)
+  return lo + (hi-lo)*u
+
+# spec: score name -> (column, bands) or (column, bands, default), or (column, factor) for a score that is the column
+# times factor, without a draw; rand draws for the frame's rows, see keyed_rand
+def band_scores(frame, spec, rand):
+  scores = pd.DataFrame(index=frame.index)
+  for name, entry in spec.items():
+    column, bands = entry[0], entry[1]
+    if isinstance(bands, (int, float)):
+      scores[name] = frame[column]*bands
+      continue
+    default = entry[2] if len(entry)>2 else None
+    scores[name] = draw_band_scores(frame[column], bands, uniform(rand, name), default)
+  return scores
+
+# Zero weights are skipped so that a switched-off score can be missing without blanking the total
+def weighted_score(scores, weights):
+  total = pd.Series(0.0, index=scores.index)
+  for name, wt in weights.items():
+    if wt!=0:
+      total = total + wt*scores[name]
+  return total
+
+############################# Child counts ######################################
+
+# Number of child rows (tradelines, inquiries, ...) per parent row.
+# spec: {"dist": "poisson", "mean": m} or {"dist": "zero_inflated_poisson", "mean": m, "zero_prob": p},
+# where a zero-inflated count is 0 with probability p and Poisson(m) otherwise.
+# Children are laid out with np.repeat(np.arange(n), counts), so they come out grouped in parent order.
+#rand draws for the parent rows, name tells the kinds of children apart
+def draw_counts(spec, rand, name):
+  if spec["dist"]=="poisson":
+    counts = poisson(rand, name, spec["mean"])
+  elif spec["dist"]=="zero_inflated_poisson":
+    counts = poisson(rand, name, spec["mean"]) * (uniform(rand, name+" zero")>=spec["zero_prob"])
+  else:
+    raise ValueError("Unknown count distribution: "+str(spec["dist"]))
+  return counts.astype('int32')
+
+#Number of each child row among its parent's children: 0, 1, ... within every parent
+def child_numbers(counts):
+  first = np.cumsum(counts) - counts
+  return np.arange(counts.sum()) - np.repeat(first, counts)
+
+############################# Conditional sampling ######################################
+
+# A dependent categorical column is drawn from a row of probabilities chosen by its parent's value.
+# All rows are drawn in one pass: each row's uniform is compared with the cumulative probabilities of its parent's row,
+# gathered a column at a time, and its code is the number of them it is not below.
+
+#parent: codes of the parent, indexing the rows of P; u: a uniform per row; returns codes indexing the columns of P
+def sample_conditional(parent, P, u):
+  P = np.asarray(P, dtype='float64')
+  cum = np.cumsum(P, axis=1)
+  cum = cum/cum[:, -1:]
+  codes = np.zeros(len(parent), dtype='int16')
+  for j in range(P.shape[1]-1): #the last cumulative probability is 1, above every uniform
+    codes += u>=cum[:, j][parent]
+  return codes
+
+#Paths of a Markov chain with transition matrix P, all rows moving a step at a time: column 0 holds each row's start
+#state and column s the state s steps on, drawn from P's row for the state before it. rand draws for the rows.
+def markov_paths(start, P, steps, rand, name):
+  paths = np.empty((len(start), steps), dtype='int8')
+  paths[:, 0] = start
+  for s in range(1, steps):
+    paths[:, s] = sample_conditional(paths[:, s-1], P, uniform(rand, "%s %d" % (name, s)))
+  return paths
+
+# spec: column -> (parent column, bands), where the bands map the parent's values to probabilities over the categories
+# of the column's dtype in schema, in the forms score bands take: [(upper, probabilities), ...] or {category: probabilities}.
+# Columns are drawn in spec order, so a column can be the parent of the ones after it.
+def sample_dependent(frame, spec, schema, rand):
+  for column, (parent, bands) in spec.items():
+    frame[column] = pd.Categorical.from_codes(dependent_codes(frame, column, parent, bands, rand), dtype=schema[column])
+  return frame
+
+#Category codes of column drawn given the parent column, see sample_dependent
+def dependent_codes(frame, column, parent, bands, rand):
+  idx, rows = band_index(frame[parent], bands)
+  if isinstance(bands, dict):
+    rows = rows[:-1]
+    if (idx<0).any():
+      raise ValueError("No %s probabilities for %s %s" % (column, parent, frame[parent][idx<0].iloc[0]))
+  return sample_conditional(idx, rows, uniform(rand, column))
+
+############################# Keyed draws ######################################
+
+# Counter based random numbers: a draw is a hash of the run's key, the table, the counters of the row it is drawn for
+# (a customer ordinal, and for child rows the child's number too) and the name of what is drawn. Any row can be drawn
+# on its own and comes out the same whichever shard, chunk or single customer lookup draws it.
+# rand: a table's key and the hash of each row's counters, made once; the functions below turn its uniforms
+# into the distributions the stages need, one value per row.
+
+def stream_key(*parts):
+  return int.from_bytes(hashlib.blake2b(repr(parts).encode(), digest_size=8).digest(), "little")
+
+#counters: one array per counter, a value per row
+def keyed_rand(key, table, *counters):
+  key = stream_key(int(key), table)
+  rows = np.full(len(counters[0]), key, dtype=np.uint64)
+  for c in counters:
+    rows = _mix((rows ^ np.asarray(c, dtype=np.uint64)) + np.uint64(0x9e3779b97f4a7c15))
+  return {"key": key, "rows": rows}
+
+#Uniforms in the open interval (0, 1)
+def uniform(rand, name):
+  h = _mix(rand["rows"] ^ np.uint64(stream_key(rand["key"], name)))
+  return ((h >> np.uint64(11)).astype('float64') + 0.5) * 2.0**-53
+
+#lo and hi may be arrays, a range per row; hi is excluded
+def integers(rand, name, lo, hi):
+  return (lo + np.floor(uniform(rand, name)*(np.asarray(hi)-lo))).astype('int64')
+
+def normal(rand, name, loc, scale):
+  return loc + scale*ndtri(uniform(rand, name))
+
+def gamma(rand, name, shape, scale):
+  return scale*gammaincinv(shape, uniform(rand, name))
+
+#Codes 0..len(p)-1 drawn with probabilities p
+def choice(rand, name, p):
+  u = uniform(rand, name)
+  return sample_conditional(np.zeros(len(u), dtype='int64'), [p], u)
+
+#By the inverse of the cumulative distribution, tabulated far enough into the tail that no uniform passes its end
+def poisson(rand, name, mean):
+  cdf = pdtr(np.arange(int(mean + 20*np.sqrt(mean) + 40)), mean)
+  return np.searchsorted(cdf, uniform(rand, name)).astype('int64')
+
+############################# Schemas ######################################
+
+# A table schema maps each column to its dtype, None for columns that keep the dtype pandas gives them (the string IDs).
+# Simulation steps build their columns with these dtypes directly; conform only casts what does not match already.
+def conform(frame, schema):
+  casts = {col: dtype for col, dtype in schema.items() if dtype is not None and col in frame and frame[col].dtype!=dtype}
+  return frame.astype(casts) if casts else frame
+
+############################# Table columns ######################################
+
+# The columns of a table spec are (column, generator, *args) entries, drawn in order into a frame that already holds
+# the row keys, so a column can depend on the ones before it. Each column's draws are named after it, see keyed_rand.
+#   ("x", "choice", p)                   category codes with probabilities p, in the order of the column's categories
+#   ("x", "dependent", column, bands)    categories drawn given another column, see sample_dependent
+#   ("x", "integers", lo, hi)            integers in [lo, hi)
+#   ("x", "normal", mean, sd[, by])      normal; with by, mean and sd are lists in the order of by's categories
+#   ("x", "gamma", shape, scale[, decimals])  gamma with that shape times scale, rounded to decimals
+#   ("x", "date", start, days)           start plus 0 to days-1 days
+#   ("x", "fixed_date", date)            the same date on every row
+#   ("x", "days_before", column, lo, hi) the date in the parent row's column less lo to hi-1 days
+#   ("x", fn, *args)                     fn(frame, rand, context, *args) returns the column, or a dict of columns
+# context: "shift", a timedelta64 added to every date (none by default), and for child tables "parent", the parent
+# table's rows, and "owner", each row's parent row; callers may add their own entries for their functions.
+# Codes of categorical columns in the schema become Categoricals of its dtype.
+
+def _choice(frame, rand, column, context, p):
+  return choice(rand, column, p)
+
+def _dependent(frame, rand, column, context, parent, bands):
+  return dependent_codes(frame, column, parent, bands, rand)
+
+def _integers(frame, rand, column, context, lo, hi):
+  return integers(rand, column, lo, hi)
+
+def _normal(frame, rand, column, context, mean, sd, by=None):
+  if by is not None:
+    codes = frame[by].cat.codes.to_numpy()
+    mean, sd = np.asarray(mean)[codes], np.asarray(sd)[codes]
+  return normal(rand, column, mean, sd)
+
+def _gamma(frame, rand, column, context, shape, scale, decimals=None):
+  x = gamma(rand, column, shape, scale)
+  return x if decimals is None else np.round(x, decimals)
+
+def _date(frame, rand, column, context, start, days):
+  return np.datetime64(start,'D') + context.get("shift", np.timedelta64(0,'D')) + integers(rand, column, 0, days)
+
+def _fixed_date(frame, rand, column, context, date):
+  return np.datetime64(date,'D') + context.get("shift", np.timedelta64(0,'D'))
+
+def _days_before(frame, rand, column, context, parent_column, lo, hi):
+  dates = context["parent"][parent_column].to_numpy().astype('datetime64[D]')[context["owner"]]
+  return dates - integers(rand, column, lo, hi)
+
+generators = {"choice": _choice, "dependent": _dependent, "integers": _integers, "normal": _normal, "gamma": _gamma,
+  "date": _date, "fixed_date": _fixed_date, "days_before": _days_before}
+
+def table_columns(frame, columns, schema, rand, context):
+  for entry in columns:
+    column, kind, args = entry[0], entry[1], entry[2:]
+    values = kind(frame, rand, context, *args) if callable(kind) else generators[kind](frame, rand, column, context, *args)
+    for col, v in (values if isinstance(values, dict) else {column: values}).items():
+      dtype = schema.get(col)
+      if isinstance(dtype, pd.CategoricalDtype) and not isinstance(v, (pd.Categorical, pd.Series)):
+        v = pd.Categorical.from_codes(v, dtype=dtype)
+      frame[col] = v
+  return frame
+
+############################# Latent store ######################################
+
+# The latent factors of a shard's customers (component and leaf risk scores) in one dense float64 matrix,
+# a row per customer ordinal, i.e. the customer's position in the shard's sorted CustIDs, and a column per factor.
+# Each stage puts the factors it computes and later stages look them up by ordinal, so scores are never merged
+# onto the child tables and grouped back. Customers without rows in a child table keep NaN for its factors.
+def new_store(customers, factors):
+  return {"customers": np.asarray(customers), "factors": list(factors), "values": np.full((len(customers), len(factors)), np.nan)}
+
+#Ordinals of any CustIDs of the store's customers, by binary search
+def store_ordinals(store, custids):
+  custids = np.asarray(custids)
+  ordinals = np.searchsorted(store["customers"], custids)
+  found = ordinals<len(store["customers"])
+  found[found] = store["customers"][ordinals[found]]==custids[found]
+  if not found.all():
+    raise KeyError("Customers not in the store: "+", ".join(map(str, custids[~found][:5])))
+  return ordinals
+
+#Stores the frame's columns that are factors, row i of the frame going to the customer with ordinal ordinals[i].
+#The frame's key column must name those same customers, so rows can never land on the wrong customer.
+def store_put(store, ordinals, frame, key="CustID"):
+  if not np.array_equal(store["customers"][ordinals], frame[key].to_numpy(dtype=store["customers"].dtype)):
+    raise ValueError("Rows do not line up with the store's customer ordinals")
+  names = [name for name in frame.columns if name in store["factors"]]
+  cols = [store["factors"].index(name) for name in names]
+  store["values"][np.ix_(ordinals, cols)] = frame[names].to_numpy(dtype='float64', na_value=np.nan)
+
+#Customers x factors, in customer order
+def store_get(store, names):
+  return store["values"][:, [store["factors"].index(name) for name in names]]
+
+############################# Group aggregation ######################################
+
+# spec: list of (output name, column, aggregate) or (output name, column, aggregate, fill)
+# count: non-missing rows, mode: most frequent non-missing value, nunique: distinct non-missing values,
+# mean and sum: average and total of non-missing values
+# fill replaces the result for groups without any non-missing value
+# The key and each categorical column are factorized once, then count, mean and sum are bincounts over integer codes,
+# and mode and nunique reduce the sorted distinct (group, value) pairs with their counts, one segment per group,
+# so their cost is O(n log n) however many distinct values the column has.
+# Groups come out sorted by key. Counts are int32, means and sums float32.
+# The mode of a pandas Categorical column is a Categorical with the same categories, plus the fill if there is one.
+# Ties for the mode go to the value the group has first.
+
+def group_agg(frame, key, spec):
+  group_codes, groups = pd.factorize(frame[key], sort=True)
+  nGroups = len(groups)
+  out = pd.DataFrame({key: np.asarray(groups)})
+  codes = {}
+  for entry in spec:
+    name, column, agg = entry[0], entry[1], entry[2]
+    fill = entry[3] if len(entry)>3 else None
+    values = frame[column]
+    categorical = isinstance(values.dtype, pd.CategoricalDtype)
+    if agg in ("mean","sum"):
+      x = values.to_numpy(dtype='float64', na_value=np.nan)
+      present = ~np.isnan(x)
+      total = np.bincount(group_codes[present], weights=x[present], minlength=nGroups)
+      n = np.bincount(group_codes[present], minlength=nGroups)
+      with np.errstate(invalid='ignore', divide='ignore'):
+        result = (total/n if agg=="mean" else total).astype('float32')
+      empty = n==0
+    elif agg=="count":
+      present = values.notna().to_numpy()
+      result = np.bincount(group_codes[present], minlength=nGroups).astype('int32')
+      empty = result==0
+    elif agg in ("mode","nunique"):
+      if column not in codes:
+        codes[column] = (values.cat.codes.to_numpy(), values.cat.categories) if categorical else pd.factorize(values)
+      value_codes, uniques = codes[column]
+      present = value_codes>=0
+      k = len(uniques)
+      pairs = group_codes[present].astype('int64')*k + value_codes[present]
+      pair_keys, first_row, pair_counts = np.unique(pairs, return_index=True, return_counts=True)
+      pair_groups = pair_keys//k if k>0 else pair_keys
+      nunique = np.bincount(pair_groups, minlength=nGroups)
+      empty = nunique==0
+      if agg=="nunique":
+        result = nunique.astype('int32')
+      else:
+        #Most rows first, ties to the value the group has first; the first pair of each group's segment is its mode
+        order = np.lexsort((first_row, -pair_counts, pair_groups))
+        heads = order[np.r_[True, pair_groups[order][1:]!=pair_groups[order][:-1]]] if len(order) else order
+        mode_codes = np.zeros(nGroups, dtype='int64')
+        mode_codes[pair_groups[heads]] = pair_keys[heads] - pair_groups[heads]*k
+        if categorical:
+          categories = uniques
+          if fill is not None and fill not in categories:
+            categories = categories.append(pd.Index([fill]))
+          mode_codes[empty] = -1 if fill is None else categories.get_loc(fill)
+          result = pd.Categorical.from_codes(mode_codes, categories=categories)
+          fill = None
+        else:
+          result = np.asarray(uniques, dtype=object)[mode_codes] if k>0 else np.full(nGroups, None, dtype=object)
+          result[empty] = None
+    else:
+      raise ValueError("Unknown aggregate: "+str(agg))
+    if fill is not None and empty.any():
+      result = np.where(empty, fill, result)
+    out[name] = result
+  return out
+
+############################# Chunked quantiles ######################################
+
+# Exact quantile, with the linear interpolation pandas and numpy use, over values that arrive in chunks.
+# chunks is called once per pass and must return a fresh iterable of arrays; missing values are ignored.
+# The first pass counts values into equal-width bins between lo and hi (values outside land in the end bins),
+# the second keeps only the values in the bins holding the two order statistics the quantile lies between.
+# Chunks of 2-D arrays give one quantile per column, with q, lo and hi either shared or given per column.
+def chunked_quantile(chunks, q, lo, hi, bins=4096):
+  columns = None
+  counts = None
+  for x in chunks():
+    x = np.asarray(x, dtype='float64')
+    if columns is None:
+      columns = x.ndim==2
+      k = x.shape[1] if columns else 1
+      q, lo, hi = (np.broadcast_to(np.asarray(v, dtype='float64'), (k,)) for v in (q, lo, hi))
+      scale = np.where(hi>lo, bins/np.where(hi>lo, hi-lo, 1), 0.0)
+      counts = np.zeros((k, bins), dtype='int64')
+    x = x.reshape(len(x), -1)
+    col, b = _bin_values(x, lo, scale, bins)
+    counts += np.bincount(col*bins + b, minlength=k*bins).reshape(k, bins)
+  if counts is None:
+    return np.nan
+
+  n = counts.sum(axis=1)
+  h = (n-1)*q
+  lower_rank, upper_rank = np.floor(h).astype('int64'), np.ceil(h).astype('int64')
+  cum = np.cumsum(counts, axis=1)
+  first_bin = np.array([np.searchsorted(cum[j], lower_rank[j], side='right') for j in range(k)])
+  last_bin = np.array([np.searchsorted(cum[j], upper_rank[j], side='right') for j in range(k)])
+  skipped = np.array([cum[j, first_bin[j]-1] if 0<first_bin[j]<=bins else 0 for j in range(k)])
+
+  kept = [[] for j in range(k)]
+  for x in chunks():
+    x = np.asarray(x, dtype='float64').reshape(len(x), -1)
+    col, b = _bin_values(x, lo, scale, bins)
+    values = x[~np.isnan(x)] #row-major, the same order as col and b
+    keep = (b>=first_bin[col]) & (b<=last_bin[col])
+    order = np.argsort(col[keep], kind='stable')
+    ends = np.searchsorted(col[keep][order], np.arange(k), side='right')
+    for j, part in enumerate(np.split(values[keep][order], ends[:-1])):
+      kept[j].append(part)
+
+  result = np.full(k, np.nan)
+  for j in range(k):
+    if n[j]==0:
+      continue
+    values = np.sort(np.concatenate(kept[j]))
+    lower, upper = values[lower_rank[j]-skipped[j]], values[upper_rank[j]-skipped[j]]
+    result[j] = lower + (upper-lower)*(h[j]-lower_rank[j])
+  return result if columns else result[0]
+
+#Column and bin of every non-missing value of a 2-D array, in row-major order
+def _bin_values(x, lo, scale, bins):
+  rows, col = np.nonzero(~np.isnan(x))
+  b = np.clip(np.floor((x[rows, col]-lo[col])*scale[col]), 0, bins-1).astype('int64')
+  return col, b
+
+############################# ID allocation ######################################
+
+# Unique, random looking IDs without materialising the ID space.
+# Ordinals 0..n-1 go through a keyed Feistel permutation of [0, 4^k) and are cycle-walked back into [0, size),
+# which makes the mapping a bijection: distinct ordinals always get distinct IDs, whichever shard or chunk asks for them.
+# IDs have exactly `width` digits, as the six digit customer, account and inquiry numbers always had.
+
+def id_width(count, min_width=6):
+  width = min_width
+  while 9*10**(width-1) < count:
+    width += 1
+  return width
+
+def id_key(seed_seq, rounds=4):
+  return seed_seq.generate_state(rounds, dtype=np.uint64)
+
+def _mix(z):
+  #splitmix64 finalizer, wrapping uint64 arithmetic
+  z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+  z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+  return z ^ (z >> np.uint64(31))
+
+def _feistel(x, half_bits, key):
+  shift = np.uint64(half_bits)
+  mask = np.uint64((1<<half_bits)-1)
+  left, right = x >> shift, x & mask
+  for round_key in key:
+    left, right = right, left ^ (_mix(right ^ round_key) & mask)
+  return (left << shift) | right
+
+def _feistel_inverse(x, half_bits, key):
+  shift = np.uint64(half_bits)
+  mask = np.uint64((1<<half_bits)-1)
+  left, right = x >> shift, x & mask
+  for round_key in key[::-1]:
+    left, right = right ^ (_mix(left ^ round_key) & mask), left
+  return (left << shift) | right
+
+def permute_ordinals(ordinals, size, key):
+  half_bits = max(1, (int(size-1).bit_length()+1)//2)
+  x = np.asarray(ordinals, dtype=np.uint64)
+  if x.size and int(x.max())>=size:
+    raise ValueError("Ordinal out of range for an ID space of %d" % size)
+  x = _feistel(x, half_bits, key)
+  outside = x>=size
+  while outside.any():
+    x[outside] = _feistel(x[outside], half_bits, key)
+    outside = x>=size
+  return x.astype('int64')
+
+#The ordinals permute_ordinals maps to values; walking back through the cycle ends at the ordinal since it is in range
+def unpermute_ordinals(values, size, key):
+  half_bits = max(1, (int(size-1).bit_length()+1)//2)
+  x = np.asarray(values, dtype=np.uint64)
+  if x.size and int(x.max())>=size:
+    raise ValueError("Value out of range for an ID space of %d" % size)
+  x = _feistel_inverse(x, half_bits, key)
+  outside = x>=size
+  while outside.any():
+    x[outside] = _feistel_inverse(x[outside], half_bits, key)
+    outside = x>=size
+  return x.astype('int64')
+
+def allocate_ids(ordinals, width, key):
+  lo = 10**(width-1)
+  return lo + permute_ordinals(ordinals, 9*lo, key)
+
+#Ordinals of IDs allocate_ids handed out; ValueError for numbers without `width` digits
+def id_ordinals(ids, width, key):
+  lo = 10**(width-1)
+  ids = np.asarray(ids, dtype='int64')
+  if ids.size and (ids.min()<lo or ids.max()>=10*lo):
+    raise ValueError("IDs must have %d digits" % width)
+  return unpermute_ordinals(ids-lo, 9*lo, key)
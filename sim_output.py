@@ -0,0 +1,213 @@
+import os
+import queue
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+
+try:
+  import pyarrow as pa
+  import pyarrow.compute as pc
+  import pyarrow.parquet as pq
+  import pyarrow.feather as feather
+except ImportError:
+  pa = None
+
+# Output writers for the simulated tables
+# CSV, the default, keeps the single file layout: each shard writes a part file and the parts are concatenated in shard order.
+# Parquet and Feather (Arrow IPC) write a dataset directory per table holding one part file per shard. With partitions,
+# rows are split into CustID hash buckets (bucket=NNN subdirectories), the same buckets for every table, so joins can be co-partitioned.
+# A run that appends to earlier output numbers its parts on from first_part: CSV rows are added to the end of the files,
+# datasets get new part files, and what is already there is left as it is.
+
+# CSV is written by write_csv, which produces the same bytes as DataFrame.to_csv with its defaults but formats
+# whole columns at once: categories, dates and other repeated values are formatted once per distinct value
+# and rows are joined in blocks, so a part is streamed out without building a table of Python objects.
+# Parts can be written on a background thread, see start_writer.
+
+formats = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+#output: dict with the format, number of partitions, shard work directory and output directory of a run,
+#the number of parts earlier runs wrote to the output, 0 unless appending, and the tables' ID columns
+def output_config(fmt, partitions, work_dir, out_dir, first_part=0, id_columns=("CustID",)):
+  if fmt not in formats:
+    raise ValueError("Unknown output format: "+str(fmt))
+  if fmt!="csv" and pa is None:
+    raise ImportError("pyarrow is required to write %s output" % fmt)
+  return {"format": fmt, "partitions": partitions, "work_dir": work_dir, "out_dir": out_dir, "first_part": first_part,
+    "id_columns": list(id_columns)}
+
+def shard_path(work_dir, index, name):
+  return os.path.join(work_dir, "shard_%06d_%s" % (index, name))
+
+def custid_bucket(custids, partitions):
+  #pandas' array hash uses a fixed key, so buckets are stable across runs and processes
+  return (pd.util.hash_array(np.asarray(custids, dtype=object)) % np.uint64(partitions)).astype('int64')
+
+#Enumerated text columns become dictionaries, IDs stay plain strings, and dates become date32
+def to_arrow(frame, id_columns):
+  frame = frame.assign(**{col: frame[col].astype('category') for col in frame.columns
+    if col not in id_columns and pd.api.types.infer_dtype(frame[col], skipna=True)=="string"})
+  table = pa.Table.from_pandas(frame, preserve_index=False)
+  for i, field in enumerate(table.schema):
+    if pa.types.is_timestamp(field.type):
+      table = table.set_column(i, field.name, table.column(i).cast(pa.date32()))
+  return table
+
+def write_arrow(table, directory, index, fmt):
+  os.makedirs(directory, exist_ok=True)
+  path = os.path.join(directory, "part-%06d%s" % (index, formats[fmt]))
+  if fmt=="parquet":
+    pq.write_table(table, path)
+  else:
+    feather.write_feather(table, path)
+  return os.path.getsize(path)
+
+#Removes what an earlier run left for this table so the dataset only holds this run's parts, unless appending
+def prepare_table(name, output):
+  if output["format"]!="csv" and not output["first_part"]:
+    dataset = os.path.join(output["out_dir"], name)
+    if os.path.isdir(dataset):
+      shutil.rmtree(dataset)
+
+############################# CSV ######################################
+
+csv_block_rows = 65536
+csv_special = [",", '"', "\r", "\n"] #fields holding any of these are quoted, as the csv module's QUOTE_MINIMAL does
+
+def csv_quote(text):
+  joined = "".join(text)
+  if not any(ch in joined for ch in csv_special):
+    return text
+  return np.array(['"'+t.replace('"','""')+'"' if any(ch in t for ch in csv_special) else t for t in text], dtype=object)
+
+#Formats the distinct values of x with fmt when there are few of them; missing values (NaN, NaT, NA) become empty fields
+def by_value(x, fmt):
+  codes, uniques = pd.factorize(x)
+  if len(uniques)*2 < len(codes):
+    return np.append(np.asarray(fmt(uniques), dtype=object), "")[codes]
+  text = np.asarray(fmt(x), dtype=object)
+  text[codes<0] = ""
+  return text
+
+def format_dates(x):
+  x = np.asarray(x, dtype='datetime64[s]')
+  present = x[~np.isnat(x)]
+  #Dates only when every value is midnight, like pandas
+  if (present.astype('int64') % 86400 == 0).all():
+    return np.datetime_as_string(x, unit='D')
+  return np.char.replace(np.datetime_as_string(x, unit='s'), "T", " ")
+
+#numpy's str of each float; with pyarrow, Arrow's faster cast gives the same shortest digits, and where its notation
+#could differ (integral values, exponents) numpy formats those values itself
+def format_floats(x):
+  x = np.asarray(x)
+  if pa is None:
+    return x.astype(str)
+  text = pc.cast(pa.array(x), pa.string()).to_numpy(zero_copy_only=False)
+  magnitude = np.abs(x)
+  other = (magnitude<1e-3) | (magnitude>=1e6) | np.isnan(x) | (x==np.floor(x))
+  text[other] = x[other].astype(str)
+  return text
+
+def csv_supported(dtype):
+  if isinstance(dtype, pd.CategoricalDtype):
+    return csv_supported(dtype.categories.dtype)
+  return dtype.kind in "biufM" or pd.api.types.is_string_dtype(dtype)
+
+#Text of each value as to_csv writes it; numbers as numpy's str, which is what to_csv uses without a float_format
+def csv_text(values):
+  dtype = values.dtype
+  if isinstance(dtype, pd.CategoricalDtype):
+    return np.append(csv_text(pd.Series(dtype.categories)), "")[values.cat.codes.to_numpy()]
+  if dtype.kind=="M":
+    return by_value(values.to_numpy(), format_dates)
+  if isinstance(dtype, np.dtype) and dtype.kind=="f":
+    return by_value(values.to_numpy(), format_floats)
+  if isinstance(dtype, np.dtype) and dtype.kind in "biu":
+    return by_value(values.to_numpy(), lambda x: np.asarray(x).astype(str))
+  if dtype.kind in "iu": #nullable integers
+    return by_value(values.array, lambda x: np.asarray(x.to_numpy(dtype='int64', na_value=0)).astype(str))
+  #strings
+  return csv_quote(values.to_numpy(dtype=object, na_value=""))
+
+#Writes frame as frame.to_csv(path, index=index, header=header) would and returns the number of bytes written
+def write_csv(frame, path, index=False, header=True):
+  columns = ([pd.Series(frame.index)] if index else []) + [frame.iloc[:, i] for i in range(frame.shape[1])]
+  if isinstance(frame.index, pd.MultiIndex) or not all(csv_supported(col.dtype) for col in columns):
+    frame.to_csv(path, index=index, header=header)
+    return os.path.getsize(path)
+  with open(path, "wb") as f:
+    if header:
+      names = ([frame.index.name if frame.index.name is not None else ""] if index else []) + [str(name) for name in frame.columns]
+      f.write((",".join(csv_quote(names))+os.linesep).encode())
+    for start in range(0, len(frame), csv_block_rows):
+      block = [csv_text(col.iloc[start:start+csv_block_rows]) for col in columns]
+      if len(block)==1:
+        block[0][block[0]==""] = '""' #a row of one empty field is quoted, so it is not read as a blank line
+      f.write("".join([",".join(row)+os.linesep for row in zip(*block)]).encode())
+    return f.tell()
+
+############################# Parts ######################################
+
+#Returns the number of bytes written
+def write_part(frame, name, index, output, csv_index=False):
+  fmt = output["format"]
+  part = output["first_part"]+index
+  if fmt=="csv":
+    return write_csv(frame, shard_path(output["work_dir"], index, name+".csv"), index=csv_index, header=part==0)
+  table = to_arrow(frame, output["id_columns"])
+  dataset = os.path.join(output["out_dir"], name)
+  if output["partitions"]:
+    buckets = custid_bucket(frame["CustID"], output["partitions"])
+    return sum(write_arrow(table.filter(pa.array(buckets==bucket)), os.path.join(dataset, "bucket=%03d" % bucket), part, fmt)
+      for bucket in np.unique(buckets))
+  return write_arrow(table, dataset, part, fmt)
+
+############################# Background writer ######################################
+
+# A writer runs queued jobs, e.g. writing a part, one at a time on a background thread, so a shard can go on simulating
+# while the tables it has finished are serialized. The queue is bounded: submitting blocks while write_queue jobs
+# are waiting, which caps how many finished tables are held in memory. stop_writer waits for the queue to drain
+# and raises the first error a job raised. Without a writer, submit runs the job at once.
+
+write_queue = 2
+
+def start_writer(depth=write_queue):
+  writer = {"queue": queue.Queue(maxsize=depth), "errors": []}
+  writer["thread"] = threading.Thread(target=run_writer, args=(writer,), daemon=True)
+  writer["thread"].start()
+  return writer
+
+def run_writer(writer):
+  while True:
+    job = writer["queue"].get()
+    if job is None:
+      return
+    try:
+      job()
+    except Exception as e:
+      writer["errors"].append(e)
+
+def submit(writer, job):
+  if writer is None:
+    job()
+  else:
+    writer["queue"].put(job)
+
+def stop_writer(writer):
+  writer["queue"].put(None)
+  writer["thread"].join()
+  if writer["errors"]:
+    raise writer["errors"][0]
+
+#Returns the number of bytes added to the CSV file
+def finish_table(name, nShards, output):
+  if output["format"]!="csv":
+    return 0
+  with open(os.path.join(output["out_dir"], name+".csv"), 'ab' if output["first_part"] else 'wb') as out:
+    start = out.tell()
+    for index in range(nShards):
+      with open(shard_path(output["work_dir"], index, name+".csv"), 'rb') as part:
+        shutil.copyfileobj(part, out)
+    return out.tell()-start
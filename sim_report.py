@@ -0,0 +1,96 @@
+import os
+import glob
+import json
+import time
+import logging
+import cProfile
+import pstats
+import resource
+import contextlib
+
+# Instrumentation for simulation runs
+# Every stage of a run records its wall time, CPU time, rows in and out, peak memory and bytes written,
+# logs a line when it finishes and is summarised in a JSON run report written next to the outputs.
+# Peak memory is the peak resident set size during the stage: on Linux the peak is reset when a stage starts
+# (/proc/self/clear_refs), elsewhere it is the peak of the process so far.
+# A stage named for profiling runs under cProfile; its stats are dumped per call and merged into one file per run.
+# A stage run on a background thread next to another one passes reset=False, so that it does not clear the other's
+# peak; its peak is then the process' since the stage it runs next to started.
+
+log = logging.getLogger("bureau_data_simulation")
+
+#report: the stage records of one process, e.g. one shard, plus which stage to profile and where to dump its stats
+def new_report(profile=None, profile_dir=None, shard=None):
+  return {"shard": shard, "profile": profile, "profile_dir": profile_dir, "stages": []}
+
+def reset_peak():
+  try:
+    with open("/proc/self/clear_refs", "w") as f:
+      f.write("5")
+  except OSError:
+    pass
+
+def peak_rss_mb():
+  try:
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1])/1024
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 #kilobytes on Linux
+
+#Yields the stage record, so the stage can fill in rows_out and bytes_written
+@contextlib.contextmanager
+def stage(report, name, rows_in=None, reset=True):
+  record = {"stage": name, "shard": report["shard"], "rows_in": rows_in, "rows_out": None, "bytes_written": 0}
+  profiler = cProfile.Profile() if report["profile"]==name else None
+  if reset:
+    reset_peak()
+  wall, cpu = time.perf_counter(), time.process_time()
+  if profiler is not None:
+    profiler.enable()
+  try:
+    yield record
+  finally:
+    if profiler is not None:
+      profiler.disable()
+    record["wall_s"] = time.perf_counter()-wall
+    record["cpu_s"] = time.process_time()-cpu
+    record["peak_rss_mb"] = peak_rss_mb()
+    report["stages"].append(record)
+    if profiler is not None:
+      nProfiles = sum(r["stage"]==name for r in report["stages"])
+      profiler.dump_stats(os.path.join(report["profile_dir"], "profile_%s_%s_%d.prof" % (name, report["shard"], nProfiles)))
+    rows = record["rows_out"] if record["rows_out"] is not None else record["rows_in"]
+    done = ([] if rows is None else ["%d rows" % rows]) + (["%d bytes" % record["bytes_written"]] if record["bytes_written"] else [])
+    log.info("%s%s: %sin %.2fs%s", name, "" if report["shard"] is None else " [shard %d]" % report["shard"],
+      "".join(d+" " for d in done), record["wall_s"], " (cached)" if record.get("cache")=="hit" else "")
+
+#Totals per stage, in the order stages first ran; peak memory is the largest of any call
+def summarize(records):
+  totals = {}
+  for r in records:
+    t = totals.setdefault(r["stage"], {"calls": 0, "cache_hits": 0, "wall_s": 0.0, "cpu_s": 0.0, "rows_in": 0, "rows_out": 0, "peak_rss_mb": 0.0, "bytes_written": 0})
+    t["calls"] += 1
+    t["cache_hits"] += r.get("cache")=="hit"
+    for key in ("wall_s","cpu_s","rows_in","rows_out","bytes_written"):
+      t[key] += r[key] or 0
+    t["peak_rss_mb"] = max(t["peak_rss_mb"], r["peak_rss_mb"])
+  return totals
+
+def merge_profiles(profile_dir, name, out_path):
+  files = sorted(glob.glob(os.path.join(profile_dir, "profile_%s_*.prof" % name)))
+  if not files:
+    return None
+  pstats.Stats(*files).dump_stats(out_path)
+  return out_path
+
+def process_usage():
+  own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+  return {"cpu_s": own.ru_utime+own.ru_stime+children.ru_utime+children.ru_stime,
+    "peak_rss_mb": max(own.ru_maxrss, children.ru_maxrss)/1024}
+
+def write_report(path, run, records):
+  with open(path, "w") as f:
+    json.dump({"run": run, "stages": summarize(records), "calls": records}, f, indent=2, default=float)
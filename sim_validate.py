@@ -0,0 +1,125 @@
+import json
+import numpy as np
+import pandas as pd
+from sim_report import log
+
+# Distribution checks of the simulated tables from mergeable summaries.
+# A table is summarized a chunk at a time, as a shard produces it or as a reader streams it back from disk, and the
+# summaries of chunks or shards merge into the summary of the whole table, so no more than a chunk is ever in memory.
+# A column's summary counts its missing values, and then the rows of each value for text and categorical columns,
+# or keeps a quantile sketch of numeric ones; IDs and dates only count missing values.
+# A sketch holds the distinct values with their weights. Past 2*sketch_size of them it is compacted into sketch_size
+# buckets of equal weight, each kept as its weighted mean, which keeps the mean exact and moves ranks by at most
+# 1/sketch_size per compaction; low cardinality columns, like rounded incomes or 0/1 flags, stay exact.
+# Checks compare a summary with the configured distribution, see check_summary.
+
+sketch_size = 2048
+check_se = 4 #standard errors of sampling noise a check allows, beyond its tolerance
+
+def new_sketch(values=()):
+  values, weights = np.unique(np.asarray(values, dtype='float64'), return_counts=True)
+  return {"values": values, "weights": weights.astype('float64')}
+
+def merge_sketches(a, b):
+  values, inverse = np.unique(np.concatenate([a["values"], b["values"]]), return_inverse=True)
+  weights = np.bincount(inverse, np.concatenate([a["weights"], b["weights"]]))
+  if len(values) > 2*sketch_size:
+    cum = np.cumsum(weights)
+    bucket = np.minimum(((cum-weights)*sketch_size/cum[-1]).astype('int64'), sketch_size-1)
+    totals = np.bincount(bucket, weights, minlength=sketch_size)
+    keep = totals>0
+    values = (np.bincount(bucket, weights*values, minlength=sketch_size)[keep]/totals[keep])
+    weights = totals[keep]
+  return {"values": values, "weights": weights}
+
+#Share of the values at or below x
+def sketch_cdf(sketch, x):
+  return sketch["weights"][sketch["values"]<=x].sum()/sketch["weights"].sum()
+
+def sketch_mean(sketch):
+  return np.average(sketch["values"], weights=sketch["weights"])
+
+def column_summary(col, values, id_columns=()):
+  summary = {"nulls": int(values.isna().sum())}
+  dtype = values.dtype
+  if col in id_columns or dtype.kind=="M":
+    return summary
+  if isinstance(dtype, pd.CategoricalDtype) or dtype.kind not in "biuf":
+    summary["counts"] = values.value_counts().to_dict()
+  else:
+    summary["sketch"] = new_sketch(values.to_numpy(dtype='float64', na_value=np.nan)[values.notna().to_numpy()])
+  return summary
+
+#Summary of a table, or of a chunk of one; id_columns: the columns holding IDs
+def summarize(frame, id_columns=()):
+  return {"rows": len(frame), "columns": {col: column_summary(col, frame[col], id_columns) for col in frame.columns}}
+
+def merge_summaries(a, b):
+  if a is None:
+    return b
+  columns = dict(a["columns"])
+  for col, s in b["columns"].items():
+    if col not in columns:
+      columns[col] = s
+      continue
+    merged = {"nulls": columns[col]["nulls"]+s["nulls"]}
+    if "counts" in s:
+      merged["counts"] = dict(columns[col]["counts"])
+      for value, count in s["counts"].items():
+        merged["counts"][value] = merged["counts"].get(value, 0)+count
+    if "sketch" in s:
+      merged["sketch"] = merge_sketches(columns[col]["sketch"], s["sketch"])
+    columns[col] = merged
+  return {"rows": a["rows"]+b["rows"], "columns": columns}
+
+############################# Checks ######################################
+
+# A check is (table, column, kind, expected, tolerance), of the kinds
+#   "shares": expected maps values to their share of the column's non-missing values
+#   "mean":   expected is the mean of the non-missing values, e.g. the rate of a 0/1 flag
+#   "cdf":    expected maps values x to the share of non-missing values at or below x
+# Each expected number passes when the observed one is within the tolerance, widened to check_se standard errors
+# of sampling noise for small tables. Every column's missing share is reported alongside.
+
+def check_result(table, column, kind, value, expected, observed, n, tolerance, se):
+  tolerance = max(tolerance, check_se*se/np.sqrt(max(n, 1)))
+  ok = observed is not None and abs(observed-expected)<=tolerance
+  return {"table": table, "column": column, "check": kind, "value": value, "expected": float(expected),
+    "observed": None if observed is None else float(observed), "tolerance": float(tolerance), "ok": bool(ok)}
+
+#Results of one check against a table's summary, one per expected number
+def check_summary(summary, check):
+  table, column, kind, expected, tolerance = check
+  s = (summary or {"columns": {}})["columns"].get(column)
+  if kind=="shares":
+    counts = (s or {}).get("counts")
+    n = sum(counts.values()) if counts else 0
+    return [check_result(table, column, kind, value, p, counts.get(value, 0)/n if n else None, n, tolerance, np.sqrt(p*(1-p)))
+      for value, p in expected.items()]
+  sketch = (s or {}).get("sketch")
+  n = sketch["weights"].sum() if sketch is not None and len(sketch["weights"]) else 0
+  if kind=="mean":
+    sd = np.sqrt(np.average((sketch["values"]-expected)**2, weights=sketch["weights"])) if n else 0
+    return [check_result(table, column, kind, None, expected, sketch_mean(sketch) if n else None, n, tolerance, sd)]
+  if kind=="cdf":
+    return [check_result(table, column, kind, x, p, sketch_cdf(sketch, x) if n else None, n, tolerance, np.sqrt(p*(1-p)))
+      for x, p in expected.items()]
+  raise ValueError("Unknown check kind: "+str(kind))
+
+#summaries: table name -> summary
+def validation_report(summaries, checks):
+  results = [r for check in checks for r in check_summary(summaries.get(check[0]), check)]
+  missing = {table: {col: s["nulls"]/summary["rows"] if summary["rows"] else 0.0 for col, s in summary["columns"].items()}
+    for table, summary in summaries.items()}
+  return {"checks": results, "failed": sum(not r["ok"] for r in results), "missing_share": missing,
+    "rows": {table: summary["rows"] for table, summary in summaries.items()}}
+
+#Writes the report as JSON and logs the checks that failed
+def write_validation(path, report):
+  for r in report["checks"]:
+    if not r["ok"]:
+      log.warning("Validation failed: %s %s %s %s expected %.4g, observed %s (tolerance %.4g)", r["table"], r["column"], r["check"],
+        "" if r["value"] is None else r["value"], r["expected"], r["observed"], r["tolerance"])
+  log.info("Validation: %d of %d checks passed, see %s", len(report["checks"])-report["failed"], len(report["checks"]), path)
+  with open(path, "w") as f:
+    json.dump(report, f, indent=2, default=float)
@@ -0,0 +1,540 @@
+import re
+import json
+import hashlib
+import io
+import importlib.util
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import kstest, chi2_contingency, poisson
+import bureau_data_simulation as sim
+from sim_engine import band_ranges, group_agg, chunked_quantile, id_key, allocate_ids, id_ordinals, sample_conditional, keyed_rand, uniform
+from sim_output import write_csv
+import feature_baseline
+import sim_validate
+import validate_output
+
+# Checks that the vectorized pipeline keeps the behaviour of the code it replaced.
+# Run with python -m pytest -q from the repository root.
+
+############################# Score bands ######################################
+
+# The if/elif chains the band tables replaced, returning the (lo, hi) range of the score or None when it stays missing
+
+def old_inc(x):
+  if x<20000: return (14,15)
+  elif 20000<=x<30000: return (11,12)
+  elif 30000<=x<40000: return (8,10)
+  elif 40000<=x<50000: return (6,7)
+  elif 50000<=x<60000: return (5,6)
+  elif 60000<=x<70000: return (4,5)
+  elif 70000<=x<80000: return (3,4)
+  elif 80000<=x<90000: return (1,2)
+  else: return (0,0.5)
+
+def old_num_tl(x):
+  if x==0: return (6,10)
+  elif 0<x<3: return (0,4)
+  elif 3<=x<5: return (2,5)
+  else: return (3,6)
+
+def old_creditor_numunique(x):
+  if x==1: return (0,3)
+  elif x==2: return (1,4)
+  elif x==3: return (3,7)
+  else: return (4,9)
+
+def old_credit_limit(x):
+  if x==None: return (0,4)
+  elif x<3000: return (4,9)
+  elif 3000<=x<4000: return (3,6)
+  elif 4000<=x<5000: return (1,5)
+  else: return (0,3)
+
+def old_num_inq(x):
+  if x==None or x==0: return (0,3)
+  elif x==1: return (0,5)
+  elif 1<x<4: return (1,6)
+  elif x>4: return (3,8)
+  else: return (0,4)
+
+def old_inq_type_numunique(x):
+  if x==None or x==0: return (0,4)
+  elif 1<x<4: return (2,7)
+  elif x>=4: return (5,9)
+
+def old_appdec_numunique(x):
+  if x==None or x==0: return (0,4)
+  elif x==1: return (0,5)
+  else: return (3,7)
+
+def old_map(ranges, default=None):
+  return lambda x: ranges.get(x, default)
+
+incomes = [0, 19999.99, 20000, 29999, 30000, 45000, 50000, 59999.5, 60000, 70000, 80000, 89999, 90000, 250000, np.nan]
+limits = [0, 2999.5, 3000, 3999, 4000, 4999, 5000, 12000, np.nan]
+counts = list(range(9))
+statuses = ["single", "married", "divorced", "widowed", "other", None]
+delq = ["<30DPD", "30-60DPD", "60-90DPD", ">90DPD", "current", None]
+
+#(band table, score, values, old chain); NaN only appears where the old chain ends in a plain else
+band_cases = [
+  ("app", "inc_score", incomes, old_inc),
+  ("app", "mar_score", statuses, old_map({"single":(2,6), "married":(1,3), "divorced":(5,9), "widowed":(0,4)})),
+  ("app", "res_score", ["rent", "mortgage", "house_owner", "other"], old_map({"rent":(4,9), "mortgage":(2,7), "house_owner":(0,5)})),
+  ("app", "purpose_score", ["auto", "education", "personal loan", "business", "debt_consolidation", "personal"],
+    old_map({"education":(0,1), "debt_consolidation":(5,7), "auto":(2,4), "personal":(8,10)}, (12,15))),
+  ("tl", "num_tl_score", counts+[np.nan], old_num_tl),
+  ("tl", "account_type_mostfreq_score", ["revolving", "mortgage", "instalment", None], old_map({"revolving":(2,7), "mortgage":(3,5)}, (1,4))),
+  ("tl", "creditor_numunique_score", counts+[np.nan], old_creditor_numunique),
+  ("tl", "creditor_mostfreq_score", ["ABC Bank", "Bank of XYZ", "Cooperative Capital", "Other Bank"],
+    old_map({"ABC Bank":(1,6), "Bank of XYZ":(1,6), "Cooperative Capital":(1,6)}, (5,10))),
+  ("tl", "credit_limit_avg_score", limits, old_credit_limit),
+  ("tl", "curr_delq_mostfreq_score", delq, old_map({"<30DPD":(0,3), "30-60DPD":(1,5), "60-90DPD":(3,6), ">90DPD":(5,9)}, (1,5))),
+  ("tl", "worst_delq_mostfreq_score", delq, old_map({"<30DPD":(0,3), "30-60DPD":(1,5), "60-90DPD":(3,6), ">90DPD":(5,9)}, (1,5))),
+  ("inq", "num_inq_score", counts, old_num_inq),
+  ("inq", "appdec_mf_score", ["approved", "declined"], old_map({"approved":(0,5)}, (3,8))),
+  ("inq", "inq_type_numunique_score", counts, old_inq_type_numunique),
+  ("inq", "application_decision_numunique_score", counts+[np.nan], old_appdec_numunique),
+  ("inq", "inq_type_mostfreq_score", ["revolving", "instalment", "mortgage", "rental_application", "auto"],
+    old_map({"revolving":(3,8), "instalment":(1,5), "mortgage":(2,7), "rental_application":(0,4)}, (2,5))),
+]
+
+def score_bands(table):
+  return {"app": sim.app_score_bands, "tl": sim.tl_score_bands, "inq": sim.inq_score_bands}[table]
+
+@pytest.mark.parametrize("table, score, values, old", band_cases, ids=[case[1] for case in band_cases])
+def test_band_ranges_match_old_chains(table, score, values, old):
+  entry = score_bands(table)[score]
+  lo, hi = band_ranges(pd.Series(values, dtype=object if isinstance(values[0], str) else 'float64'), entry[1], *entry[2:])
+  ranges = [old(v) for v in values]
+  np.testing.assert_array_equal(lo, [np.nan if r is None else r[0] for r in ranges])
+  np.testing.assert_array_equal(hi, [np.nan if r is None else r[1] for r in ranges])
+
+def test_missing_values_fall_in_last_band():
+  lo, hi = band_ranges([np.nan], sim.app_score_bands["inc_score"][1])
+  assert (lo[0], hi[0])==(0, 0.5)
+  lo, hi = band_ranges([np.nan], sim.tl_score_bands["credit_limit_avg_score"][1])
+  assert (lo[0], hi[0])==(0, 3)
+
+def test_single_inquiry_type_keeps_score_missing():
+  lo, hi = band_ranges([1, 2], sim.inq_score_bands["inq_type_numunique_score"][1])
+  assert np.isnan(lo[0]) and np.isnan(hi[0])
+  assert (lo[1], hi[1])==(2, 7)
+
+############################# Conditional sampling ######################################
+
+def test_sample_conditional_matches_each_row():
+  P = np.array([[0.5,0.3,0.2,0.0], [0.1,0.2,0.3,0.4], [0.0,0.0,1.0,0.0], [0.25,0.25,0.25,0.25]])
+  rng = np.random.default_rng(13)
+  parent = rng.permutation(np.repeat(np.arange(len(P)), 50000))
+  codes = sample_conditional(parent, P, rng.random(len(parent)))
+  for i, p in enumerate(P):
+    n = (parent==i).sum()
+    freq = np.bincount(codes[parent==i], minlength=P.shape[1])/n
+    #Within five standard errors, and exact where a category is impossible or certain
+    assert (np.abs(freq-p)<=5*np.sqrt(p*(1-p)/n)).all(), (i, freq)
+
+############################# Group aggregation ######################################
+
+# The groupby lambdas group_agg replaced
+def lambda_mode(frame, column, fill=None):
+  return frame[["CustID",column]].groupby("CustID").agg(lambda x: x.value_counts().index[0] if len(x.value_counts())>0 else fill)[column]
+
+def lambda_nunique(frame, column):
+  return frame[["CustID",column]].groupby("CustID").agg(lambda x: len(x.unique()))[column]
+
+def agg_frame(n=3000):
+  rng = np.random.default_rng(9)
+  #About four rows per customer, so many modes are ties
+  frame = pd.DataFrame({
+    "CustID": ["C"+str(s) for s in rng.integers(100000, 100800, n)],
+    "few": rng.choice(["a","b","c","d"], n),
+    "many": [str(s) for s in rng.integers(0, 2000, n)],
+    "missing": pd.Series(rng.choice(["<30DPD","30-60DPD",">90DPD"], n), dtype=object),
+  })
+  frame.loc[rng.random(n)<0.3, "missing"] = None
+  frame.loc[frame["CustID"]<"C100100", "missing"] = None
+  return frame
+
+#Categorical columns must aggregate like the object columns the lambdas saw
+@pytest.mark.parametrize("categorical", [False, True])
+def test_group_agg_matches_groupby_lambdas(categorical):
+  frame = agg_frame()
+  typed = frame.astype({"few": "category", "many": "category", "missing": "category"}) if categorical else frame
+  rows = group_agg(typed, "CustID", [
+    ("few_mostfreq", "few", "mode"), ("few_numunique", "few", "nunique"),
+    ("many_mostfreq", "many", "mode"), ("many_numunique", "many", "nunique"),
+    ("missing_mostfreq", "missing", "mode", "NA"),
+  ])
+  assert list(rows["CustID"])==sorted(frame["CustID"].unique())
+  for column in ["few", "many"]:
+    assert list(rows[column+"_mostfreq"].astype(object))==list(lambda_mode(frame, column))
+    assert list(rows[column+"_numunique"])==list(lambda_nunique(frame, column))
+  expected = lambda_mode(frame, "missing", "NA")
+  assert (expected=="NA").sum()>=100
+  assert list(rows["missing_mostfreq"].astype(object))==list(expected)
+
+############################# Chunked quantiles ######################################
+
+@pytest.mark.parametrize("q", [0.0, 0.1, 0.5, 0.9, 0.999, 1.0])
+def test_chunked_quantile_matches_pandas(q):
+  rng = np.random.default_rng(11)
+  values = np.concatenate([rng.normal(0.5, 0.2, 20000), rng.random(5000), [np.nan]*50])
+  rng.shuffle(values)
+  chunks = np.array_split(values, 7)
+  assert chunked_quantile(lambda: chunks, q, 0, 1) == pd.Series(values).quantile(q)
+
+def test_chunked_quantile_per_column():
+  rng = np.random.default_rng(12)
+  values = rng.gamma(2, 1, (3000, 3))
+  values[rng.random(values.shape)<0.05] = np.nan
+  q = np.array([0.1, 0.5, 0.9])
+  result = chunked_quantile(lambda: np.array_split(values, 4), q, 0, 20)
+  assert list(result)==[pd.Series(values[:, j]).quantile(q[j]) for j in range(3)]
+
+############################# IDs ######################################
+
+@pytest.mark.parametrize("width, n", [(6, 5000), (6, 900000), (7, 20000)])
+def test_ids_are_a_bijection_that_round_trips(width, n):
+  key = id_key(np.random.SeedSequence(3))
+  ordinals = np.arange(n) if n<=20000 else np.random.default_rng(5).choice(9*10**(width-1), 20000, replace=False)
+  ids = allocate_ids(ordinals, width, key)
+  assert len(np.unique(ids))==len(ids)
+  assert ids.min()>=10**(width-1) and ids.max()<10**width
+  assert (id_ordinals(ids, width, key)==ordinals).all()
+  #Any split of the ordinals gets the same IDs
+  assert (np.concatenate([allocate_ids(part, width, key) for part in np.array_split(ordinals, 3)])==ids).all()
+
+def test_id_space_is_a_permutation():
+  key = id_key(np.random.SeedSequence(4))
+  ids = allocate_ids(np.arange(9*10**5), 6, key)
+  assert (np.sort(ids)==np.arange(10**5, 10**6)).all()
+
+############################# Shards ######################################
+
+def read_output(out_dir):
+  frames = {}
+  for name in sim.tables:
+    frame = pd.read_csv(out_dir/(name+".csv"), keep_default_na=False, dtype=str)
+    if frame.columns[0].startswith("Unnamed"):
+      #inq_agg's index only numbers the rows in shard order
+      frame = frame.drop(columns=frame.columns[0])
+    frames[name] = frame.sort_values(list(frame.columns[:2])).reset_index(drop=True)
+  return frames
+
+#Each customer's rows are the same for any shard size; only the order of the rows follows the shards
+def test_output_does_not_depend_on_shards(tmp_path):
+  outputs = {}
+  for chunk_size in (None, 300, 450):
+    out_dir = tmp_path/str(chunk_size)
+    out_dir.mkdir()
+    sim.main(1000, chunk_size, str(out_dir))
+    outputs[chunk_size] = read_output(out_dir)
+  for name in sim.tables:
+    assert len(outputs[None][name])>0
+    for chunk_size in (300, 450):
+      pd.testing.assert_frame_equal(outputs[chunk_size][name], outputs[None][name])
+
+#The same shards give byte-identical files for any number of workers
+def test_output_does_not_depend_on_workers(tmp_path):
+  for workers in (1, 2):
+    (tmp_path/str(workers)).mkdir()
+    sim.main(1000, 300, str(tmp_path/str(workers)), workers)
+  files = sorted(p.name for p in (tmp_path/"1").glob("*.csv"))
+  assert len(files)>=5
+  assert files==sorted(p.name for p in (tmp_path/"2").glob("*.csv"))
+  for name in files:
+    assert (tmp_path/"1"/name).read_bytes()==(tmp_path/"2"/name).read_bytes(), name
+
+############################# Stage cache ######################################
+
+#A copy of the simulation module with a comment added to the body of function, as an edit that changes nothing else
+def edited_module(tmp_path, function):
+  source = open(sim.__file__).read()
+  edited, n = re.subn(r"(?m)^(def %s\(.*\n)" % function, r"\1  #edited\n", source)
+  assert n==1
+  path = tmp_path/("edited_"+function+".py")
+  path.write_text(edited)
+  spec = importlib.util.spec_from_file_location(path.stem, path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+#Cache outcome of each simulate_/agg_ stage in a run of module
+def stage_cache(module, tmp_path, run):
+  out_dir = tmp_path/run
+  out_dir.mkdir()
+  module.main(500, None, str(out_dir), cache_dir=str(tmp_path/"cache"))
+  calls = json.loads((out_dir/"run_report.json").read_text())["calls"]
+  return {c["stage"]: c["cache"] for c in calls if c["stage"].startswith(("simulate_","agg_"))}
+
+def test_stage_cache_follows_helper_code(tmp_path):
+  first = stage_cache(sim, tmp_path, "first")
+  assert first and set(first.values())=={"miss"}
+  assert set(stage_cache(sim, tmp_path, "again").values())=={"hit"}
+  #sim_date is only called by application_dates, a column generator of the loans spec
+  assert stage_cache(edited_module(tmp_path, "sim_date"), tmp_path, "helper")["simulate_loan_apps"]=="miss"
+  #account_limits is called by account_terms, the tradeline spec's generator, and reaches no other stage
+  limits = stage_cache(edited_module(tmp_path, "account_limits"), tmp_path, "limits")
+  assert limits["simulate_tradeline"]=="miss" and limits["simulate_loan_apps"]=="hit" and limits["simulate_inq"]=="hit"
+  assert set(stage_cache(edited_module(tmp_path, "target_cutoffs"), tmp_path, "target").values())=={"hit"}
+
+############################# CSV writer ######################################
+
+def csv_frame(n=500):
+  rng = np.random.default_rng(7)
+  frame = pd.DataFrame({
+    "id": ["C"+str(s) for s in rng.integers(100000, 999999, n)],
+    "category": pd.Categorical.from_codes(rng.integers(-1, 3, n), categories=["a","b, c","NA"]),
+    "f32": np.where(rng.random(n)<0.1, np.nan, rng.normal(0, 1000, n)).astype('float32'),
+    "f64": np.where(rng.random(n)<0.1, np.nan, rng.gamma(1.7, 3, n)),
+    "i32": rng.integers(-5000, 5000, n).astype('int32'),
+    "int8": rng.integers(0, 2, n).astype('int8'),
+    "nullable": pd.arrays.IntegerArray(rng.integers(0, 8000, n).astype('int32'), rng.random(n)<0.2),
+    "date": (np.datetime64('2014-07-01','D') + rng.integers(0, 90, n)).astype('datetime64[s]'),
+    "text": pd.Series(rng.choice(['plain','with,comma','with "quote"','multi\nline',None], n), dtype=object),
+  })
+  frame.loc[frame.index[::7], "date"] = pd.NaT
+  return frame
+
+@pytest.mark.parametrize("index, header", [(False, True), (True, True), (False, False)])
+def test_write_csv_matches_to_csv(tmp_path, index, header):
+  frame = csv_frame()
+  frame.index = range(1000, 1000+len(frame))
+  nBytes = write_csv(frame, tmp_path/"fast.csv", index=index, header=header)
+  frame.to_csv(tmp_path/"pandas.csv", index=index, header=header)
+  expected = (tmp_path/"pandas.csv").read_bytes()
+  assert (tmp_path/"fast.csv").read_bytes()==expected
+  assert nBytes==len(expected)
+
+############################# Keyed draws ######################################
+
+def test_keyed_uniforms_are_uniform_and_independent():
+  n = 100000
+  rand = keyed_rand(sim.mySeed, "loans", np.arange(n))
+  draws = {name: uniform(rand, name) for name in ["inc_score", "mar_score", "app_date"]}
+  draws["other table"] = uniform(keyed_rand(sim.mySeed, "tradeline", np.arange(n)), "inc_score")
+  #Two children of each customer
+  children = uniform(keyed_rand(sim.mySeed, "tradeline", np.repeat(np.arange(n//2), 2), np.tile([0, 1], n//2)), "inc_score")
+  draws["first child"], draws["second child"] = children[::2], children[1::2]
+  for name, u in draws.items():
+    assert 0<u.min() and u.max()<1
+    assert kstest(u, "uniform").pvalue>1e-3, name
+  names = list(draws)
+  for i, a in enumerate(names):
+    for b in names[i+1:]:
+      joint = np.histogram2d(draws[a][:n//2], draws[b][:n//2], bins=10, range=[[0,1],[0,1]])[0]
+      assert chi2_contingency(joint).pvalue>1e-3, (a, b)
+  #A row's draw does not depend on which other rows are drawn with it
+  assert (uniform(keyed_rand(sim.mySeed, "loans", np.arange(500, 600)), "inc_score")==draws["inc_score"][500:600]).all()
+
+############################# Customer lookup ######################################
+
+def test_customer_ordinal_rejects_unknown_ids():
+  index = sim.customer_index(1000)
+  width, key = index["ids"]["customer"]
+  assert sim.customer_ordinal("C"+str(allocate_ids([7], width, key)[0]), index)==7
+  outside = "C"+str(allocate_ids([1000], width, key)[0])
+  for custid in ["X123456", "C12345", "C1234567", "C12a456", "C012345", "", outside]:
+    with pytest.raises(KeyError):
+      sim.customer_ordinal(custid, index)
+
+def test_customer_records_match_full_run(tmp_path, monkeypatch):
+  #Small lookup blocks, so that the customers are spread over several of them
+  monkeypatch.setattr(sim, "lookup_block", 200)
+  sim.main(1500, 500, str(tmp_path))
+  target = json.loads((tmp_path/"run_report.json").read_text())["run"]["target"]
+  index = sim.customer_index(1500)
+  full = {}
+  loans = pd.read_csv(tmp_path/"Loan Applications.csv", keep_default_na=False, dtype=str)
+  for custid in np.random.default_rng(14).choice(loans["CustID"], 40, replace=False):
+    for name, frame in sim.customer_records(custid, index, target).items():
+      if name not in full:
+        full[name] = pd.read_csv(tmp_path/(name+".csv"), keep_default_na=False, dtype=str)
+      got = pd.read_csv(io.StringIO(frame.to_csv(index=False)), keep_default_na=False, dtype=str)
+      expected = full[name][full[name]["CustID"]==custid]
+      assert list(got.columns)==list(expected.columns)
+      assert got.values.tolist()==expected.values.tolist(), (custid, name)
+
+############################# Cohorts ######################################
+
+#Table -> its ID column
+id_columns = {"Loan Applications": "CustID", "Bureau Tradeline Accounts": "account_id", "Bureau Inquiries": "inquiry_id",
+  "Bureau Public Records": "record_id", "Bureau Collections": "collection_id"}
+
+def test_append_keeps_existing_rows_and_unique_ids(tmp_path):
+  sim.main(800, 300, str(tmp_path))
+  before = {p.name: p.read_bytes() for p in tmp_path.glob("*.csv")}
+  sim.main(500, 300, str(tmp_path), append=True)
+  for name, data in before.items():
+    after = (tmp_path/name).read_bytes()
+    assert len(after)>len(data) and after.startswith(data), name
+  for name, column in id_columns.items():
+    ids = pd.read_csv(tmp_path/(name+".csv"), usecols=[column], dtype=str)[column]
+    assert ids.is_unique, name
+  assert len(pd.read_csv(tmp_path/"Loan Applications.csv"))==1300
+
+############################# Tradeline snapshots ######################################
+
+def test_last_snapshot_matches_tradeline(tmp_path):
+  sim.main(1000, 400, str(tmp_path), months=12)
+  tradeline = pd.read_csv(tmp_path/"Bureau Tradeline Accounts.csv", keep_default_na=False, dtype=str)
+  snapshots = pd.read_csv(tmp_path/"Bureau Tradeline Snapshots.csv", keep_default_na=False, dtype=str)
+  last = snapshots.sort_values(["account_id","snapshot_date"]).groupby("account_id").tail(1).set_index("account_id")
+  open_accounts = tradeline[tradeline["closed_date"]==""].set_index("account_id")
+  assert len(open_accounts)>0 and open_accounts.index.isin(last.index).all()
+  last = last.loc[open_accounts.index]
+  assert (last["delq_state"]==open_accounts["current_delq"]).all()
+  assert (last["balance"]==open_accounts["balance"]).all()
+  assert (last["utilization"]==open_accounts["utilization"]).all()
+  #Closed accounts drop out before they close
+  closed = tradeline[tradeline["closed_date"]!=""].set_index("account_id")["closed_date"]
+  snapshot_closed = snapshots[snapshots["account_id"].isin(closed.index)]
+  assert (snapshot_closed["snapshot_date"]<snapshot_closed["account_id"].map(closed)).all()
+
+############################# Point in time features ######################################
+
+def pit_tables(out_dir):
+  read = lambda name, columns: feature_baseline.read_table(str(out_dir), name, "csv", columns)
+  return (read("Loan Applications", ["CustID","app_date"]),
+    read("Bureau Tradeline Accounts", ["CustID","open_date","closed_date","credit_limit","balance","utilization"]),
+    read("Bureau Inquiries", ["CustID","inquiry_date","inquiry_type"]),
+    read("Bureau Tradeline Snapshots", ["CustID","snapshot_date","delq_state"]))
+
+#Per applicant in loans order: merge each child table with the applications and filter it window by window
+def brute_force_features(loans, tradeline, inq, snapshots):
+  features = pd.DataFrame({"CustID": loans["CustID"]})
+  def per_applicant(rows, values=None, how="size"):
+    grouped = (rows if values is None else rows[values]).groupby(rows["CustID"])
+    return grouped.agg(how).reindex(loans["CustID"]).to_numpy()
+  before = lambda rows, column, days=None: (rows[column]<rows["app_date"]) & ((rows[column]>=rows["app_date"]-pd.Timedelta(days=days)) if days else True)
+  inq = inq.merge(loans, on="CustID")
+  for days in feature_baseline.inq_windows:
+    features["inq_%dd" % days] = np.nan_to_num(per_applicant(inq[before(inq, "inquiry_date", days)]))
+  for name in sim.inq_type:
+    for days in feature_baseline.inq_windows:
+      features["inq_%s_%dd" % (name, days)] = np.nan_to_num(per_applicant(inq[before(inq, "inquiry_date", days) & (inq["inquiry_type"]==name)]))
+  tl = tradeline.merge(loans, on="CustID")
+  for days in feature_baseline.tl_open_windows:
+    features["tl_opened_%dd" % days] = np.nan_to_num(per_applicant(tl[before(tl, "open_date", days)]))
+  is_open = before(tl, "open_date") & (tl["closed_date"].isna() | (tl["closed_date"]>=tl["app_date"]))
+  features["tl_open"] = np.nan_to_num(per_applicant(tl[is_open]))
+  has_util = tl[is_open & tl["utilization"].notna()]
+  with np.errstate(invalid='ignore', divide='ignore'):
+    features["tl_open_revolving_util"] = per_applicant(has_util, "balance", "sum")/per_applicant(has_util, "credit_limit", "sum")
+  features["tl_open_util_avg"] = per_applicant(has_util, "utilization", "mean")
+  snap = snapshots.merge(loans, on="CustID")
+  for days in feature_baseline.delq_windows:
+    delinquent = snap[before(snap, "snapshot_date", days) & snap["delq_state"].isin(sim.curr_status[1:])]
+    features["delq_account_months_%dd" % days] = np.nan_to_num(per_applicant(delinquent))
+  return features
+
+def test_point_in_time_features_match_brute_force(tmp_path):
+  sim.main(1000, None, str(tmp_path), months=12)
+  loans, tradeline, inq, snapshots = pit_tables(tmp_path)
+  features = feature_baseline.point_in_time_features(loans, tradeline, inq, snapshots)
+  expected = brute_force_features(loans, tradeline, inq, snapshots)
+  assert list(features.columns)==list(expected.columns)
+  assert features["inq_90d"].sum()>0 and features["tl_open"].sum()>0 and features["delq_account_months_365d"].sum()>0
+  for column in features.columns[1:]:
+    np.testing.assert_allclose(features[column].to_numpy(dtype='float64'), expected[column].to_numpy(dtype='float64'), rtol=1e-9, err_msg=column)
+
+#Rows dated on or after app_date never count
+def test_point_in_time_features_ignore_rows_from_app_date(tmp_path):
+  sim.main(500, None, str(tmp_path), months=12)
+  loans, tradeline, inq, snapshots = pit_tables(tmp_path)
+  features = feature_baseline.point_in_time_features(loans, tradeline, inq, snapshots)
+  later = lambda frame, column, days: pd.DataFrame({"CustID": loans["CustID"], column: loans["app_date"]+pd.Timedelta(days=days)})
+  for days in (0, 1):
+    inq = pd.concat([inq, later(inq, "inquiry_date", days).assign(inquiry_type="revolving")], ignore_index=True)
+    tradeline = pd.concat([tradeline, later(tradeline, "open_date", days).assign(credit_limit=1000.0, balance=900.0, utilization=0.9)], ignore_index=True)
+    snapshots = pd.concat([snapshots, later(snapshots, "snapshot_date", days).assign(delq_state=">90DPD")], ignore_index=True)
+  pd.testing.assert_frame_equal(feature_baseline.point_in_time_features(loans, tradeline, inq, snapshots), features)
+
+############################# Validation summaries ######################################
+
+def summary_frame(n, seed=0):
+  rng = np.random.default_rng(seed)
+  return pd.DataFrame({
+    "creditor": pd.Categorical(rng.choice(["a","b","c"], n)),
+    "decision": np.where(rng.random(n)<0.1, None, rng.choice(["approved","declined","NA"], n)),
+    "months": rng.integers(0, 12, n),
+    "income": np.where(rng.random(n)<0.05, np.nan, np.round(rng.gamma(1.7, 300, n))),
+    "balance": rng.normal(1000, 300, n),
+  })
+
+def summary_in_chunks(frame, size):
+  merged = None
+  for start in range(0, len(frame), size):
+    merged = sim_validate.merge_summaries(merged, sim_validate.summarize(frame.iloc[start:start+size]))
+  return merged
+
+@pytest.mark.parametrize("size", [3, 7, 1000, 5000])
+def test_merged_summaries_match_single_pass(size):
+  frame = summary_frame(5000)
+  whole, merged = sim_validate.summarize(frame), summary_in_chunks(frame, size)
+  assert merged["rows"]==whole["rows"]
+  for col in frame.columns:
+    assert merged["columns"][col]["nulls"]==whole["columns"][col]["nulls"]
+    assert merged["columns"][col].get("counts")==whole["columns"][col].get("counts")
+  #Up to 2*sketch_size distinct values a sketch is exact, so merging changes nothing
+  for col in ["months","income"]:
+    for key in ["values","weights"]:
+      np.testing.assert_array_equal(merged["columns"][col]["sketch"][key], whole["columns"][col]["sketch"][key])
+
+#Past that, each compaction keeps the total weight and the mean and moves ranks by at most 1/sketch_size
+def test_compacted_sketch_stays_close_to_single_pass(monkeypatch):
+  monkeypatch.setattr(sim_validate, "sketch_size", 64)
+  frame, size = summary_frame(20000), 500
+  whole = sim_validate.summarize(frame)["columns"]["balance"]["sketch"]
+  merged = summary_in_chunks(frame, size)["columns"]["balance"]["sketch"]
+  assert len(merged["values"])<=2*64 and merged["weights"].sum()==whole["weights"].sum()
+  assert sim_validate.sketch_mean(merged)==pytest.approx(sim_validate.sketch_mean(whole), rel=1e-12)
+  bound = (len(frame)//size)/64
+  for x in np.quantile(frame["balance"], [0.05,0.25,0.5,0.75,0.95]):
+    assert abs(sim_validate.sketch_cdf(merged, x)-sim_validate.sketch_cdf(whole, x))<=bound
+
+def test_streamed_validation_matches_run(tmp_path):
+  sim.main(2000, 700, str(tmp_path), validate=True)
+  with open(tmp_path/"validation.json") as f:
+    in_run = json.load(f)
+  streamed = validate_output.main(str(tmp_path), str(tmp_path/"streamed.json"), chunk_rows=300)
+  with open(tmp_path/"streamed.json") as f:
+    assert json.load(f)==in_run
+  assert streamed["failed"]==in_run["failed"]
+
+############################# Table specs ######################################
+
+#Public records and collections: no rows with probability zero_prob, and otherwise a Poisson number of them
+@pytest.mark.parametrize("spec", [sim.public_record_spec, sim.collection_spec], ids=lambda spec: spec["stage"])
+def test_zero_inflated_count_shares(spec):
+  ids, run_key, totals = sim.run_keys(200000, 6)
+  counts = sim.shard_counts(0, 200000, run_key)[sim.child_specs.index(spec)]
+  dist = spec["counts"][0]
+  assert dist["dist"]=="zero_inflated_poisson"
+  for k in range(5):
+    p = (1-dist["zero_prob"])*poisson.pmf(k, dist["mean"]) + dist["zero_prob"]*(k==0)
+    assert abs((counts==k).mean()-p) <= 4*np.sqrt(p*(1-p)/len(counts)), k
+  assert abs(counts.mean()-(1-dist["zero_prob"])*dist["mean"]) < 0.01
+
+#SHA-256 of the tables of main(1000, 400) before public records and collections were added
+digests = {
+  "Loan Applications": "e08d53d7578119ed11a28ad736c6d6edad5988751e066e5292297c05d9528828",
+  "Bureau Tradeline Accounts": "36b4bfa24b341d2acb866e9e24c756e57ff6f0a5ecd7d66186b50f344e9ff6a2",
+  "Bureau Inquiries": "0753855b3129a81cc7592dcc9eac5b2616d00b49805b82000d5ec7d465e1ff7c",
+  "agg_tl": "3ce5e122d46626f263c3caf0d34cf709ca549ff529ef824b05d7986b70607ae6",
+  "inq_agg": "0d5cef16795b64608758b6c7181defbabb8cea5e86c1626fdf18d3373c61263d",
+}
+
+#With their leaf weights at 0 the new tables leave the others as they were, whatever their specs draw
+@pytest.mark.parametrize("mean", [None, 4])
+def test_new_tables_leave_output_unchanged_at_zero_weight(tmp_path, monkeypatch, mean):
+  for spec in (sim.public_record_spec, sim.collection_spec):
+    monkeypatch.setitem(spec, "leaf_weight", 0)
+    if mean is not None:
+      monkeypatch.setitem(spec, "counts", (dict(spec["counts"][0], mean=mean), spec["counts"][1]))
+  sim.main(1000, 400, str(tmp_path))
+  for name, digest in digests.items():
+    assert hashlib.sha256((tmp_path/(name+".csv")).read_bytes()).hexdigest()==digest, name
+  assert len(pd.read_csv(tmp_path/"Bureau Public Records.csv")) and len(pd.read_csv(tmp_path/"Bureau Collections.csv"))
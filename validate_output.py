@@ -0,0 +1,56 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import pandas as pd
+import bureau_data_simulation as sim
+from sim_output import pa
+from sim_validate import summarize, merge_summaries, validation_report, write_validation
+
+if pa is not None:
+  import pyarrow.dataset as ds
+
+# Checks output already on disk against the configured distributions, as --validate does during a run (see sim_validate):
+# each table is streamed back in chunks of chunk_rows rows, CSV with pandas' chunked reader and datasets a record batch at
+# a time, and the chunks' summaries are merged, so memory stays at a chunk whatever the size of the output.
+# The table list and format come from the run's run_report.json. Exits with status 1 when a check fails.
+
+chunk_rows = 500000
+
+#Chunks of a table of the output, as the run wrote it
+def table_chunks(out_dir, name, fmt, chunk_rows=chunk_rows):
+  path = os.path.join(out_dir, name)
+  if fmt=="csv":
+    header = pd.read_csv(path+".csv", nrows=0).columns
+    dates = [col for col in header if col.endswith("_date")]
+    #inq_agg is written with its index, as an unnamed first column
+    index_col = 0 if header[0].startswith("Unnamed") else None
+    #Missing values are written as empty fields; text such as "NA" is a value
+    yield from pd.read_csv(path+".csv", chunksize=chunk_rows, parse_dates=dates, index_col=index_col, keep_default_na=False, na_values=[""])
+    return
+  if pa is None:
+    raise ImportError("pyarrow is required to read %s output" % fmt)
+  for batch in ds.dataset(path, format="ipc" if fmt=="feather" else fmt).to_batches(batch_size=chunk_rows):
+    yield batch.to_pandas(date_as_object=False)
+
+def main(out_dir=".", path=None, chunk_rows=chunk_rows):
+  with open(os.path.join(out_dir, "run_report.json")) as f:
+    run = json.load(f)["run"]
+  names = sim.tables + (["scenario_labels"] if run.get("scenarios") else []) + (["Bureau Tradeline Snapshots"] if run.get("snapshot_months") else [])
+  summaries = {}
+  for name in names:
+    for chunk in table_chunks(out_dir, name, run["format"], chunk_rows):
+      summaries[name] = merge_summaries(summaries.get(name), summarize(chunk, sim.id_columns))
+  validation = validation_report(summaries, sim.validation_checks)
+  write_validation(path or os.path.join(out_dir, "validation.json"), validation)
+  return validation
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Check simulated output against the configured distributions")
+  parser.add_argument("--out-dir", default=".", help="directory holding the run's output and run_report.json")
+  parser.add_argument("--report", default=None, help="where to write the results; by default validation.json in --out-dir")
+  parser.add_argument("--chunk-rows", type=int, default=chunk_rows, help="rows read at a time")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  sys.exit(1 if main(args.out_dir, args.report, args.chunk_rows)["failed"] else 0)